@@ -0,0 +1,131 @@
+# "Boomerang" animations of the capture burst.
+#
+# The four captures of a session are played forth and back (1 2 3 4 3 2) as
+# an animated GIF, or as an MP4 when a local ffmpeg is available. Encoding
+# takes seconds of CPU, so it runs in a separate process pool, off the
+# session path: the worker processes are niced and pinned to the last CPU
+# so the booth's countdowns and captures keep the other cores, and ffmpeg
+# is limited to one thread.
+#
+# GIF frames share one palette computed once per session from all frames,
+# so colours do not flicker from frame to frame and only one median cut is
+# paid.
+
+import os
+import shutil
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+
+def boomerang(frames):
+    return frames + frames[-2:0:-1]
+
+
+def lower_priority(niceness=19, cpus=None):
+    # process pool initializer
+    os.nice(niceness)
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            pass
+
+
+def make_gif(frames, path, duration=0.25):
+    # frames: PIL images of the same size, duration: seconds per frame
+    frames = boomerang([f.convert("RGB") for f in frames])
+    w, h = frames[0].size
+    # palette of all the frames at once
+    sample = Image.new("RGB", (w, h * len(frames)))
+    for i, frame in enumerate(frames):
+        sample.paste(frame, (0, i * h))
+    palette = sample.reduce(2).quantize(colors=255, method=Image.MEDIANCUT)
+    gif = [frame.quantize(palette=palette, dither=Image.FLOYDSTEINBERG)
+           for frame in frames]
+    tmp = path + ".tmp"
+    gif[0].save(tmp, "GIF", save_all=True, append_images=gif[1:],
+                duration=int(1000 * duration), loop=0, optimize=True)
+    os.replace(tmp, path)
+    return path
+
+
+def make_mp4(frames, path, duration=0.25, ffmpeg="ffmpeg", repeat=3):
+    # raw frames on ffmpeg's stdin, H.264 for browsers and phones
+    frames = boomerang([f.convert("RGB") for f in frames]) * repeat
+    w, h = frames[0].size
+    # yuv420p needs even sizes
+    w, h = (w - w % 2, h - h % 2)
+    tmp = path + ".tmp.mp4"
+    cmd = [ffmpeg, "-y", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24",
+           "-s", "{}x{}".format(w, h), "-framerate", str(1.0 / duration),
+           "-i", "-", "-threads", "1",
+           "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+           "-r", "25", "-movflags", "+faststart", tmp]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for frame in frames:
+            p.stdin.write(frame.crop((0, 0, w, h)).tobytes())
+        p.stdin.close()
+    except BrokenPipeError:
+        pass
+    err = p.stderr.read()
+    if p.wait() != 0:
+        raise OSError("ffmpeg failed: {}".format(err.decode(errors="replace")))
+    os.replace(tmp, path)
+    return path
+
+
+class Animator():
+    def __init__(self, kind="gif", width=480, duration=0.25, workers=1,
+                 niceness=19, cpus=None, ffmpeg=None):
+        # kind: "gif" or "mp4"; mp4 falls back to gif without ffmpeg
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        if kind == "mp4" and self.ffmpeg is None:
+            kind = "gif"
+        self.kind = kind
+        self.width = width
+        self.duration = duration
+        if cpus is None and hasattr(os, "sched_getaffinity"):
+            # the last core, the booth has the others
+            cpus = {max(os.sched_getaffinity(0))}
+        # fresh interpreters, forking the threaded booth is not safe
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=lower_priority, initargs=(niceness, cpus))
+        self.made = 0
+
+    def frames(self, captures):
+        # shrunk before they are sent to the worker process
+        frames = []
+        for img in captures:
+            factor = max(img.size[0] // self.width, 1)
+            if factor > 1:
+                img = img.reduce(factor)
+            if img.size[0] > self.width:
+                img = img.resize((self.width, img.size[1] * self.width
+                                  // img.size[0]), Image.BILINEAR)
+            frames.append(img)
+        return frames
+
+    def path(self, photo_path):
+        return os.path.splitext(photo_path)[0] + "." + self.kind
+
+    def submit(self, captures, path):
+        if self.kind == "mp4":
+            return self.pool.submit(make_mp4, self.frames(captures), path,
+                                    self.duration, self.ffmpeg)
+        return self.pool.submit(make_gif, self.frames(captures), path,
+                                self.duration)
+
+    def make(self, captures, path):
+        # blocks the calling (pipeline) thread, not the booth
+        path = self.submit(captures, path).result()
+        self.made += 1
+        return path
+
+    def close(self):
+        self.pool.shutdown()
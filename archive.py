@@ -0,0 +1,224 @@
+# Indexed photo archive.
+#
+# Finished photos stay flat in photos/ as YYYYmmdd-HHMMSS.jpg; an SQLite
+# index next to them (photos/archive.db) has one row per session with its
+# capture times, layout, print and upload status and the paths of the
+# photo, print strip and thumbnail, so reprints, upload retries and gallery
+# listings are queries instead of directory walks and JPEG decodes.
+# Thumbnails are made by a background thread into photos/thumbs/. scan()
+# indexes the photos already in the directory that the database does not
+# know about (and only those), so an existing photos/ is picked up
+# incrementally.
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+from PIL import Image
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    created REAL,
+    captures TEXT,
+    layout TEXT,
+    photo_path TEXT,
+    toprint_path TEXT,
+    thumb_path TEXT,
+    width INTEGER,
+    height INTEGER,
+    print_state TEXT,
+    print_error TEXT,
+    uploaded_at REAL,
+    animation_path TEXT,
+    thumb_error TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created);
+CREATE INDEX IF NOT EXISTS sessions_photo ON sessions (photo_path);
+"""
+
+# columns added since the first schema, for existing databases
+MIGRATIONS = [("animation_path", "TEXT"), ("thumb_error", "TEXT")]
+
+
+def session_time(name):
+    # sessions are named after their start time, "-2"... when several
+    # started within the same second
+    try:
+        return time.mktime(time.strptime(name[:15], "%Y%m%d-%H%M%S"))
+    except ValueError:
+        return None
+
+
+class Archive():
+    def __init__(self, photos_dir, db_path=None, thumb_size=(320, 240),
+                 logger=None):
+        self.photos_dir = photos_dir
+        self.thumbs_dir = os.path.join(photos_dir, "thumbs")
+        self.db_path = db_path or os.path.join(photos_dir, "archive.db")
+        self.thumb_size = thumb_size
+        self.logger = logger
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        # one connection shared by the booth threads, serialized by a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in
+                   self.db.execute("PRAGMA table_info(sessions)")]
+        for column, kind in MIGRATIONS:
+            if column not in columns:
+                self.db.execute("ALTER TABLE sessions ADD COLUMN {} {}".format(
+                    column, kind))
+        self.thumbnails = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="thumbnails")
+        self._thread.start()
+
+    def update(self, session_id, **fields):
+        # creates the row if needed, e.g. a print finishing before the
+        # session is archived
+        if "captures" in fields and not isinstance(fields["captures"], str):
+            fields["captures"] = json.dumps(fields["captures"])
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO sessions (id, created) "
+                            "VALUES (?, ?)", (session_id,
+                                              session_time(session_id)))
+            if fields:
+                self.db.execute(
+                    "UPDATE sessions SET {} WHERE id = ?".format(
+                        ", ".join("{} = ?".format(k) for k in fields)),
+                    list(fields.values()) + [session_id])
+
+    def add(self, session_id, photo_path, **fields):
+        # fields: toprint_path, captures, layout, print_state...
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if "toprint_path" in fields:
+            fields["toprint_path"] = os.path.abspath(fields["toprint_path"])
+        self.update(session_id, photo_path=os.path.abspath(photo_path),
+                    **fields)
+        self._queue.put(session_id)
+
+    def printed(self, session_id, state, error=None):
+        self.update(session_id, print_state=state, print_error=error)
+
+    def uploaded(self, paths):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE sessions SET uploaded_at = ? WHERE photo_path = ?",
+                [(now, os.path.abspath(p)) for p in paths])
+
+    def _row(self, row):
+        if row is None:
+            return None
+        entry = dict(row)
+        if entry["captures"]:
+            entry["captures"] = json.loads(entry["captures"])
+        return entry
+
+    def get(self, session_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM sessions WHERE id = ?",
+                                  (session_id,)).fetchone()
+        return self._row(row)
+
+    def list(self, limit=50, offset=0, printed=None, uploaded=None):
+        # newest first; printed/uploaded: True or False to filter
+        where = []
+        if printed is not None:
+            where.append("print_state {} 'done'".format(
+                "=" if printed else "IS NOT"))
+        if uploaded is not None:
+            where.append("uploaded_at IS {}NULL".format(
+                "NOT " if uploaded else ""))
+        sql = "SELECT * FROM sessions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created DESC, id DESC LIMIT ? OFFSET ?"
+        with self.lock:
+            rows = self.db.execute(sql, (limit, offset)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def scan(self):
+        # index the photos added to photos/ behind our back (or before the
+        # index existed) and queue missing thumbnails; returns the number
+        # of new sessions
+        with self.lock:
+            known = {row[0]: row[1] for row in self.db.execute(
+                "SELECT id, thumb_path FROM sessions "
+                "WHERE thumb_error IS NULL")}
+            # photos a thumbnail could not be made of are not retried
+            failed = {row[0] for row in self.db.execute(
+                "SELECT id FROM sessions WHERE thumb_error IS NOT NULL")}
+        added = []
+        with os.scandir(self.photos_dir) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext.lower() != ".jpg" or not entry.is_file():
+                    continue
+                if name in failed:
+                    continue
+                if name not in known:
+                    created = session_time(name) or entry.stat().st_mtime
+                    added.append((name, created, os.path.abspath(entry.path)))
+                elif known[name] is None or not os.path.exists(known[name]):
+                    self._queue.put(name)
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO sessions (id, created, "
+                                "photo_path) VALUES (?, ?, ?)", added)
+        for name, _, _ in added:
+            self._queue.put(name)
+        return len(added)
+
+    def thumbnail(self, session_id):
+        entry = self.get(session_id)
+        if entry is None or not entry["photo_path"]:
+            return None
+        path = os.path.join(self.thumbs_dir, session_id + ".jpg")
+        img = Image.open(entry["photo_path"])
+        width, height = img.size
+        # JPEG DCT scaling, only about thumb_size pixels are decoded
+        img.draft("RGB", self.thumb_size)
+        img.thumbnail(self.thumb_size)
+        img.save(path, "JPEG", quality=85)
+        self.update(session_id, thumb_path=path, width=width, height=height,
+                    thumb_error=None)
+        self.thumbnails += 1
+        return path
+
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            if session_id is None:
+                return
+            try:
+                self.thumbnail(session_id)
+            except Exception as e:
+                # a truncated or corrupt photo, the next ones still get theirs
+                if self.logger is not None:
+                    self.logger.error("no thumbnail for {}".format(
+                        session_id), exc_info=True)
+                try:
+                    self.update(session_id, thumb_error="{}: {}".format(
+                        type(e).__name__, e))
+                except Exception:
+                    pass
+
+    def pending_thumbnails(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
+        with self.lock:
+            self.db.close()
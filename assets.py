@@ -0,0 +1,73 @@
+# Pre-baked screen assets.
+#
+# The home, end and print screens are PNG backgrounds with text drawn on
+# top. Decoding the PNGs and rasterizing the text again on every start is
+# slow on a Pi, so the finished screens are kept in cache/ as raw pixels,
+# keyed by the source file (path, size, mtime), the font and the text
+# drawn. The next start only reads them back; editing a PNG or a text
+# makes a new key and the stale file is replaced.
+
+import os
+import json
+import hashlib
+from PIL import Image, ImageDraw
+
+
+class AssetCache():
+    def __init__(self, cache_dir, font, font_path=None):
+        # font: size -> ImageFont, e.g. ScreenCache.font
+        self.cache_dir = cache_dir
+        self.font = font
+        self.font_path = font_path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, texts):
+        st = os.stat(path)
+        material = json.dumps([os.path.abspath(path), st.st_size,
+                               st.st_mtime_ns, self.font_path, texts])
+        return hashlib.sha1(material.encode()).hexdigest()[:16]
+
+    def screen(self, path, texts=()):
+        # texts: [[(x, y), text, font size, fill], ...]
+        texts = [list(t) for t in texts]
+        name = os.path.splitext(os.path.basename(path))[0]
+        cached = os.path.join(self.cache_dir, "{}-{}.raw".format(
+            name, self.key(path, texts)))
+        try:
+            img = self.read(cached)
+            self.hits += 1
+            return img
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        img = self.render(path, texts)
+        for old in os.listdir(self.cache_dir):
+            if old.startswith(name + "-") and old.endswith(".raw"):
+                os.remove(os.path.join(self.cache_dir, old))
+        self.write(cached, img)
+        return img
+
+    def render(self, path, texts):
+        img = Image.open(path)
+        img.load()
+        d = ImageDraw.Draw(img)
+        for xy, text, size, fill in texts:
+            d.text(tuple(xy), text, font=self.font(size), fill=tuple(fill))
+        return img
+
+    def read(self, path):
+        # one JSON header line, then the pixels
+        with open(path, "rb") as f:
+            header = json.loads(f.readline().decode())
+            data = f.read()
+        return Image.frombytes(header["mode"], tuple(header["size"]), data)
+
+    def write(self, path, img):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write((json.dumps({"mode": img.mode,
+                                 "size": img.size}) + "\n").encode())
+            f.write(img.tobytes())
+        os.replace(tmp, path)
@@ -0,0 +1,261 @@
+# Per-stage latency benchmark suite.
+#
+# usage: python3 bench.py [--rounds N] [--sizes 640x480,1640x1232]
+#                         [--output results.json]
+#        python3 bench.py --compare old.json new.json
+#
+# Every stage of a session is run on a Booth built with the simulated
+# backends, with synthetic captures at the given camera resolutions, and
+# timed on its own. Results (p50/p95/p99 in ms) are written as JSON so two
+# versions can be compared with --compare.
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+from booth_tk import Booth
+from hardware import simulated_backends
+from simulate import make_wd
+from timeline import Timeline
+
+# a Pi camera v2 binned mode, the booth default, and the full sensor
+SIZES = [(640, 480), (1640, 1232)]
+
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def summarize(times):
+    ms = [1000 * t for t in times]
+    return {"n": len(ms),
+            "p50": percentile(ms, 50),
+            "p95": percentile(ms, 95),
+            "p99": percentile(ms, 99),
+            "mean": sum(ms) / len(ms) if ms else 0.0,
+            "max": max(ms) if ms else 0.0}
+
+
+def timed(fn, rounds, *args):
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+class Suite():
+    def __init__(self, size, rounds, tick=0.05):
+        self.size = size
+        self.rounds = rounds
+        self.tick = tick
+        self.wd = make_wd()
+        logger = logging.getLogger("booth.bench")
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        backends = simulated_backends(os.path.join(self.wd, "gallery"),
+                                      speed=1000.0)
+        self.booth = Booth(logger, wd=self.wd, backends=backends,
+                           camera_width=size[0], camera_heigh=size[1])
+        self.booth.prerender_screens()
+        self.captures = [self.booth.backends.camera().frame(size)
+                         for _ in range(4)]
+
+    def close(self):
+        self.booth.teardown()
+        shutil.rmtree(self.wd)
+
+    def screen_switch(self):
+        texts = ['photo {} / 4 !'.format(i) for i in range(1, 5)]
+        return timed(lambda: [self.booth.show_smile(t) for t in texts][-1],
+                     self.rounds)
+
+    def overlay_render(self):
+        # cold render of a new frame, what every tick used to cost
+        overlays = self.booth.overlays
+        return timed(overlays.render, self.rounds,
+                     250, 100, 240, "3", (32, 178, 170, 210))
+
+    def overlay_show(self):
+        return timed(self.booth.add_preview_overlay, self.rounds,
+                     250, 100, 240, "3")
+
+    def countdown_drift(self):
+        # lateness of each tick planned on a Timeline the way play() does
+        root = self.booth.root
+        timeline = Timeline(
+            lambda seconds, fn, *args: root.after(int(1000 * seconds), fn,
+                                                  *args),
+            clock=lambda: time.monotonic() * root.speed)
+        for n in range(self.rounds):
+            timeline.at(n * self.tick, "tick",
+                        self.booth.add_preview_overlay, 250, 100, 240,
+                        str(3 - n % 3))
+        timeline.at(self.rounds * self.tick, "end", root.quit)
+        timeline.start()
+        root.mainloop()
+        # in real seconds
+        return [max(error, 0) / root.speed
+                for kind, _, error in timeline.errors() if kind == "tick"]
+
+    def capture(self):
+        path = os.path.join(self.wd, "capture.jpg")
+        times = timed(self.booth.capture_image, self.rounds, path)
+        self.booth.burst.flush()
+        return times
+
+    def compose(self):
+        compositor = self.booth.compositor
+        show = os.path.join(self.wd, "show.jpg")
+        toprint = os.path.join(self.wd, "toprint.jpg")
+
+        def both():
+            compositor.show_preview(self.captures, show)
+            compositor.print_strip(self.captures, toprint)
+        return timed(both, self.rounds)
+
+    def review_resize(self):
+        # from the captures to the annotated review screen
+        compositor = self.booth.compositor
+        size = (self.booth.w, self.booth.h)
+        return timed(lambda: self.booth.load_toprint(
+            compositor.review(self.captures, size)), self.rounds)
+
+    def prepress(self):
+        # print-ready file during the review screen, off the green press
+        strip = self.booth.compositor.print_strip(self.captures)
+        profile = self.booth.print_profile
+        path = profile.path(self.wd)
+        return timed(profile.prepare, self.rounds, strip, path)
+
+    def print_submit(self):
+        # submit to an idle spooler until the fake CUPS queue gave a job id
+        path = os.path.join(self.wd, "toprint.jpg")
+        times = []
+        for _ in range(self.rounds):
+            submitted = threading.Event()
+            t0 = time.perf_counter()
+            job = self.booth.spooler.submit(
+                path, callback=lambda job: submitted.set())
+            submitted.wait(5)
+            times.append(time.perf_counter() - t0)
+            job.wait(5)
+        return times
+
+    def upload_enqueue(self):
+        # distinct names, the journal ignores files already pending
+        paths = iter([os.path.join(self.wd, "photo{}.jpg".format(i))
+                      for i in range(self.rounds)])
+        return timed(lambda: self.booth.uploader.enqueue(next(paths)),
+                     self.rounds)
+
+    stages = ["screen_switch", "overlay_render", "overlay_show",
+              "countdown_drift", "capture", "compose", "review_resize",
+              "prepress", "print_submit", "upload_enqueue"]
+
+    def run(self, stages=None):
+        results = {}
+        for stage in stages or self.stages:
+            results[stage] = summarize(getattr(self, stage)())
+        return results
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(sizes, rounds, stages=None):
+    import PIL
+    report = {"meta": {"version": git_version(),
+                       "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "pillow": PIL.__version__,
+                       "machine": platform.machine(),
+                       "rounds": rounds},
+              "results": {}}
+    for size in sizes:
+        suite = Suite(size, rounds)
+        try:
+            report["results"]["{}x{}".format(*size)] = suite.run(stages)
+        finally:
+            suite.close()
+    return report
+
+
+def print_report(report):
+    for size, stages in report["results"].items():
+        print("{} ({})".format(size, report["meta"]["version"]))
+        for stage, r in stages.items():
+            print("  {:<16} p50 {:8.2f}  p95 {:8.2f}  p99 {:8.2f} ms".format(
+                stage, r["p50"], r["p95"], r["p99"]))
+
+
+def compare(old, new, threshold=0.1):
+    # returns the (size, stage) pairs whose p50 got worse than threshold
+    regressions = []
+    print("{} -> {}".format(old["meta"]["version"], new["meta"]["version"]))
+    for size, stages in new["results"].items():
+        print(size)
+        for stage, r in stages.items():
+            before = old["results"].get(size, {}).get(stage)
+            if before is None:
+                print("  {:<16} new".format(stage))
+                continue
+            ratio = r["p50"] / before["p50"] if before["p50"] else 1.0
+            flag = ""
+            if ratio > 1 + threshold and r["p50"] - before["p50"] > 0.1:
+                flag = "  REGRESSION"
+                regressions.append((size, stage))
+            print("  {:<16} p50 {:8.2f} -> {:8.2f} ms  x{:.2f}{}".format(
+                stage, before["p50"], r["p50"], ratio, flag))
+    return regressions
+
+
+def parse_size(text):
+    w, h = text.lower().split("x")
+    return (int(w), int(h))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="boothy stage benchmarks")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--sizes", default=",".join(
+        "{}x{}".format(*s) for s in SIZES))
+    parser.add_argument("--stages", default=None,
+                        help="comma separated subset of: " +
+                        ", ".join(Suite.stages))
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new) else 0)
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    stages = args.stages.split(",") if args.stages else None
+    report = run(sizes, args.rounds, stages)
+    print_report(report)
+    output = args.output or "bench_{}.json".format(time.strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(output))
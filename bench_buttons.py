@@ -0,0 +1,75 @@
+# Benchmark: idle CPU and wake-up latency of the button input, on any
+# Linux box thanks to the fake GPIO backend.
+#
+# usage: python3 bench_buttons.py [idle seconds] [presses]
+
+import sys
+import time
+import statistics
+import threading
+from buttons import ButtonInput, FakeGPIO
+
+PIN = 26
+
+
+def busy_wait(gpio, stop):
+    # the old user_input() loop
+    while not stop.is_set():
+        gpio.input(PIN)
+
+
+def idle_cpu(wait_fn, seconds):
+    # CPU seconds used by this process per wall second while waiting
+    t0, c0 = (time.monotonic(), time.process_time())
+    wait_fn(seconds)
+    return (time.process_time() - c0) / (time.monotonic() - t0)
+
+
+def bench_idle(seconds):
+    gpio = FakeGPIO()
+    buttons = ButtonInput(gpio, {"green": PIN})
+    queue_cpu = idle_cpu(lambda s: buttons.wait(timeout=s), seconds)
+    buttons.close()
+
+    stop = threading.Event()
+    t = threading.Thread(target=busy_wait, args=(gpio, stop))
+
+    def poll(s):
+        t.start()
+        time.sleep(s)
+        stop.set()
+        t.join()
+    poll_cpu = idle_cpu(poll, seconds)
+    print("idle CPU: event queue {:5.1f} %  busy wait {:5.1f} %".format(
+        100 * queue_cpu, 100 * poll_cpu))
+
+
+def bench_latency(presses, debounce, bounces):
+    gpio = FakeGPIO()
+    buttons = ButtonInput(gpio, {"green": PIN}, debounce=debounce)
+    latencies = []
+    extra = 0
+    for _ in range(presses):
+        t0 = time.monotonic()
+        gpio.press(PIN, bounces)
+        event = buttons.wait(timeout=1)
+        latencies.append(event.time - t0)
+        gpio.release(PIN, bounces)
+        event = buttons.wait(timeout=1)
+        # any further event is a bounce leaking through
+        while buttons.wait(timeout=2 * debounce + 0.01) is not None:
+            extra += 1
+    buttons.close()
+    print("wake-up latency (debounce {:.0f} ms, {} bounces): "
+          "median {:.2f} ms  max {:.2f} ms  spurious events {}".format(
+              1000 * debounce, bounces,
+              1000 * statistics.median(latencies),
+              1000 * max(latencies), extra))
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    presses = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    bench_idle(seconds)
+    bench_latency(presses, 0.02, 0)
+    bench_latency(presses, 0.02, 3)
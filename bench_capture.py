@@ -0,0 +1,54 @@
+# Benchmark: shutter to next countdown latency, still port to file vs
+# in-memory video port burst, with the fake camera backend.
+#
+# usage: python3 bench_capture.py [shots] [still delay in seconds]
+
+import os
+import sys
+import time
+import shutil
+import statistics
+import tempfile
+from capture import BurstCapture, FakeCamera
+
+SIZE = (640, 480)
+
+
+def still_to_file(camera, path):
+    # the old capture_image()
+    camera.stop_preview()
+    camera.capture(path, resize=SIZE)
+    camera.start_preview()
+
+
+def report(name, times):
+    print("{:<20} median {:7.1f} ms  max {:7.1f} ms".format(
+        name, 1000 * statistics.median(times), 1000 * max(times)))
+
+
+if __name__ == "__main__":
+    shots = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    still_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    wd = tempfile.mkdtemp(prefix="boothy_bench_")
+    camera = FakeCamera(still_delay=still_delay)
+    try:
+        times = []
+        for i in range(shots):
+            t0 = time.perf_counter()
+            still_to_file(camera, os.path.join(wd, "still{}.jpg".format(i)))
+            times.append(time.perf_counter() - t0)
+        report("still port + file", times)
+
+        burst = BurstCapture(camera, SIZE)
+        times = []
+        for i in range(shots):
+            t0 = time.perf_counter()
+            burst.capture(os.path.join(wd, "burst{}.jpg".format(i)))
+            times.append(time.perf_counter() - t0)
+        report("video port + memory", times)
+        t0 = time.perf_counter()
+        burst.close()
+        print("background writes drained in {:.1f} ms".format(
+            1000 * (time.perf_counter() - t0)))
+    finally:
+        shutil.rmtree(wd)
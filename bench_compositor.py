@@ -0,0 +1,101 @@
+# Benchmark: ImageMagick montage subprocesses vs in-process compositor.
+#
+# usage: python3 bench_compositor.py [rounds] [width] [height]
+#
+# Synthetic captures are written to a temporary directory, then both the
+# print strip and the screen preview are built with each method: montage
+# subprocesses, the Montage compositor and the compiled templates of
+# templates/ (layouts.Layout).
+
+import os
+import sys
+import time
+import shutil
+import random
+import statistics
+import subprocess
+import tempfile
+from PIL import Image, ImageDraw
+from compositor import Compositor, PRINT_MONTAGE, SHOW_MONTAGE
+from layouts import Layout, load_template
+
+
+def make_captures(wd, width, height):
+    paths = []
+    for i in range(1, 5):
+        img = Image.new("RGB", (width, height),
+                        tuple(random.randrange(256) for _ in range(3)))
+        d = ImageDraw.Draw(img)
+        for _ in range(200):
+            x, y = (random.randrange(width), random.randrange(height))
+            d.ellipse((x, y, x + 40, y + 40),
+                      fill=tuple(random.randrange(256) for _ in range(3)))
+        path = os.path.join(wd, "{}.jpg".format(i))
+        img.save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def run_montage(paths, wd):
+    toprint = os.path.join(wd, "montage_print.jpg")
+    show = os.path.join(wd, "montage_show.jpg")
+    p = subprocess.Popen(PRINT_MONTAGE.command(paths, toprint),
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    subprocess.call(SHOW_MONTAGE.command(paths, show))
+    p.wait()
+    return toprint, show
+
+
+def run_compositor(compositor, paths, wd):
+    toprint = os.path.join(wd, "pil_print.jpg")
+    show = os.path.join(wd, "pil_show.jpg")
+    compositor.compose(paths, toprint, show)
+    return toprint, show
+
+
+def timeit(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        res = fn()
+        times.append(time.perf_counter() - t0)
+    return times, res
+
+
+def report(name, times):
+    print("{:<12} median {:7.1f} ms  mean {:7.1f} ms  min {:7.1f} ms".format(
+        name,
+        1000 * statistics.median(times),
+        1000 * statistics.mean(times),
+        1000 * min(times)))
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 640
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 480
+    wd = tempfile.mkdtemp(prefix="boothy_bench_")
+    try:
+        paths = make_captures(wd, width, height)
+        compositor = Compositor()
+        times, outputs = timeit(lambda: run_compositor(compositor, paths, wd),
+                                rounds)
+        report("compositor", times)
+        pil_sizes = [Image.open(p).size for p in outputs]
+        layouts = Compositor(
+            Layout(load_template("strip"), (width, height)),
+            Layout(load_template("preview"), (width, height)))
+        times, outputs = timeit(lambda: run_compositor(layouts, paths, wd),
+                                rounds)
+        report("layouts", times)
+        if shutil.which("montage") is None:
+            print("montage not found, skipping ImageMagick run")
+        else:
+            times, outputs = timeit(lambda: run_montage(paths, wd), rounds)
+            report("montage", times)
+            im_sizes = [Image.open(p).size for p in outputs]
+            print("output sizes: compositor {} / montage {} -> {}".format(
+                pil_sizes, im_sizes,
+                "same" if pil_sizes == im_sizes else "DIFFERENT"))
+    finally:
+        shutil.rmtree(wd)
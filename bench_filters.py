@@ -0,0 +1,44 @@
+# Benchmark: post-capture filters on a session's four frames.
+#
+# usage: python3 bench_filters.py [rounds] [width] [height]
+#
+# Each filter is applied to a batch of four synthetic captures, the way the
+# compose stage does it, and compared with one countdown tick (1 s).
+
+import sys
+import time
+import statistics
+from capture import FakeCamera
+from filters import FILTERS, get_filter
+
+TICK = 1.0
+
+
+def bench(rounds, width, height):
+    camera = FakeCamera()
+    frames = [camera.frame((width, height)) for _ in range(4)]
+    print("4 frames {}x{}, {} rounds".format(width, height, rounds))
+    for name in sorted(FILTERS):
+        t0 = time.perf_counter()
+        f = get_filter(name)
+        f.apply(frames[:1])
+        compiled = time.perf_counter() - t0
+        times = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            f.apply(frames)
+            times.append(time.perf_counter() - t0)
+        median = statistics.median(times)
+        print("  {:<9} median {:7.1f} ms  max {:7.1f} ms  "
+              "({:4.1%} of a tick, first call {:.1f} ms)".format(
+                  name, 1000 * median, 1000 * max(times), median / TICK,
+                  1000 * compiled))
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    if len(sys.argv) > 3:
+        bench(rounds, int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        for width, height in [(640, 480), (1640, 1232)]:
+            bench(rounds, width, height)
@@ -0,0 +1,143 @@
+# Benchmark: the guest gallery under load, on loopback.
+#
+# usage: python3 bench_gallery.py [phones] [seconds] [sessions] [connections]
+#
+# A temporary archive of synthetic sessions is served by GalleryServer on
+# 127.0.0.1 while `phones` browse it like guests do: the index page, every
+# thumbnail, then full photos fetched in byte ranges. Like a phone's
+# browser, each one keeps `connections` (6) keep-alive connections open,
+# one client thread each, and shares the thumbnails out between them.
+# Meanwhile a 10 ms timer loop stands in for the booth's Tk loop and its
+# lateness is measured, with and without the load.
+
+import os
+import sys
+import time
+import shutil
+import random
+import tempfile
+import threading
+import http.client
+from capture import FakeCamera
+from archive import Archive
+from gallery import GalleryServer
+
+
+def make_archive(wd, sessions):
+    camera = FakeCamera()
+    photos = os.path.join(wd, "photos")
+    os.makedirs(photos)
+    archive = Archive(photos)
+    for i in range(sessions):
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(1.6e9 + 60 * i))
+        path = os.path.join(photos, name + ".jpg")
+        camera.frame((1640, 1232)).save(path, "JPEG", quality=90)
+        archive.add(name, path)
+    while archive.pending_thumbnails():
+        time.sleep(0.05)
+    # the last one may still be written
+    time.sleep(0.2)
+    return archive
+
+
+def timer_lateness(stop, interval=0.01):
+    late = []
+    next_t = time.perf_counter() + interval
+    while not stop.is_set():
+        time.sleep(max(next_t - time.perf_counter(), 0))
+        late.append(1000 * (time.perf_counter() - next_t))
+        next_t += interval
+    return late
+
+
+def phone(port, ids, deadline, latencies, errors, n=0, connections=1):
+    # connection n of a phone: the page and photos on the first one, the
+    # thumbnails spread over all of them
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def get(path, headers=None):
+        t0 = time.perf_counter()
+        conn.request("GET", path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        latencies.append(1000 * (time.perf_counter() - t0))
+        if response.status >= 400:
+            errors.append(response.status)
+        return response, body
+
+    while time.monotonic() < deadline:
+        try:
+            if n == 0:
+                get("/")
+            for sid in ids[n::connections]:
+                get("/thumb/{}.jpg".format(sid))
+            if n != 0:
+                continue
+            sid = random.choice(ids)
+            response, _ = get("/photo/{}.jpg".format(sid),
+                              {"Range": "bytes=0-16383"})
+            size = int(response.headers["Content-Range"].split("/")[1])
+            if size <= 16384:
+                continue
+            get("/photo/{}.jpg".format(sid),
+                {"Range": "bytes=16384-{}".format(size - 1),
+                 "If-Range": response.headers["ETag"]})
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.close()
+
+
+def summary(name, values):
+    values = sorted(values)
+    print("  {:<22} n {:6d}  p50 {:7.1f}  p95 {:7.1f}  max {:7.1f} ms".format(
+        name, len(values), values[len(values) // 2],
+        values[int(len(values) * 0.95)], values[-1]))
+
+
+def run_timer(seconds):
+    stop = threading.Event()
+    result = []
+    t = threading.Thread(target=lambda: result.extend(timer_lateness(stop)))
+    t.start()
+    time.sleep(seconds)
+    stop.set()
+    t.join()
+    return result
+
+
+if __name__ == "__main__":
+    phones = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+    connections = int(sys.argv[4]) if len(sys.argv) > 4 else 6
+    wd = tempfile.mkdtemp(prefix="boothy_bench_")
+    try:
+        archive = make_archive(wd, sessions)
+        ids = [entry["id"] for entry in archive.list(limit=sessions)]
+        server = GalleryServer(archive, host="127.0.0.1", port=0).start()
+        print("{} phones of {} connections, {} sessions, {:.0f}s".format(
+            phones, connections, sessions, seconds))
+        idle = run_timer(1.0)
+        latencies, errors = [], []
+        deadline = time.monotonic() + seconds
+        clients = [threading.Thread(target=phone, args=(
+            server.port, ids, deadline, latencies, errors, n, connections))
+            for _ in range(phones) for n in range(connections)]
+        for c in clients:
+            c.start()
+        loaded = run_timer(seconds)
+        for c in clients:
+            c.join()
+        summary("request latency", latencies)
+        summary("timer lateness, idle", idle)
+        summary("timer lateness, load", loaded)
+        print("  {:.0f} requests/s, errors: {}".format(
+            len(latencies) / seconds,
+            dict((e, errors.count(e)) for e in set(errors)) or "none"))
+        print("  {}".format(server.stats()))
+        server.stop(timeout=5)
+        archive.close(timeout=5)
+    finally:
+        shutil.rmtree(wd)
@@ -0,0 +1,140 @@
+# Load test: booths sharing one print hub, on one machine.
+#
+# usage: python3 bench_hub.py [booths] [prints] [photos] [tcp|unix]
+#
+# A PrintHub with a fake CUPS printer and a local uplink directory runs in
+# this process; every booth is a separate process with the booth's own
+# client side (HubSpooler, and an UploadWorker over HubTransport). Booth 0
+# sends `prints` strips in one burst, the others half as many, and every
+# photo is sent twice from two paths to exercise deduplication. Halfway
+# through the burst the hub drops every connection and stops listening for
+# a second, like a Wi-Fi outage: the booths keep their jobs and photos and
+# send them once it is back.
+#
+# Reported: the order the printer took the booths in, each booth's
+# submit-to-printed time, and what the hub archived.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+from capture import FakeCamera
+from printing import PrintSpooler, FakeCups
+from upload import UploadWorker, LocalTransport
+from hub import PrintHub, HubSpooler, HubTransport
+
+PRINT_TIME = 0.15
+TOKEN = "bench"
+
+
+def booth(address, n, prints, photos, wd, results):
+    wd = os.path.join(wd, "booth{}".format(n))
+    camera = FakeCamera()
+    files = []
+    for i in range(max(prints, photos)):
+        path = os.path.join(wd, "b{}-{}.jpg".format(n, i))
+        os.makedirs(wd, exist_ok=True)
+        img = camera.frame((600, 900))
+        # synthetic frames repeat, a corner tells the photos apart
+        img.paste((40 * n, 20 * i, 255), (0, 0, 64, 64))
+        img.save(path, "JPEG", quality=85)
+        files.append(path)
+    spooler = HubSpooler(address, "booth{}".format(n), poll_interval=0.05,
+                         retry_interval=0.2, token=TOKEN)
+    uploader = UploadWorker(HubTransport(address, "booth{}".format(n),
+                                         token=TOKEN),
+                            os.path.join(wd, "journal.jsonl"),
+                            min_backoff=0.2, max_backoff=0.5)
+    t0 = time.monotonic()
+    jobs = [spooler.submit(path) for path in files[:prints]]
+    for path in files[:photos]:
+        uploader.enqueue(path)
+        # the same photo again, from elsewhere
+        copy = os.path.join(wd, "again", os.path.basename(path))
+        os.makedirs(os.path.dirname(copy), exist_ok=True)
+        shutil.copy(path, copy)
+        uploader.enqueue(copy)
+    for job in jobs:
+        job.wait(120)
+    while uploader.depth():
+        time.sleep(0.05)
+    results.put((n, [(job.state, job.finished_at - t0 if job.finished_at
+                      else None) for job in jobs],
+                 uploader.transport.duplicates))
+    spooler.close(timeout=5)
+    uploader.close(timeout=5)
+
+
+def printed_order(cups, spool_dir):
+    # booth of every job, in the order the printer got them
+    order = []
+    for job_id in sorted(cups.jobs):
+        name = os.path.basename(cups.jobs[job_id]["file"])
+        order.append(name.split("-b")[-1].split("-")[0])
+    return order
+
+
+if __name__ == "__main__":
+    booths = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    prints = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    photos = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    family = sys.argv[4] if len(sys.argv) > 4 else "unix"
+    wd = tempfile.mkdtemp(prefix="boothy_hub_")
+    try:
+        cups = FakeCups(print_time=PRINT_TIME, start_delay=0.01)
+        spooler = PrintSpooler(cups_module=cups, poll_interval=0.02,
+                               retry_interval=0.2)
+        # a slow uplink, the photos pile up into batches meanwhile
+        gallery = LocalTransport(os.path.join(wd, "gallery"), delay=0.3)
+        uploader = UploadWorker(gallery, os.path.join(wd, "journal.jsonl"),
+                                batch_size=20)
+        address = (os.path.join(wd, "hub.sock") if family == "unix"
+                   else "127.0.0.1:0")
+        hub = PrintHub(address, os.path.join(wd, "hub"), spooler,
+                       uploader, token=TOKEN).start()
+        print("{} booths on {}, {} prints from booth 0 and {} from the "
+              "others, {} photos each".format(booths, hub.url(), prints,
+                                              prints // 2, photos))
+        # spawned, not forked: a fork would inherit the hub's listening
+        # socket and keep its port taken across the outage
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        procs = [context.Process(target=booth, args=(
+            hub.url(), n, prints if n == 0 else prints // 2, photos, wd,
+            results)) for n in range(booths)]
+        t0 = time.monotonic()
+        for p in procs:
+            p.start()
+        time.sleep(prints * PRINT_TIME / 2)
+        hub.disconnect()
+        print("  hub unreachable at {:.2f}s".format(time.monotonic() - t0))
+        time.sleep(1.0)
+        hub.listen()
+        print("  hub back at {:.2f}s".format(time.monotonic() - t0))
+        for _ in procs:
+            n, jobs, duplicates = results.get(timeout=300)
+            times = sorted(t for _, t in jobs if t is not None)
+            states = [s for s, _ in jobs]
+            print("  booth{}: {} printed, {} failed, first after {:.2f}s, "
+                  "last after {:.2f}s, {} duplicate photo(s)".format(
+                      n, states.count("done"), len(jobs) - states.count(
+                          "done"), times[0] if times else 0,
+                      times[-1] if times else 0, duplicates))
+        for p in procs:
+            p.join()
+        elapsed = time.monotonic() - t0
+        while uploader.depth():
+            time.sleep(0.05)
+        print("  printer order: {}".format(" ".join(
+            printed_order(cups, hub.spool_dir))))
+        print("  {} jobs in {:.1f}s, hub: {}".format(len(cups.jobs), elapsed,
+                                                     hub.stats()))
+        print("  uploaded {} photo(s) in {} batch(es)".format(
+            uploader.uploaded, uploader.batches))
+        hub.stop(timeout=5)
+        spooler.close(timeout=5)
+        uploader.close(timeout=5)
+    finally:
+        shutil.rmtree(wd)
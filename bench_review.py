@@ -0,0 +1,91 @@
+# Benchmark: ways to get the review screen out of four captures.
+#
+# usage: python3 bench_review.py [rounds] [width] [height]
+#
+#   file     decode the saved full-size preview JPEG, then resize (the
+#            original show_toprint() path)
+#   draft    same file, decoded with JPEG DCT scaling (Image.draft)
+#   memory   full-size preview montage in memory, then resize
+#   review   Compositor.review(): reduced captures, screen-sized montage
+#
+# Quality is measured against the "memory" result (LANCZOS from full
+# resolution): PSNR, higher is closer, and the mean absolute difference in
+# 0-255 levels. The reduced paths differ mostly along the cell borders.
+
+import os
+import sys
+import math
+import time
+import shutil
+import statistics
+import tempfile
+from PIL import Image, ImageChops, ImageStat
+from bench_compositor import make_captures
+from compositor import Compositor, load_images
+
+SCREEN = (800, 480)
+
+
+def fit(img, size=SCREEN):
+    w, h = img.size
+    ratio = min(size[0] / w, size[1] / h, 1)
+    return img.resize((int(w * ratio), int(h * ratio)), Image.LANCZOS)
+
+
+def from_file(path):
+    return fit(Image.open(path))
+
+
+def from_draft(path):
+    img = Image.open(path)
+    img.draft("RGB", SCREEN)
+    return fit(img)
+
+
+def difference(a, b):
+    # (psnr, mean absolute difference)
+    if a.size != b.size:
+        b = b.resize(a.size, Image.LANCZOS)
+    diff = ImageStat.Stat(ImageChops.difference(a, b))
+    mse = sum(v ** 2 for v in diff.rms) / len(diff.rms)
+    mad = sum(diff.mean) / len(diff.mean)
+    if mse == 0:
+        return (float("inf"), mad)
+    return (10 * math.log10(255 ** 2 / mse), mad)
+
+
+def bench(rounds, width, height):
+    wd = tempfile.mkdtemp(prefix="boothy_review_")
+    try:
+        compositor = Compositor()
+        imgs = load_images(make_captures(wd, width, height))
+        preview = os.path.join(wd, "preview.jpg")
+        compositor.show_preview(imgs, preview)
+        methods = [("file", lambda: from_file(preview)),
+                   ("draft", lambda: from_draft(preview)),
+                   ("memory", lambda: fit(compositor.show_preview(imgs))),
+                   ("review", lambda: compositor.review(imgs, SCREEN))]
+        reference = fit(compositor.show_preview(imgs))
+        print("captures {}x{}, {} rounds".format(width, height, rounds))
+        for name, fn in methods:
+            times = []
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                res = fn()
+                times.append(time.perf_counter() - t0)
+            print("  {:<8} median {:7.1f} ms  max {:7.1f} ms  {}x{}  "
+                  "psnr {:5.1f} dB  diff {:4.2f}".format(
+                      name, 1000 * statistics.median(times),
+                      1000 * max(times), res.size[0], res.size[1],
+                      *difference(reference, res)))
+    finally:
+        shutil.rmtree(wd)
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    if len(sys.argv) > 3:
+        bench(rounds, int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        for width, height in [(640, 480), (1640, 1232)]:
+            bench(rounds, width, height)
@@ -0,0 +1,84 @@
+# Benchmark: session writes straight to disk versus through the staging area.
+#
+# usage: python3 bench_staging.py [sessions] [target dir]
+#
+# Each session writes what the booth writes (four captures, the preview and
+# the print strip, as JPEGs) and then keeps them. "direct" saves them where
+# they belong, with an fsync each; "staged" saves them in /dev/shm and has
+# the Staging flusher write them in batches. The figure that matters is the
+# write time, what the capture and the compose stage wait for; the flush
+# happens behind them. Point `target dir` at the SD card to see its stalls.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from capture import FakeCamera
+from staging import Staging, default_root
+
+
+def session_images(camera):
+    captures = [camera.frame((1640, 1232)) for _ in range(4)]
+    return captures + [camera.frame((1640, 1232)), camera.frame((1200, 1800))]
+
+
+def save(img, path, sync):
+    with open(path, "wb") as f:
+        img.save(f, "JPEG", quality=92)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def direct(images, target, sessions):
+    writes = []
+    for n in range(sessions):
+        t0 = time.perf_counter()
+        for i, img in enumerate(images):
+            save(img, os.path.join(target, "d{}-{}.jpg".format(n, i)), True)
+        writes.append(time.perf_counter() - t0)
+    return writes, 0.0
+
+
+def staged(images, target, sessions):
+    staging = Staging(default_root(target) or
+                      tempfile.mkdtemp(prefix="boothy_staging_"))
+    writes = []
+    t_start = time.perf_counter()
+    for n in range(sessions):
+        work = staging.workdir("s{}".format(n))
+        t0 = time.perf_counter()
+        pairs = []
+        for i, img in enumerate(images):
+            src = os.path.join(work, "{}.jpg".format(i))
+            save(img, src, False)
+            pairs.append((src, os.path.join(target, "s{}-{}.jpg".format(
+                n, i))))
+        writes.append(time.perf_counter() - t0)
+        staging.keep_all(pairs)
+        staging.drop(work)
+    staging.close()
+    print("  staging: {}".format(staging.stats()))
+    return writes, time.perf_counter() - t_start
+
+
+def summary(name, writes, total):
+    writes = sorted(1000 * w for w in writes)
+    print("  {:<8} write p50 {:7.1f}  max {:7.1f} ms{}".format(
+        name, writes[len(writes) // 2], writes[-1],
+        "  (flushed after {:.2f}s)".format(total) if total else ""))
+
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    base = sys.argv[2] if len(sys.argv) > 2 else None
+    target = tempfile.mkdtemp(prefix="boothy_bench_", dir=base)
+    try:
+        images = session_images(FakeCamera())
+        print("{} sessions of {} files into {}".format(sessions, len(images),
+                                                      target))
+        summary("direct", *direct(images, target, sessions))
+        summary("staged", *staged(images, target, sessions))
+    finally:
+        shutil.rmtree(target)
@@ -0,0 +1,40 @@
+# Benchmark: upload worker queue depth and throughput against a local
+# directory, including an offline period.
+#
+# usage: python3 bench_upload.py [photos] [offline seconds]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from upload import UploadWorker, LocalTransport
+
+
+if __name__ == "__main__":
+    photos = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    offline = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    wd = tempfile.mkdtemp(prefix="boothy_bench_")
+    try:
+        transport = LocalTransport(os.path.join(wd, "gallery"), delay=0.05)
+        transport.is_online = False
+        worker = UploadWorker(transport, os.path.join(wd, "journal.jsonl"),
+                              min_backoff=0.1, max_backoff=0.5)
+        for i in range(photos):
+            path = os.path.join(wd, "{}.jpg".format(i))
+            with open(path, "wb") as f:
+                f.write(os.urandom(500000))
+            worker.enqueue(path)
+        time.sleep(offline)
+        print("after {:.1f}s offline: {}".format(offline, worker.stats()))
+        transport.is_online = True
+        t0 = time.monotonic()
+        worker.retry_now()
+        while worker.depth():
+            time.sleep(0.01)
+        print("drained in {:.2f}s: {}".format(time.monotonic() - t0,
+                                              worker.stats()))
+        print("remote syncs: {} for {} photos".format(transport.syncs, photos))
+        worker.close()
+    finally:
+        shutil.rmtree(wd)
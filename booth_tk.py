@@ -1,37 +1,38 @@
-import cups
-import tkinter as tk
-import itertools
-from PIL import ImageTk, Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import logging
 import time
-import subprocess
-import picamera
-import RPi.GPIO as GPIO
+import socket
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from compositor import Compositor
+from buttons import ButtonInput
+from screens import ScreenCache
+from assets import AssetCache
+from archive import Archive
+from layouts import Layout, load_template
+from animation import Animator
+from filters import get_filter
+from gallery import GalleryServer
+from prepress import get_profile
+from timeline import Timeline, capture_sequence
+from probe import ResourceProbe
+from staging import Staging, default_root
+from overlays import OverlayPool
+from capture import BurstCapture
+from printing import PrintSpooler
+from hub import HubSpooler, HubTransport
+from upload import UploadWorker
+from session import StateMachine
+from pipeline import BoothPipeline, Session
+from metrics import Metrics
+from logqueue import init_logging, stop_logging
+from hardware import pi_backends
 
 
 def init_logger(output_dir="./logs/"):
-    logger = logging.getLogger("booth")
-    logger.setLevel(logging.DEBUG)
-    # create console handler and set level to info
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    # create error file handler and set level to error
-    handler = logging.FileHandler(output_dir+"/"+time.strftime("%Y%m%d")+"_error.log","w", encoding=None, delay="true")
-    handler.setLevel(logging.ERROR)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    # create debug file handler and set level to debug
-    handler = logging.FileHandler(output_dir+"/"+time.strftime("%Y%m%d")+"_debug.log","w", encoding=None, delay="true")
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    return(logger)
+    # records go through a queue, a background thread writes the console
+    # and the rotating logs/booth_{debug,error}.log files
+    return init_logging("booth", output_dir)
 
 
 class Booth():
@@ -44,319 +45,617 @@ class Booth():
                  camera_heigh=480,
                  countdown=3,
                  green_button_pin=26,
-                 red_button_pin=16):
+                 red_button_pin=16,
+                 printer="Canon_SELPHY_CP1300",
+                 print_timeout=90,
+                 print_template="strip",
+                 show_template="preview",
+                 animation=None,
+                 photo_filter="none",
+                 print_profile="postcard",
+                 gallery_port=None,
+                 gallery_url="https://photo.caye.fr",
+                 probe_every=20,
+                 staging="auto",
+                 staging_bytes=256 * 1024 * 1024,
+                 print_hub=None,
+                 print_hub_token=None,
+                 booth_name=None,
+                 backends=None,
+                 metrics=None):
+        # display, camera, buttons, printer and uplink implementations
+        self.backends = pi_backends() if backends is None else backends
         self.countdown = countdown
+        self.print_timeout = print_timeout
         # init logger
         self.logger = logger
         self.wd = wd
+        # "host:port" or a Unix socket path: strips and photos go to a hub
+        # shared with other booths (hub.py) instead of CUPS and the uplink
+        self.print_hub = print_hub
+        self.print_hub_token = print_hub_token
+        self.booth_name = booth_name or socket.gethostname()
+        # shown on the end screen, the on-device gallery when it runs
+        self.gallery_url = gallery_url
+        # timing spans, one JSON line each in logs/metrics.jsonl
+        if metrics is None:
+            metrics = Metrics("{}/logs/metrics.jsonl".format(wd))
+        self.metrics = metrics
+        self.session = None
+        self.session_span = None
+        # the last session given to the pipeline
+        self.handed = None
+        # sessions started within the same second get a -2, -3... suffix
+        self.name_base = None
+        self.name_count = 0
+        self.outcome = None
 
-        # init tk
-        self.init_tk(wd, screen_width, screen_height)
+        # startup time of each component, reported once home is shown
+        self.started = time.perf_counter()
+        self.startup = collections.OrderedDict()
+        self.parallel = set()
+        self.home_shown = False
 
-        # init camera
-        self.init_camera(camera_width, camera_heigh)
+        # resource counters logged every `probe_every` home screens, to
+        # catch leaks over a long day
+        self.probe = ResourceProbe(self)
+        self.probe_every = probe_every
+        self.homes = 0
 
-        # init gpio
-        self.init_gpio(green_button_pin, red_button_pin)
+        # the camera, the buttons and the upload journal replay start in
+        # the background, Tk has to stay on this thread
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            camera = pool.submit(self.timed_init, "camera", self.init_camera,
+                                 camera_width, camera_heigh)
+            gpio = pool.submit(self.timed_init, "gpio", self.init_gpio,
+                               green_button_pin, red_button_pin)
+            storage = pool.submit(self.init_storage, wd)
+            # layout templates are compiled once, static layers included
+            layouts = pool.submit(self.timed_init, "layouts",
+                                  self.init_layouts, print_template,
+                                  show_template, camera_width, camera_heigh)
+            self.parallel.update(["camera", "gpio", "archive", "uploader",
+                                  "layouts"])
 
-        # montage command
-        imgs = [["{}.jpg".format(i), "{}.jpg".format(i)] for i in range(1, 5)]
-        imgs = list(itertools.chain.from_iterable(imgs))
-        self.res_cmd = (["montage"]
-                        + imgs
-                        + ["-tile", "2x4", "-geometry", "+8+4"])
-        imgs = ["{}.jpg".format(i) for i in range(1, 5)]
-        self.show_cmd = (["montage"]
-                         + imgs
-                         + ["-tile", "2x2"]
-                         + ["-geometry", "+2+2"])
+            # init tk
+            self.timed_init("tk", self.init_tk, wd, screen_width,
+                            screen_height)
+            self.timed_init("assets", self.load_assets, wd)
+            self.timed_init("canvas", self.init_canvas)
+
+            self.camera = camera.result()
+            gpio.result()
+            storage.result()
+            self.compositor = layouts.result()
+        self.timed_init("overlays", self.init_overlays)
+
+        # optional gallery of photos/ for the guests' phones, over the
+        # booth's own hotspot
+        self.gallery = None
+        if gallery_port is not None:
+            self.gallery = GalleryServer(self.archive, port=gallery_port,
+                                         logger=self.logger).start()
+
+        # sessions are written to RAM ("auto": /dev/shm when there is one),
+        # only the files kept reach the SD card, in batches; what a crash
+        # left there is flushed first
+        self.staging = None
+        if staging == "auto":
+            staging = default_root(wd)
+        if staging is not None:
+            self.staging = Staging(staging, staging_bytes, logger=self.logger)
+            self.staging.recover()
+
+        # blocking work never runs on the Tk thread
+        self.executor = ThreadPoolExecutor(max_workers=2)
+
+        # printing runs in its own thread with a persistent CUPS connection,
+        # cups itself is only imported by the first print
+        if print_hub is None:
+            self.spooler = PrintSpooler(
+                cups_module=self.backends.cups, printer=printer,
+                logger=self.logger, poll_interval=1.0 / self.backends.speed,
+                retry_interval=10.0 / self.backends.speed)
+        else:
+            # jobs wait here while the hub is unreachable
+            self.spooler = HubSpooler(
+                print_hub, self.booth_name, token=print_hub_token,
+                logger=self.logger,
+                poll_interval=1.0 / self.backends.speed,
+                retry_interval=10.0 / self.backends.speed)
+
+        # optional boomerang ("gif" or "mp4") made in a niced process pool
+        self.animator = None
+        if animation is not None:
+            self.animator = Animator(animation)
+
+        # post-capture styling: "bw", "sepia", "warm", "vintage"...
+        self.photo_filter = None
+        if photo_filter not in (None, "none"):
+            self.photo_filter = get_filter(photo_filter)
+
+        # print-ready file for the printer's paper and DPI, made while the
+        # guest looks at the review screen (None: CUPS fits the strip)
+        self.print_profile = get_profile(print_profile)
+
+        # composition, printing, archiving and upload run in background
+        # stages, the next guest does not wait for them
+        self.pipeline = BoothPipeline(self.compositor, self.spooler,
+                                      self.uploader, logger=self.logger,
+                                      metrics=self.metrics,
+                                      review_size=(self.w, self.h),
+                                      index=self.archive,
+                                      animator=self.animator,
+                                      photo_filter=self.photo_filter,
+                                      print_profile=self.print_profile,
+                                      staging=self.staging)
+
+        # booth flow
+        self.init_session()
 
     def init_tk(self, wd, screen_width, screen_height):
         # parameters
         self.w = screen_width
         self.h = screen_height
         # full screen
-        self.root = tk.Tk()
+        display = self.backends.display
+        self.root = display.create_root()
         self.root.overrideredirect(True)
         self.root.geometry("{0}x{1}+0+0".format(screen_width, screen_height))
         self.root.focus_set()  # <-- move focus to this widget
         self.root.bind("<Escape>", lambda e: e.widget.quit())
-        # add images
+        # add images, fonts and rendered screens are cached
+        self.screens = ScreenCache(photo_factory=display.photo)
+
+    def load_assets(self, wd):
+        # backgrounds with their text, read back from cache/ once rendered
+        self.assets = AssetCache("{}/cache".format(wd), self.screens.font,
+                                 self.screens.font_path)
         self.imgs = {}
-        self.imgs["home"] = Image.open("{}/booth0.png".format(wd))
-        d = ImageDraw.Draw(self.imgs["home"])
-        fnt = ImageFont.truetype('Pillow/Tests/fonts/FreeMonoBold.ttf', 37)
-        d.text((80, 340), "Appuyez sur le bouton VERT\n pour commencer !",
-               font=fnt,
-               fill=(0, 128, 0))
-        self.imgs["smile"] = Image.open("{}/booth1.png".format(wd))
-        self.imgs["end"] = Image.open("{}/end.png".format(wd))
-        d = ImageDraw.Draw(self.imgs["end"])
-        d.text((40, 15), "Les photos sont disponibles sur \n    https://photo.caye.fr ;)",
-               font=fnt,
-               fill=(220,20,60,255))
-        d.text((120, 390), "Bouton VERT pour continuer.",
-               font=fnt,
-               fill=(0, 128, 0))
-        self.imgs["print"] = Image.open("{}/print.png".format(wd))
-        d = ImageDraw.Draw(self.imgs["print"])
-        d.text((50, 380), "Les photos sont en cours \n   d'impression.....",
-               font=fnt,
-               fill=(220,20,60,255))
+        self.imgs["home"] = self.assets.screen(
+            "{}/booth0.png".format(wd),
+            [((80, 340), "Appuyez sur le bouton VERT\n pour commencer !",
+              37, (0, 128, 0))])
+        self.imgs["smile"] = self.assets.screen("{}/booth1.png".format(wd))
+        self.imgs["end"] = self.assets.screen(
+            "{}/end.png".format(wd),
+            [((40, 15), "Les photos sont disponibles sur \n    {} ;)".format(
+                self.gallery_url),
+              37, (220,20,60,255)),
+             ((120, 390), "Bouton VERT pour continuer.", 37, (0, 128, 0))])
+        self.imgs["print"] = self.assets.screen(
+            "{}/print.png".format(wd),
+            [((50, 380), "Les photos sont en cours \n   d'impression.....",
+              37, (220,20,60,255))])
+        for name in ["home", "end", "print"]:
+            self.screens.add(name, self.imgs[name])
+        self.screens.register("smile", self.render_smile)
+
+    def prerender_screens(self):
+        # smile screens, once the home screen is up
+        self.screens.prerender("smile", None, 100, 380, 80)
+        for i in range(1, 5):
+            self.screens.prerender("smile", 'photo {} / 4 !'.format(i),
+                                   100, 380, 80)
+        for dots in self.wait_dots:
+            self.screens.prerender("smile", "Un petit instant :D" + dots,
+                                   40, 380, 50)
 
+    def init_canvas(self):
         # create canvas
-        self.canvas = tk.Canvas(self.root,
-                                width=self.w,
-                                height=self.h)
+        self.canvas = self.backends.display.create_canvas(self.root, self.w,
+                                                          self.h)
         self.canvas.pack()
         self.canvas.configure(background='black')
         # image on canvas
-        self.current_img = ImageTk.PhotoImage(self.imgs["home"])
+        self.current_img = self.screens.get("home")
         self.imagesprite = self.canvas.create_image(self.w/2,
                                                     self.h/2,
                                                     image=self.current_img)
 
+    def render_smile(self, write, x, y, size):
+        smile_img = self.imgs["smile"].copy()
+        if not write is None:
+            d = ImageDraw.Draw(smile_img)
+            # draw text, half opacity
+            d.text((x, y), write,
+                   font=self.screens.font(size), fill=(220,20,60,200))
+        return smile_img
+
+    # frames of the "please wait" animation
+    wait_dots = ["", ".", "..", "..."]
+
     def init_camera(self, camera_width, camera_heigh):
         self.c_w, self.c_h = (camera_width, camera_heigh)
         self.logger.info("Initializing camera.")
-        self.camera = picamera.PiCamera()
+        camera = self.backends.camera(resolution=(self.c_w, self.c_h),
+                                      framerate=24)
         # camera settings
-        self.camera.resolution = (self.c_w, self.c_h)
-        self.camera.framerate = 24
-        self.camera.sharpness = 0
-        self.camera.contrast = 0
-        self.camera.brightness = 50
-        self.camera.saturation = 0
-        self.camera.ISO = 0
-        self.camera.video_stabilization = False
-        self.camera.exposure_compensation = 0
-        self.camera.exposure_mode = 'auto'
-        self.camera.meter_mode = 'average'
-        self.camera.awb_mode = 'auto'
-        self.camera.image_effect = 'none'
-        self.camera.color_effects = None
-        self.camera.rotation = 0
-        self.camera.hflip = False
-        self.camera.vflip = False
-        self.camera.crop = (0.0, 0.0, 1.0, 1.0)
-
-        self.overlay_renderer = None
+        camera.sharpness = 0
+        camera.contrast = 0
+        camera.brightness = 50
+        camera.saturation = 0
+        camera.ISO = 0
+        camera.video_stabilization = False
+        camera.exposure_compensation = 0
+        camera.exposure_mode = 'auto'
+        camera.meter_mode = 'average'
+        camera.awb_mode = 'auto'
+        camera.image_effect = 'none'
+        camera.color_effects = None
+        camera.rotation = 0
+        camera.hflip = False
+        camera.vflip = False
+        camera.crop = (0.0, 0.0, 1.0, 1.0)
+        return camera
+
+    def init_overlays(self):
+        # overlays are rendered once and swapped in place
+        self.overlays = OverlayPool(self.camera, (self.c_w, self.c_h),
+                                    font=self.screens.font)
+        # shots are taken from the video port into memory
+        self.burst = BurstCapture(self.camera, (self.c_w, self.c_h))
+        for i in range(1, self.countdown + 1):
+            self.overlays.add(250, 100, 240, str(i))
+        self.overlays.add(30, 10, 38, "Appuyez sur le bouton vert \n pour prendre 4 photos !", (34,139,34, 255))
+
+    def init_layouts(self, print_template, show_template, camera_width,
+                     camera_heigh):
+        size = (camera_width, camera_heigh)
+        return Compositor(Layout(load_template(print_template), size),
+                          Layout(load_template(show_template), size))
+
+    def init_storage(self, wd):
+        # photos/ index, brought up to date with the files already there
+        self.archive = self.timed_init("archive", Archive,
+                                       "{}/photos".format(wd),
+                                       logger=self.logger)
+        added = self.archive.scan()
+        if added:
+            self.logger.info("{} photo(s) added to the archive index".format(
+                added))
+        # photos are journaled and uploaded in batches in the background,
+        # to the hub when there is one
+        transport = self.backends.transport
+        if self.print_hub is not None:
+            transport = HubTransport(self.print_hub, self.booth_name,
+                                     token=self.print_hub_token)
+        self.uploader = self.timed_init(
+            "uploader", UploadWorker, transport,
+            "{}/logs/upload_journal.jsonl".format(wd), logger=self.logger,
+            metrics=self.metrics, on_uploaded=self.archive.uploaded)
+
+    def timed_init(self, name, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.startup[name] = 1000 * (time.perf_counter() - t0)
+        return result
+
+    def startup_report(self):
+        total = 1000 * (time.perf_counter() - self.started)
+        self.metrics.record("startup", total, **self.startup)
+        return "startup: {:.0f} ms to home screen; {} (* in parallel)".format(
+            total, ", ".join("{} {:.0f} ms{}".format(
+                name, ms, "*" if name in self.parallel else "")
+                for name, ms in self.startup.items()))
 
     def init_gpio(self, green_button_pin, red_button_pin):
         self.green_button_pin, self.red_button_pin = (green_button_pin,
                                                       red_button_pin)
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(green_button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(red_button_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # edge detection feeds a queue, no busy waiting on GPIO.input()
+        self.buttons = ButtonInput(self.backends.gpio,
+                                   {"green": green_button_pin,
+                                    "red": red_button_pin},
+                                   logger=self.logger)
 
-    def show_home(self):
-        self.current_img = ImageTk.PhotoImage(self.imgs["home"])
+    def init_session(self):
+        # home -> ready -> play ((countdown -> capture) x4 on a timeline)
+        # -> merge -> review -> print -> end, every step scheduled on the Tk
+        # event loop; a guest can start a new session while the previous
+        # one prints
+        self.timeline = None
+        self.sequence_over = False
+        self.machine = StateMachine(self.root, self.buttons, self.logger)
+        self.machine.add("home", self.show_home, {"green": "ready"})
+        self.machine.add("ready", self.start_preview, {"green": "play"})
+        self.machine.add("play", self.play)
+        self.machine.add("merge", self.merge)
+        self.machine.add("review", self.show_toprint,
+                         {"green": "print", "red": self.skip_print})
+        self.machine.add("print", self.print_pic, {"green": "home"})
+        self.machine.add("end", self.show_end, {"green": "home"})
+
+    def show_screen(self, photo):
+        t0 = time.perf_counter()
+        self.current_img = photo
         self.canvas.itemconfig(self.imagesprite,
                                image=self.current_img)
-        self.root.update()
+        self.root.update_idletasks()
+        self.screens.record_switch(time.perf_counter() - t0)
+
+    def show_home(self):
+        self.logger.info("new cycle")
+        # a guest leaving the print screen early still printed
+        self.end_session(self.outcome or "abandoned")
+        self.logger.debug(self.screens.report())
+        self.logger.debug("overlays: {}".format(self.overlays.stats()))
+        self.logger.debug("pipeline: {}".format(self.pipeline.stats()))
+        self.logger.debug("upload: {}".format(self.uploader.stats()))
+        self.logger.debug(self.metrics.report())
+        self.show_screen(self.screens.get("home"))
         self.logger.info("show home")
+        if not self.home_shown:
+            self.home_shown = True
+            self.logger.info(self.startup_report())
+            self.logger.info("assets: {} cached, {} rendered".format(
+                self.assets.hits, self.assets.misses))
+        self.homes += 1
+        if self.probe_every and self.homes % self.probe_every == 0:
+            # once home is on screen, unless the next guest is quicker
+            self.machine.after(0.1, self.log_resources)
+
+    def log_resources(self):
+        sample = self.probe.sample(cycle=self.homes)
+        self.logger.info(self.probe.format(sample))
+
+    def animate(self, frames, interval=0.4, i=0):
+        # cycles through screens until the state changes
+        self.show_screen(frames[i % len(frames)])
+        self.machine.after(interval, self.animate, frames, interval, i + 1)
 
-    def show_toprint(self):
-        # load image
-        showprint_img = Image.open(self.showprint_path)
-        # resize
+    def load_toprint(self, showprint_img):
+        # runs in the executor: annotate the review montage
+        # resize, if it was not built at screen size
         img_w, img_h = showprint_img.size
         if img_w > self.w or img_h > self.h:
             ratio = min(self.w/img_w, self.h/img_h)
             img_w = int(img_w*ratio)
             img_h = int(img_h*ratio)
             showprint_img = showprint_img.resize((img_w, img_h),
-                                                 Image.ANTIALIAS)
+                                                 Image.LANCZOS)
         # get a drawing context
         d = ImageDraw.Draw(showprint_img)
         # draw text, half opacity
-        fnt = ImageFont.truetype('Pillow/Tests/fonts/FreeMonoBold.ttf', 37)
+        fnt = self.screens.font(37)
         d.text((50, 150), "BOUTTON VERT : imprimer",
                font=fnt,
                fill=(0, 128, 0))
         d.text((50, 300), "BOUTTON ROUGE : acceuil",
                font=fnt,
                fill=(255, 51, 51))
+        return showprint_img
+
+    def show_toprint(self, showprint_img):
         # show to screen
-        self.current_img = ImageTk.PhotoImage(showprint_img)
-        self.canvas.itemconfig(self.imagesprite,
-                               image=self.current_img)
-        self.root.update()
+        self.show_screen(self.backends.display.photo(showprint_img))
         self.logger.info("show toprint")
 
     def show_smile(self, write=None, x=100, y=380, size=80):
-        smile_img = self.imgs["smile"].copy()
-        if not write is None:
-            d = ImageDraw.Draw(smile_img)
-            # draw text, half opacity
-            fnt = ImageFont.truetype('Pillow/Tests/fonts/FreeMonoBold.ttf', size)
-            d.text((x, y), write,
-                   font=fnt, fill=(220,20,60,200))
-        self.current_img = ImageTk.PhotoImage(smile_img)
-        self.canvas.itemconfig(self.imagesprite,
-                               image=self.current_img)
-        self.root.update()
+        self.show_screen(self.screens.get("smile", write, x, y, size))
         self.logger.info("show smile")
 
+    def end_session(self, outcome):
+        # the guest's part of the session: from the first green press to
+        # the end screen
+        if self.session_span is not None:
+            self.session_span.end(outcome=outcome)
+            self.metrics.count("session." + outcome, self.session.name)
+            self.session_span = None
+
     def print_pic(self):
         self.logger.info("PRINT")
-        self.current_img = ImageTk.PhotoImage(self.imgs["print"])
-        self.canvas.itemconfig(self.imagesprite,
-                               image=self.current_img)
-        self.root.update()
+        self.outcome = "printed"
+        self.show_screen(self.screens.get("print"))
         self.logger.info("show print in progress")
-        # to be sure that the montage is over :D
-        self.to_print_p.wait()
-        # send print
-        conn = cups.Connection()
-        printers = conn.getPrinters()
-        default_printer = "Canon_SELPHY_CP1300"
-        if (default_printer in printers.keys()):
-            cups.setUser('pi')
-            conn.printFile(default_printer, self.toprint_path,
-                           "boothy", {'fit-to-page':'True'})
-        else:
-            self.logger.info("Printer not found ! ")
-        time.sleep(5)
-
-    def user_input(self):
-        green_event = False
-        red_event = False
-        output = None
-        while output is None:
-            green_state = GPIO.input(self.green_button_pin)
-            red_state = GPIO.input(self.red_button_pin)
-            if (not green_state) and (not green_event):
-                self.logger.info("green down")
-                green_event = True
-            elif (not red_state) and (not red_event):
-                self.logger.info("red down")
-                red_event = True
-            elif green_state and green_event:
-                self.logger.info("green up")
-                output = "green"
-            elif red_state and red_event:
-                self.logger.info("red up")
-                output = "red"
-        return output
+        # the end screen comes when the printer is actually done, unless
+        # the next guest presses green first
+        self.session.on_print = self.machine.callback(self.printed)
+        # composing or submitting failed: nothing to wait for
+        self.session.on_error = self.machine.callback(self.print_failed)
+        # the print file is ready by now, green to printer start is
+        # reported as print.printing
+        self.executor.submit(self.pipeline.decide, self.session, True,
+                             time.monotonic())
+        self.machine.after(self.print_timeout, self.print_timeout_reached)
+
+    def printed(self, session, job):
+        if job.state == "error":
+            self.logger.info("Printer error: {}".format(job.error))
+        elif job.done.is_set():
+            if not job.succeeded():
+                self.logger.info("Print failed: {}".format(job.error))
+            self.machine.goto("end")
+
+    def print_failed(self, session, stage):
+        self.logger.error("session {} failed in {}: {}".format(
+            session.name, stage, session.error))
+        self.outcome = "failed"
+        self.machine.goto("home")
+
+    def print_timeout_reached(self):
+        job = self.session.print_job
+        self.logger.info("print still in progress ({}), moving on".format(
+            "queued" if job is None else job.error or job.state))
+        self.outcome = "print_timeout"
+        self.machine.goto("end")
+
+    def skip_print(self):
+        self.logger.info("do not print the picture")
+        self.outcome = "skipped"
+        self.executor.submit(self.pipeline.decide, self.session, False,
+                             time.monotonic())
+        self.machine.goto("end")
 
     def add_preview_overlay(self, xcoord, ycoord,
                             fontSize, overlayText, color=(32, 178, 170, 210)):
-        img = Image.new("RGBA", (self.c_w, self.c_h), (255, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        draw.font = ImageFont.truetype(
-            'Pillow/Tests/fonts/FreeMonoBold.ttf',
-            fontSize)
-        draw.text((xcoord, ycoord), overlayText, color)
-        if self.overlay_renderer is None:
-            self.overlay_renderer = self.camera.add_overlay(img.tobytes(),
-                                                            layer=3,
-                                                            size=img.size,
-                                                            alpha=128)
-        else:
-            if self.remove_overlay:
-                self.camera.remove_overlay(self.overlay_renderer)
-            self.overlay_renderer = self.camera.add_overlay(img.tobytes(),
-                                                            layer=3,
-                                                            size=img.size,
-                                                            alpha=128)
-            # self.overlay_renderer.update(img.tobytes()) # generate error
-        self.remove_overlay = True
-
-    def countdown_from(self, countdown):
-        s = countdown
-        while s > 0:
-            self.add_preview_overlay(250, 100, 240, str(s))
-            time.sleep(1)
-            s = s - 1
+        self.overlays.show(xcoord, ycoord, fontSize, overlayText, color)
+
+    def countdown_tick(self, shot, s):
+        self.add_preview_overlay(250, 100, 240, str(s))
 
     def stop_camera_preview(self):
         self.camera.stop_preview()
-        if self.remove_overlay:
-            self.camera.remove_overlay(self.overlay_renderer)
-            self.remove_overlay = False
+        self.overlays.hide()
 
     def capture_image(self, image_name):
         self.logger.info("Capture image {}".format(image_name))
-        self.stop_camera_preview()
-        self.camera.capture(image_name, resize=(self.c_w, self.c_h))
-        self.camera.start_preview()
+        # the preview keeps running, only the countdown is cleared; the
+        # file is written in the background
+        self.overlays.hide()
+        with self.metrics.span("capture", self.session and self.session.name):
+            return self.burst.capture(image_name)
 
-    def sync_withcloud(self):
-        self.logger.info("Sync with piwigo cloud")
-        p = subprocess.Popen(["sh",
-                              '{}/sync_piwigo.sh'.format(self.wd),
-                              self.photo_path],
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    def start_preview(self):
+        self.logger.info("Start camera preview")
+        self.camera.start_preview()
+        self.add_preview_overlay(30, 10, 38, "Appuyez sur le bouton vert \n pour prendre 4 photos !", (34,139,34, 255))
 
     def play(self):
-        res_name = time.strftime("%Y%m%d-%H%M%S")+".jpg"
-        self.photo_path = "{}/photos/{}".format(self.wd, res_name)
-        self.toprint_path = "{}/toprint/{}".format(self.wd, res_name)
+        # each session gets its own working area
+        name = self.session_name()
+        # in RAM unless the staging area is full
+        work = self.staging.workdir(name) if self.staging else None
+        self.session = Session(name, self.wd, work)
+        self.session_span = self.metrics.span("session", self.session.name)
+        self.outcome = None
         self.show_smile()
-        # capture 4 images
-        for i in range(1, 5):
-            self.countdown_from(self.countdown)
-            img = "{}.jpg".format(i)
-            self.show_smile('photo {} / 4 !'.format(i))
-            self.capture_image(img)
-            time.sleep(1)
+        # capture 4 images: every tick, shutter and pause planned as a
+        # deadline from now, in the play state
+        speed = getattr(self.root, "speed", 1.0)
+        self.timeline = Timeline(self.machine.after,
+                                 clock=lambda: time.monotonic() * speed,
+                                 metrics=self.metrics,
+                                 session=self.session.name,
+                                 logger=self.logger)
+        end = capture_sequence(
+            self.timeline, 4, self.countdown, 1, self.countdown_tick,
+            self.capture_shot, prepare_tick=self.prepare_tick,
+            prepare_shutter=self.prepare_shot)
+        self.timeline.at(end, "merge", self.sequence_done)
+        self.sequence_over = False
+        self.timeline.start()
 
-        self.camera.stop_preview()
-        self.show_smile("Un petit instant :D...", 40, 380, 50)
-        # now merge all the images
-        res_cmd = self.res_cmd + [self.toprint_path]
-        self.to_print_p = subprocess.Popen(res_cmd,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT)
-        self.showprint_path = self.photo_path
-        subprocess.call(self.show_cmd + [self.showprint_path])
-        # sync with cloud
-        self.sync_withcloud()
+    def session_name(self):
+        # unique: photos/<name>.jpg, sessions/<name>/ and the staging
+        # workdir must not be shared
+        base = time.strftime("%Y%m%d-%H%M%S")
+        if base != self.name_base:
+            self.name_base = base
+            self.name_count = 0
+        self.name_count += 1
+        if self.name_count == 1:
+            return base
+        return "{}-{}".format(base, self.name_count)
+
+    def prepare_tick(self, shot, s):
+        # renders the digit if it is not in the pool yet
+        self.overlays.add(250, 100, 240, str(s))
+
+    def prepare_shot(self, shot):
+        self.screens.get("smile", 'photo {} / 4 !'.format(shot), 100, 380,
+                         80)
+
+    def capture_shot(self, shot):
+        # the shutter first, the screen while it runs
+        self.machine.run_in(self.executor, self.capture_image,
+                            self.session.capture_path(shot),
+                            then=lambda img: self.captured(shot, img))
+        self.show_smile('photo {} / 4 !'.format(shot))
+
+    def captured(self, shot, img):
+        self.session.captures.append(img)
+        self.session.captured_at.append(time.time())
+        if self.sequence_over and len(self.session.captures) == 4:
+            self.machine.goto("merge")
+
+    def sequence_done(self):
+        # the last pause is over; merge now, or when the last capture is in
+        self.sequence_over = True
+        self.logger.debug(self.timeline.report())
+        if len(self.session.captures) == 4:
+            self.machine.goto("merge")
+
+    def merge(self):
+        self.merge_span = self.metrics.span("merge_wait", self.session.name)
+        self.stop_camera_preview()
+        self.animate([self.screens.get("smile", "Un petit instant :D" + dots,
+                                       40, 380, 50)
+                      for dots in self.wait_dots])
+        # the review screen comes as soon as the screen-sized montage is
+        # ready, the full preview and the print strip are still being built
+        self.session.on_preview = self.machine.callback(self.merged)
+        # no review screen coming: back home instead of waiting forever
+        self.session.on_error = self.machine.callback(self.merge_failed)
+        self.machine.run_in(self.executor, self.hand_over, self.session)
+
+    def hand_over(self, session):
+        # the captures are written before the pipeline may keep them
+        self.burst.flush()
+        self.pipeline.put("compose", session)
+        self.handed = session
+
+    def merge_failed(self, session, stage):
+        self.logger.error("session {} failed in {}: {}".format(
+            session.name, stage, session.error))
+        self.merge_span.end(error=session.error)
+        self.outcome = "failed"
+        self.machine.goto("home")
+
+    def merged(self, session):
         self.logger.info("Images have been merged.")
+        self.merge_span.end()
+        self.machine.run_in(self.executor, self.load_toprint, session.review,
+                            then=lambda img: self.machine.goto("review", img))
 
     def show_end(self):
-        self.current_img = ImageTk.PhotoImage(self.imgs["end"])
-        self.canvas.itemconfig(self.imagesprite,
-                               image=self.current_img)
-        self.root.update()
+        self.end_session(self.outcome or "ended")
+        self.show_screen(self.screens.get("end"))
         self.logger.info("show end")
 
     def run(self):
-        gogogo = True
-        while gogogo:
-            self.logger.info("new cycle")
-            self.show_home()
-            # wait for user to press green button
-            button = self.user_input()
-            while button != "green":
-                button = self.user_input()
-            self.logger.info("Start camera preview")
-            self.camera.start_preview()
-            self.add_preview_overlay(30, 10, 38, "Appuyez sur le bouton vert \n pour prendre 4 photos !", (34,139,34, 255))
-            # wait for user to press green button
-            button = self.user_input()
-            while button != "green":
-                button = self.user_input()
-            self.play()
-            self.stop_camera_preview()
-            self.show_toprint()
-            # green or red ?
-            button = self.user_input()
-            if button == "green":
-                self.print_pic()
-            else:
-                self.logger.info("do not print the picture")
-            self.show_end()
-            # wait for user to press green button
-            button = self.user_input()
-            while button != "green":
-                button = self.user_input()
+        # everything happens in Tk callbacks, <Escape> leaves the main loop
+        self.machine.start("home")
+        self.root.after(0, self.prerender_screens)
+        self.root.mainloop()
+
+    def let_go_session(self):
+        # the guest's session at teardown: not printed when the review
+        # screen was still up, dropped when it never reached the pipeline
+        session = self.session
+        if session is None:
+            return
+        if session is not self.handed:
+            if session.staged:
+                self.staging.drop(session.work)
+        elif session.print_requested is None:
+            self.pipeline.decide(session, False)
 
     def teardown(self):
         self.logger.info("close everything")
         self.root.destroy()
+        self.overlays.close()
+        self.burst.close()
         self.camera.close()
+        self.executor.shutdown()
+        self.buttons.close()
+        self.backends.gpio.cleanup()
+        self.let_go_session()
+        # the sessions in flight are archived, their strips printed, before
+        # their RAM workdirs go
+        self.pipeline.close(timeout=5)
+        if self.animator is not None:
+            self.animator.close()
+        if not self.spooler.drain(timeout=30):
+            self.logger.info("{} print job(s) left unfinished".format(
+                self.spooler.pending()))
+        self.spooler.close(timeout=5)
+        if self.staging is not None:
+            self.staging.close(timeout=5)
+        self.uploader.close(timeout=5)
+        if self.gallery is not None:
+            self.gallery.stop(timeout=5)
+        self.archive.close(timeout=5)
+        self.metrics.close(timeout=5)
 
 
 if __name__ == "__main__":
@@ -369,3 +668,4 @@ if __name__ == "__main__":
     finally:
         logging.info("quitting...")
         booth.teardown()
+        stop_logging("booth")
@@ -0,0 +1,238 @@
+# Event-driven button input.
+#
+# Buttons are wired active low (pull-up, pressed = 0). Instead of polling
+# GPIO.input() in a tight loop, edge detection callbacks push press/release
+# events onto a queue and the booth blocks on that queue, so it sleeps while
+# nobody touches the buttons.
+#
+# Debounce is done in software: every edge pushes back a per-pin settle
+# deadline, and once a pin had `debounce` seconds without edges its level is
+# read again. An event is emitted only if the settled level differs from the
+# last known state, so bounces never produce extra events. The GPIO callback
+# itself only records the edge, it never sleeps, so a bouncy button cannot
+# delay the edges of the other one.
+
+import time
+import queue
+import threading
+import collections
+
+ButtonEvent = collections.namedtuple("ButtonEvent", ["name", "pressed", "time"])
+
+
+class ButtonInput():
+    def __init__(self, gpio, pins, debounce=0.02, logger=None):
+        # pins: {"green": 26, "red": 16}
+        self.gpio = gpio
+        self.pins = dict(pins)
+        self.debounce = debounce
+        self.logger = logger
+        self.events = queue.Queue()
+        self._names = {pin: name for name, pin in self.pins.items()}
+        self._lock = threading.Lock()
+        self._settle = threading.Condition(self._lock)
+        self._deadlines = {}
+        self._pressed = {}
+        self._down = set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._debounce_loop,
+                                        daemon=True)
+        self._thread.start()
+        gpio.setmode(gpio.BCM)
+        for pin in self.pins.values():
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+            self._pressed[pin] = not gpio.input(pin)
+            gpio.add_event_detect(pin, gpio.BOTH, callback=self._on_edge)
+
+    def _on_edge(self, pin):
+        # called from the GPIO callback thread
+        with self._settle:
+            self._deadlines[pin] = time.monotonic() + self.debounce
+            self._settle.notify()
+
+    def _debounce_loop(self):
+        while True:
+            with self._settle:
+                while not self._closed:
+                    now = time.monotonic()
+                    settled = [pin for pin, t in self._deadlines.items()
+                               if t <= now]
+                    if settled:
+                        break
+                    timeout = None
+                    if self._deadlines:
+                        timeout = min(self._deadlines.values()) - now
+                    self._settle.wait(timeout)
+                if self._closed:
+                    return
+                changed = []
+                for pin in settled:
+                    del self._deadlines[pin]
+                    pressed = not self.gpio.input(pin)
+                    if pressed != self._pressed[pin]:
+                        self._pressed[pin] = pressed
+                        changed.append((pin, pressed))
+            for pin, pressed in changed:
+                self._emit(pin, pressed)
+
+    def _emit(self, pin, pressed):
+        name = self._names[pin]
+        if self.logger is not None:
+            self.logger.info("{} {}".format(name, "down" if pressed else "up"))
+        self.events.put(ButtonEvent(name, pressed, time.monotonic()))
+
+    def is_pressed(self, name):
+        with self._lock:
+            return self._pressed[self.pins[name]]
+
+    def flush(self):
+        # drop pending events (e.g. presses made while the booth was busy)
+        # and return the buttons currently held down
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        with self._lock:
+            return set(self._names[pin]
+                       for pin, pressed in self._pressed.items() if pressed)
+
+    def wait(self, timeout=None):
+        # next press or release event, None on timeout
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def arm(self):
+        # start listening for a new press/release: pending events are
+        # dropped, a button already held counts as pressed
+        self._down = self.flush()
+
+    def poll(self, names=None, timeout=0):
+        # name of the next armed button released within timeout (None
+        # blocks, 0 only looks at queued events), None otherwise
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            try:
+                if remaining == 0:
+                    event = self.events.get_nowait()
+                else:
+                    event = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if names is not None and event.name not in names:
+                continue
+            if event.pressed:
+                self._down.add(event.name)
+            elif event.name in self._down:
+                self._down.discard(event.name)
+                return event.name
+
+    def wait_for_release(self, names=None, timeout=None):
+        # block until one of `names` is pressed then released, return its
+        # name (None on timeout)
+        self.arm()
+        return self.poll(names, timeout)
+
+    def close(self):
+        for pin in self.pins.values():
+            self.gpio.remove_event_detect(pin)
+        with self._settle:
+            self._closed = True
+            self._settle.notify()
+        self._thread.join()
+
+
+class FakeGPIO():
+    # Stand-in for the RPi.GPIO module, used off the Pi. Levels are set by
+    # press()/release() and edge callbacks run on a single dispatcher thread
+    # like the real library.
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.callbacks = {}
+        self._edges = queue.Queue()
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        if pull_up_down == self.PUD_UP:
+            self.levels[pin] = self.HIGH
+        else:
+            self.levels[pin] = self.LOW if initial is None else initial
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def output(self, pin, level):
+        self.set_level(pin, level)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pins=None):
+        for pin in list(self.levels) if pins is None else pins:
+            self.callbacks.pop(pin, None)
+
+    def set_level(self, pin, level):
+        old = self.levels.get(pin)
+        self.levels[pin] = level
+        if old == level or pin not in self.callbacks:
+            return
+        edge, callback = self.callbacks[pin]
+        rising = level == self.HIGH
+        if (edge == self.BOTH
+                or (edge == self.RISING and rising)
+                or (edge == self.FALLING and not rising)):
+            self._edges.put((pin, callback))
+
+    def press(self, pin, bounces=0, bounce_interval=0.001):
+        # contact bounce: a few extra edges before settling low
+        for _ in range(bounces):
+            self.set_level(pin, self.LOW)
+            time.sleep(bounce_interval)
+            self.set_level(pin, self.HIGH)
+            time.sleep(bounce_interval)
+        self.set_level(pin, self.LOW)
+
+    def release(self, pin, bounces=0, bounce_interval=0.001):
+        for _ in range(bounces):
+            self.set_level(pin, self.HIGH)
+            time.sleep(bounce_interval)
+            self.set_level(pin, self.LOW)
+            time.sleep(bounce_interval)
+        self.set_level(pin, self.HIGH)
+
+    def click(self, pin, duration=0.1, bounces=0):
+        self.press(pin, bounces)
+        time.sleep(duration)
+        self.release(pin, bounces)
+
+    def _dispatch(self):
+        while True:
+            pin, callback = self._edges.get()
+            if callback is not None:
+                callback(pin)
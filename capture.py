@@ -0,0 +1,142 @@
+# In-memory burst capture.
+#
+# Frames are grabbed from the video port as raw RGB into memory, so a shot
+# needs no preview teardown, no still-port mode switch and no JPEG encode
+# before the next countdown can start. The returned PIL images go straight
+# to the compositor; writing them to disk is done by a background writer.
+
+import io
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
+# raw captures are padded like overlays are
+from overlays import pad
+
+
+class BurstCapture():
+    def __init__(self, camera, size, use_video_port=True, quality=92,
+                 writer=None):
+        self.camera = camera
+        self.size = size
+        self.use_video_port = use_video_port
+        self.quality = quality
+        if writer is None:
+            writer = ThreadPoolExecutor(max_workers=1)
+        self.writer = writer
+        self.pending = []
+        self.capture_times = collections.deque(maxlen=100)
+
+    def capture(self, path=None):
+        t0 = time.perf_counter()
+        stream = io.BytesIO()
+        self.camera.capture(stream, format="rgb",
+                            use_video_port=self.use_video_port,
+                            resize=self.size)
+        img = Image.frombytes("RGB", pad(self.size), stream.getvalue())
+        if img.size != self.size:
+            img = img.crop((0, 0) + self.size)
+        if path is not None:
+            self.persist(img, path)
+        self.capture_times.append(time.perf_counter() - t0)
+        return img
+
+    def persist(self, img, path):
+        # asynchronous side step, the caller does not wait for the SD card
+        self.pending = [f for f in self.pending if not f.done()]
+        self.pending.append(self.writer.submit(img.save, path, "JPEG",
+                                               quality=self.quality))
+
+    def flush(self):
+        for f in self.pending:
+            f.result()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.shutdown()
+
+
+class FakeRenderer():
+    def __init__(self, source=None, layer=0, alpha=255, **options):
+        self.source = source
+        self.layer = layer
+        self.alpha = alpha
+
+    def update(self, source):
+        self.source = source
+
+
+class FakeCamera():
+    # Stand-in for picamera.PiCamera, used off the Pi. Frames are synthetic;
+    # the still port pays `still_delay` seconds (mode switch + exposure),
+    # the video port waits for the next frame at `framerate`, both divided
+    # by `speed` for accelerated simulations.
+    def __init__(self, still_delay=0.5, resolution=(640, 480), framerate=24,
+                 speed=1.0):
+        self.still_delay = still_delay
+        self.speed = speed
+        self.resolution = resolution
+        self.framerate = framerate
+        self.previewing = False
+        self.overlays = []
+        self.frame_count = 0
+        self.closed = False
+
+    def start_preview(self, **options):
+        self.previewing = True
+
+    def stop_preview(self):
+        self.previewing = False
+
+    def add_overlay(self, source, size=None, format=None, **options):
+        renderer = FakeRenderer(source, **options)
+        self.overlays.append(renderer)
+        return renderer
+
+    def remove_overlay(self, renderer):
+        self.overlays.remove(renderer)
+
+    def frame(self, size):
+        self.frame_count += 1
+        img = Image.new("RGB", size, (40, 40, 40))
+        d = ImageDraw.Draw(img)
+        w, h = size
+        x = (self.frame_count * 37) % max(w - h // 2, 1)
+        d.ellipse((x, h // 4, x + h // 2, 3 * h // 4), fill=(220, 20, 60))
+        d.text((10, 10), "frame {}".format(self.frame_count), (255, 255, 255))
+        return img
+
+    def capture(self, output, format=None, use_video_port=False,
+                resize=None, **options):
+        size = tuple(resize or self.resolution)
+        if use_video_port:
+            time.sleep(1.0 / float(self.framerate) / self.speed)
+        else:
+            time.sleep(self.still_delay / self.speed)
+        img = self.frame(size)
+        if format is None and isinstance(output, str):
+            format = "jpeg"
+        if format in ("rgb", "rgba"):
+            padded = Image.new(img.mode, pad(size))
+            padded.paste(img, (0, 0))
+            if format == "rgba":
+                padded = padded.convert("RGBA")
+            data = padded.tobytes()
+            if isinstance(output, str):
+                with open(output, "wb") as f:
+                    f.write(data)
+            else:
+                output.write(data)
+        else:
+            img.save(output, "JPEG", quality=92)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,131 @@
+# In-process replacement for the ImageMagick ``montage`` calls.
+#
+# A session used to run ``montage`` twice (2x4 print strip and 2x2 screen
+# preview), each run forking a process and decoding the four captures again.
+# Here every capture is decoded once and both layouts are pasted from the
+# same in-memory images, with the tile/geometry semantics of ``montage``:
+# each cell is the size of the largest image plus ``+x+y`` border on every
+# side, images are centred in their cell, cells are filled row by row on a
+# white background. The cells are laid out and rendered by the template
+# engine (layouts.grid_template), compiled once per capture size.
+#
+# The review screen does not need the full-size preview: review() renders
+# the same layout directly at screen size, each capture being shrunk on its
+# own with a cheap integer box reduction before the final resampling.
+
+import itertools
+from PIL import Image
+from layouts import Layout, grid_template
+
+
+class Montage():
+    def __init__(self, tile, geometry, repeat=1, background="white"):
+        # tile: (columns, rows), geometry: (x border, y border) as in "+x+y"
+        self.cols, self.rows = tile
+        self.bx, self.by = geometry
+        self.repeat = repeat
+        self.background = background
+        self.layouts = {}
+
+    def layout(self, imgs):
+        # the compiled grid for this many images of this size
+        cells = self.cells(imgs)
+        if len(cells) > self.cols * self.rows:
+            raise ValueError("{} images do not fit in a {}x{} tile".format(
+                len(cells), self.cols, self.rows))
+        key = (max(img.size[0] for img in cells),
+               max(img.size[1] for img in cells), len(imgs))
+        if key not in self.layouts:
+            self.layouts[key] = Layout(grid_template(
+                (self.cols, self.rows), (self.bx, self.by), key[:2],
+                captures=len(imgs), repeat=self.repeat,
+                background=self.background, name=self.describe()))
+        return self.layouts[key]
+
+    def size(self, imgs):
+        # size of the rendered montage
+        return self.layout(imgs).size()
+
+    def cells(self, imgs):
+        # every image is used `repeat` times in a row (print strip duplicates
+        # each capture side by side)
+        cells = [[img] * self.repeat for img in imgs]
+        return list(itertools.chain.from_iterable(cells))
+
+    def render(self, imgs, scale=1):
+        # scale < 1 renders a smaller copy of the same layout
+        return self.layout(imgs).render(imgs, scale)
+
+    def describe(self):
+        # e.g. "2x4+8+4*2", tile, geometry and repeat
+        layout = "{}x{}+{}+{}".format(self.cols, self.rows, self.bx, self.by)
+        if self.repeat > 1:
+            layout += "*{}".format(self.repeat)
+        return layout
+
+    def command(self, paths, output):
+        # equivalent ImageMagick command line, kept for comparison/fallback
+        return (["montage"]
+                + self.cells(paths)
+                + ["-tile", "{}x{}".format(self.cols, self.rows)]
+                + ["-geometry", "+{}+{}".format(self.bx, self.by)]
+                + [output])
+
+
+# layouts used by booth_tk.py
+PRINT_MONTAGE = Montage((2, 4), (8, 4), repeat=2)
+SHOW_MONTAGE = Montage((2, 2), (2, 2))
+
+
+def load_images(paths):
+    imgs = []
+    for path in paths:
+        img = Image.open(path)
+        img.load()
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        imgs.append(img)
+    return imgs
+
+
+class Compositor():
+    # print_montage / show_montage: a Montage, or a compiled template
+    # (layouts.Layout), anything with render(imgs, scale), size(imgs) and
+    # describe()
+    def __init__(self,
+                 print_montage=PRINT_MONTAGE,
+                 show_montage=SHOW_MONTAGE,
+                 quality=92):
+        self.print_montage = print_montage
+        self.show_montage = show_montage
+        self.quality = quality
+
+    def load(self, paths):
+        return load_images(paths)
+
+    def save(self, img, path):
+        img.save(path, "JPEG", quality=self.quality)
+        return path
+
+    def print_strip(self, imgs, path=None):
+        res = self.print_montage.render(imgs)
+        if path is not None:
+            self.save(res, path)
+        return res
+
+    def show_preview(self, imgs, path=None):
+        res = self.show_montage.render(imgs)
+        if path is not None:
+            self.save(res, path)
+        return res
+
+    def review(self, imgs, size):
+        # the preview layout fitting in `size`
+        w, h = self.show_montage.size(imgs)
+        return self.show_montage.render(
+            imgs, min(size[0] / w, size[1] / h, 1))
+
+    def compose(self, paths, toprint_path=None, show_path=None):
+        imgs = self.load(paths)
+        return (self.print_strip(imgs, toprint_path),
+                self.show_preview(imgs, show_path))
@@ -0,0 +1,437 @@
+# On-device guest gallery.
+#
+# A small HTTP/1.1 server on asyncio, in its own thread, that serves the
+# photos/ archive to the guests' phones over the booth's hotspot when the
+# venue has no internet:
+#
+#   /                   newest sessions first, ?page=N
+#   /thumb/<id>.jpg     thumbnails made by the archive, kept in memory
+#   /photo/<id>.jpg     full photos, with ETag / If-None-Match and single
+#   /animation/<id>     byte ranges (Range, If-Range), for resumed and
+#                       seeking downloads on flaky wifi
+#
+# The booth comes first: the server and its file reading threads run at a
+# lower priority and at most `max_requests` requests read files or make
+# thumbnails at once (the others wait their turn). A phone opens about six
+# connections; past `max_connections` new ones wait for a free one (a 503
+# after `queue_timeout`), and idle keep-alive connections are cut after
+# `busy_idle_timeout` instead of `idle_timeout` once the server is nearly
+# full, so thirty phones browsing at once cost the capture loop a bounded
+# amount of CPU and SD card reads.
+
+import os
+import re
+import html
+import asyncio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs
+
+REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified",
+           400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           416: "Range Not Satisfiable", 503: "Service Unavailable"}
+TYPES = {".jpg": "image/jpeg", ".gif": "image/gif", ".mp4": "video/mp4"}
+ROUTE = re.compile(r"^/(thumb|photo|animation)/([\w-]+)(\.\w+)?$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK = 64 * 1024
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Photos</title>
+<style>body{{margin:0;font-family:sans-serif;background:#222;color:#eee}}
+a{{color:#eee}} img{{width:48%;margin:1%;float:left}}
+p{{clear:both;text-align:center;padding:1em}}</style></head>
+<body>{items}<p>{links}</p></body></html>
+"""
+
+
+def lower_thread_priority(niceness):
+    # Linux nices threads one by one
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass
+
+
+def parse_range(value, size):
+    # "bytes=a-b" -> (first, last) inclusive, None for the whole file
+    # (missing, malformed or several ranges), "unsatisfiable"
+    m = RANGE.match(value.strip()) if value else None
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first == "":
+        if last == "":
+            return None
+        # suffix: the last N bytes
+        n = int(last)
+        if n == 0:
+            return "unsatisfiable"
+        return (max(size - n, 0), size - 1)
+    first = int(first)
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size or first > last:
+        return "unsatisfiable"
+    return (first, last)
+
+
+class Response():
+    def __init__(self, status, headers=None, body=b"", path=None,
+                 span=None):
+        # body bytes, or `span` (first, last) bytes of the file at `path`
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.path = path
+        self.span = span
+
+    def length(self):
+        if self.path is not None:
+            return self.span[1] - self.span[0] + 1
+        return len(self.body)
+
+
+class ThumbCache():
+    # thumbnail bytes by path, least recently used out past `max_bytes`
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # used from the server's file reading threads
+        self.lock = threading.Lock()
+
+    def get(self, path, stat):
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        with open(path, "rb") as f:
+            data = f.read()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+        return data
+
+
+class GalleryServer():
+    def __init__(self, archive, host="0.0.0.0", port=8080, max_requests=4,
+                 max_connections=256, page_size=24, idle_timeout=10,
+                 busy_idle_timeout=1, queue_timeout=30, niceness=10,
+                 logger=None):
+        # port 0: any free port, see self.port once started
+        self.archive = archive
+        self.host = host
+        self.port = port
+        self.max_requests = max_requests
+        self.max_connections = max_connections
+        self.page_size = page_size
+        self.idle_timeout = idle_timeout
+        self.busy_idle_timeout = busy_idle_timeout
+        self.queue_timeout = queue_timeout
+        self.niceness = niceness
+        self.logger = logger
+        self.thumbs = ThumbCache()
+        self.connections = 0
+        self.waiting = 0
+        self.writers = set()
+        self.served = collections.Counter()
+        self.rejected = 0
+        self.queued = 0
+        self.loop = None
+        self.pool = None
+        self.server = None
+        self._started = threading.Event()
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="gallery")
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        if self.logger is not None:
+            self.logger.info("gallery on http://{}:{}/".format(self.host,
+                                                                self.port))
+        return self
+
+    def _run(self):
+        lower_thread_priority(self.niceness)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.slots = asyncio.Semaphore(self.max_requests)
+        self.admitted = asyncio.Semaphore(self.max_connections)
+        # the SD card reads and thumbnails, off the event loop
+        self.pool = ThreadPoolExecutor(self.max_requests, "gallery-io",
+                                       lower_thread_priority,
+                                       (self.niceness,))
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(
+                self.handle, self.host, self.port,
+                backlog=self.max_connections))
+        except OSError as e:
+            self._error = e
+            self._started.set()
+            self.pool.shutdown(wait=False)
+            return
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # phones keep connections open, they are cut short
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                self.loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+            self.loop.close()
+            self.pool.shutdown(wait=False)
+
+    def stop(self, timeout=None):
+        if self.loop is not None and self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {"served": dict(self.served), "rejected": self.rejected,
+                "queued": self.queued, "connections": self.connections,
+                "thumb_hits": self.thumbs.hits,
+                "thumb_misses": self.thumbs.misses}
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        admitted = False
+        try:
+            admitted = await self.admit()
+            if not admitted:
+                self.rejected += 1
+                await self.send(writer, "GET", self.error(
+                    503, {"Retry-After": "2"}), False)
+                return
+            self.connections += 1
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader),
+                                                     self.keep_alive_timeout())
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    return
+                if request is None:
+                    await self.send(writer, "GET", self.error(400), False)
+                    return
+                method, target, version, headers = request
+                keep_alive = (version == "HTTP/1.1" and
+                              headers.get("connection", "").lower() != "close"
+                              and not self.has_body(headers))
+                # the file reads happen under the slot, not the sending
+                async with self.slots:
+                    response = await self.loop.run_in_executor(
+                        self.pool, self.respond, method, target, headers)
+                self.served[response.status] += 1
+                # the rest of a request we did not understand is not read
+                if response.status in (400, 405):
+                    keep_alive = False
+                await self.send(writer, method, response, keep_alive)
+        except ConnectionError:
+            pass
+        except Exception:
+            if self.logger is not None:
+                self.logger.error("gallery request failed", exc_info=True)
+        finally:
+            if admitted:
+                self.connections -= 1
+                self.admitted.release()
+            self.writers.discard(writer)
+            writer.close()
+
+    async def admit(self):
+        # a free connection, waiting for one past max_connections
+        if not self.admitted.locked():
+            await self.admitted.acquire()
+            return True
+        self.queued += 1
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.admitted.acquire(),
+                                   self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def keep_alive_timeout(self):
+        # idle phones make room when others wait or are about to
+        if self.waiting or self.connections >= self.max_connections * 3 // 4:
+            return self.busy_idle_timeout
+        return self.idle_timeout
+
+    async def read_request(self, reader):
+        line = await reader.readuntil(b"\r\n")
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 64:
+                return None
+        return parts[0], parts[1], parts[2], headers
+
+    def has_body(self, headers):
+        # bodies are never read: what follows is not a request line
+        return "transfer-encoding" in headers or \
+            headers.get("content-length", "0").strip() not in ("", "0")
+
+    async def send(self, writer, method, response, keep_alive):
+        headers = {"Server": "boothy", "Date": formatdate(usegmt=True),
+                   "Content-Length": str(response.length()),
+                   "Connection": "keep-alive" if keep_alive else "close"}
+        headers.update(response.headers)
+        head = "HTTP/1.1 {} {}\r\n{}\r\n".format(
+            response.status, REASONS[response.status],
+            "".join("{}: {}\r\n".format(k, v) for k, v in headers.items()))
+        writer.write(head.encode("latin-1"))
+        if method != "HEAD":
+            if response.path is not None:
+                await self.send_file(writer, response.path, response.span)
+            else:
+                writer.write(response.body)
+        await writer.drain()
+
+    async def send_file(self, writer, path, span):
+        # a chunk at a time, slow phones only hold a chunk of memory each
+        first, last = span
+        async with self.slots:
+            f = await self.loop.run_in_executor(self.pool, open, path, "rb")
+        with f:
+            f.seek(first)
+            left = last - first + 1
+            while left > 0:
+                async with self.slots:
+                    data = await self.loop.run_in_executor(
+                        self.pool, f.read, min(CHUNK, left))
+                if not data:
+                    break
+                left -= len(data)
+                writer.write(data)
+                await writer.drain()
+
+    def error(self, status, headers=None):
+        body = "{} {}\n".format(status, REASONS[status]).encode()
+        return Response(status, dict({"Content-Type": "text/plain"},
+                                     **(headers or {})), body)
+
+    def respond(self, method, target, headers):
+        if method not in ("GET", "HEAD"):
+            return self.error(405, {"Allow": "GET, HEAD"})
+        url = urlsplit(target)
+        if url.path == "/":
+            try:
+                page = int(parse_qs(url.query).get("page", ["0"])[0])
+            except ValueError:
+                page = 0
+            return self.index(max(page, 0))
+        m = ROUTE.match(url.path)
+        if m is None:
+            return self.error(404)
+        kind, session_id, _ = m.groups()
+        entry = self.archive.get(session_id)
+        if entry is None:
+            return self.error(404)
+        path = entry[kind + "_path"]
+        if not path:
+            return self.error(404)
+        try:
+            stat = os.stat(path)
+            if kind == "thumb":
+                return self.thumb(path, stat, headers)
+            return self.file(path, stat, headers)
+        except OSError:
+            return self.error(404)
+
+    def index(self, page):
+        entries = self.archive.list(limit=self.page_size + 1,
+                                    offset=page * self.page_size)
+        items = []
+        for entry in entries[:self.page_size]:
+            sid = html.escape(entry["id"])
+            if entry["animation_path"]:
+                href = "/animation/{}{}".format(
+                    sid, os.path.splitext(entry["animation_path"])[1])
+            else:
+                href = "/photo/{}.jpg".format(sid)
+            items.append('<a href="{}"><img src="/thumb/{}.jpg" alt="{}" '
+                         'loading="lazy"></a>'.format(href, sid, sid))
+        links = []
+        if page > 0:
+            links.append('<a href="/?page={}">&lt;</a>'.format(page - 1))
+        if len(entries) > self.page_size:
+            links.append('<a href="/?page={}">&gt;</a>'.format(page + 1))
+        body = PAGE.format(items="\n".join(items),
+                           links=" ".join(links)).encode()
+        return Response(200, {"Content-Type": "text/html; charset=utf-8",
+                              "Cache-Control": "no-cache"}, body)
+
+    def etag(self, stat):
+        return '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+
+    def not_modified(self, headers, etag):
+        # If-None-Match: a list of tags or "*", weak ones (W/) match too
+        tags = [t.strip() for t in headers.get("if-none-match", "").split(",")]
+        return "*" in tags or etag in [t[2:] if t.startswith("W/") else t
+                                       for t in tags]
+
+    def content_type(self, path):
+        return TYPES.get(os.path.splitext(path)[1].lower(),
+                         "application/octet-stream")
+
+    def thumb(self, path, stat, headers):
+        etag = self.etag(stat)
+        common = {"ETag": etag, "Cache-Control": "max-age=86400"}
+        if self.not_modified(headers, etag):
+            return Response(304, common)
+        return Response(200, dict(common, **{"Content-Type": "image/jpeg"}),
+                        self.thumbs.get(path, stat))
+
+    def file(self, path, stat, headers):
+        size = stat.st_size
+        etag = self.etag(stat)
+        common = {"ETag": etag, "Accept-Ranges": "bytes",
+                  "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+                  "Cache-Control": "max-age=3600"}
+        if self.not_modified(headers, etag):
+            return Response(304, common)
+        span = parse_range(headers.get("range"), size)
+        # a stale If-Range gets the whole (changed) file
+        if span is not None and headers.get("if-range", etag) != etag:
+            span = None
+        if span == "unsatisfiable":
+            return Response(416, dict(common, **{
+                "Content-Range": "bytes */{}".format(size)}))
+        common["Content-Type"] = self.content_type(path)
+        if span is None or size == 0:
+            return Response(200, common, path=path, span=(0, size - 1))
+        common["Content-Range"] = "bytes {}-{}/{}".format(span[0], span[1],
+                                                          size)
+        return Response(206, common, path=path, span=span)
@@ -0,0 +1,237 @@
+# Hardware backends.
+#
+# The booth talks to five pieces of hardware: the display (Tk), the camera
+# (picamera), the buttons (RPi.GPIO), the printer (pycups) and the gallery
+# uplink. Backends bundles one implementation of each; pi_backends() is the
+# real thing and imports the Pi-only modules lazily, simulated_backends()
+# plugs in the fakes so a whole Booth can run headless on any Linux box, at
+# accelerated time.
+
+import time
+import heapq
+import weakref
+import threading
+import itertools
+from buttons import FakeGPIO
+from capture import FakeCamera
+from printing import FakeCups
+from upload import SshTransport, LocalTransport
+
+
+class Backends():
+    def __init__(self, display, camera, gpio, cups, transport, speed=1.0):
+        self.display = display
+        # camera: factory returning a PiCamera-like object
+        self.camera = camera
+        self.gpio = gpio
+        # cups: pycups-like module, None imports cups on first print
+        self.cups = cups
+        self.transport = transport
+        self.speed = speed
+
+
+class TkDisplay():
+    def create_root(self):
+        import tkinter
+        return tkinter.Tk()
+
+    def create_canvas(self, root, width, height):
+        import tkinter
+        return tkinter.Canvas(root, width=width, height=height)
+
+    def photo(self, img):
+        from PIL import ImageTk
+        return ImageTk.PhotoImage(img)
+
+    def image_count(self, root):
+        # PhotoImages still alive in the Tk interpreter
+        return len(root.image_names())
+
+
+class OffscreenRoot():
+    # the subset of tk.Tk used by the booth, with its own timer loop;
+    # delays are divided by `speed`
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.timers = []
+        self.counter = itertools.count()
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.running = False
+        self.destroyed = False
+        self.bindings = {}
+
+    def after(self, ms, fn, *args):
+        due = time.monotonic() + ms / 1000.0 / self.speed
+        with self.lock:
+            timer_id = next(self.counter)
+            heapq.heappush(self.timers, (due, timer_id, fn, args))
+        return timer_id
+
+    def after_cancel(self, timer_id):
+        with self.lock:
+            self.cancelled.add(timer_id)
+
+    def mainloop(self):
+        self.running = True
+        while self.running:
+            with self.lock:
+                if not self.timers:
+                    break
+                due, timer_id, fn, args = self.timers[0]
+                now = time.monotonic()
+                if due <= now:
+                    heapq.heappop(self.timers)
+            if due > now:
+                time.sleep(min(due - now, 0.05))
+                continue
+            if timer_id in self.cancelled:
+                self.cancelled.discard(timer_id)
+                continue
+            fn(*args)
+
+    def quit(self):
+        self.running = False
+
+    def destroy(self):
+        self.running = False
+        self.destroyed = True
+
+    def update(self):
+        pass
+
+    def update_idletasks(self):
+        pass
+
+    def bind(self, sequence, fn):
+        self.bindings[sequence] = fn
+
+    def overrideredirect(self, flag):
+        pass
+
+    def geometry(self, spec):
+        pass
+
+    def focus_set(self):
+        pass
+
+
+class OffscreenCanvas():
+    def __init__(self, root, width, height):
+        self.root = root
+        self.size = (width, height)
+        self.items = {}
+        self.ids = itertools.count(1)
+        self.switches = 0
+
+    def pack(self):
+        pass
+
+    def configure(self, **options):
+        pass
+
+    def create_image(self, x, y, image=None):
+        item = next(self.ids)
+        self.items[item] = image
+        return item
+
+    def itemconfig(self, item, image=None):
+        self.items[item] = image
+        self.switches += 1
+
+    def current(self):
+        return list(self.items.values())[-1] if self.items else None
+
+
+class OffscreenDisplay():
+    # PIL images are kept as they are instead of becoming PhotoImages
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        # "photos" made and since garbage collected, like Tk's image names
+        self.photos = 0
+        self.released = 0
+
+    def create_root(self):
+        return OffscreenRoot(self.speed)
+
+    def create_canvas(self, root, width, height):
+        return OffscreenCanvas(root, width, height)
+
+    def photo(self, img):
+        self.photos += 1
+        weakref.finalize(img, self._release)
+        return img
+
+    def _release(self):
+        self.released += 1
+
+    def image_count(self, root):
+        return self.photos - self.released
+
+
+def pi_backends():
+    import picamera
+    import RPi.GPIO as GPIO
+    return Backends(TkDisplay(), picamera.PiCamera, GPIO, None,
+                    SshTransport())
+
+
+def simulated_backends(gallery_dir, speed=10.0, print_time=50.0):
+    # synthetic frames, fake GPIO, fake CUPS queue, offscreen display and a
+    # local directory standing in for the gallery
+    return Backends(OffscreenDisplay(speed),
+                    lambda **options: FakeCamera(speed=speed, **options),
+                    FakeGPIO(),
+                    FakeCups(print_time=print_time / speed),
+                    LocalTransport(gallery_dir),
+                    speed)
+
+
+class SimulatedGuest():
+    # Presses the buttons the way a guest would: one press per screen
+    # listed in `script` ({"home": "green", "review": "red", ...}), after
+    # `think` seconds (accelerated). Quits the booth main loop after
+    # `cycles` sessions.
+    def __init__(self, booth, script=None, cycles=1, think=1.0):
+        self.booth = booth
+        self.script = script or {"home": "green", "ready": "green",
+                                 "review": "green", "end": "green"}
+        self.cycles = cycles
+        self.think = think
+        self.sessions = 0
+        self.presses = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        machine = self.booth.machine
+        gpio = self.booth.backends.gpio
+        speed = self.booth.backends.speed
+        pins = self.booth.buttons.pins
+        seen = None
+        while not self._stop.is_set():
+            epoch, state = (machine.epoch, machine.state)
+            if epoch == seen:
+                time.sleep(0.002)
+                continue
+            seen = epoch
+            if state == "home":
+                if self.sessions == self.cycles:
+                    machine.post(self.booth.root.quit)
+                    return
+                self.sessions += 1
+            button = self.script.get(state)
+            if button is None:
+                continue
+            self._stop.wait(self.think / speed)
+            if machine.epoch != seen:
+                continue
+            gpio.click(pins[button], duration=0.05)
+            self.presses += 1
@@ -0,0 +1,713 @@
+# Print and archive hub shared by several booths.
+#
+# At larger events two or three booths share one Selphy and one uplink. The
+# hub owns both: booths send it their finished strips and photos over a TCP
+# or Unix socket, and it
+#
+#   - prints them through its PrintSpooler one at a time, taking the booths
+#     in turn (round-robin), so a busy booth does not hold back the others
+#   - stores the photos once in its photos/ (the content hash tells a resend
+#     from a new photo) and uploads them through a single UploadWorker
+#
+# The protocol is a JSON header line followed by `size` bytes of payload,
+# in both directions, one request at a time on a connection:
+#
+#   {"op": "print", "booth", "key", "name", "sha1", "title", "options"}
+#       -> {"ok", "job", "state", "ahead", "duplicate"}
+#   {"op": "status", "job"}       -> {"ok", "state", "error", "ahead"}
+#   {"op": "archive", "booth", "name", "sha1"} -> {"ok", "name", "duplicate"}
+#   {"op": "ping"}, {"op": "stats"}
+#
+# Every request carries the hub's shared secret as "token": guests' phones
+# are on the same Wi-Fi as the booths (gallery.py). A hub listening beyond
+# the loopback interface without a token is refused.
+#
+# On the booths, HubSpooler takes the place of the PrintSpooler and
+# HubTransport the one of the uplink transport: while the hub cannot be
+# reached, print jobs wait in the spooler's queue and photos in the upload
+# journal, and both are sent when it is back. Print requests are keyed by
+# booth and a key the booth makes for every print, so a request sent again
+# after a lost reply does not print twice while the same strip printed
+# again does (without a key, the same content is only folded into a job
+# still waiting or printing). The hub keeps its jobs in memory: after a restart the booths
+# send the jobs it lost again, and the one printing then is printed twice.
+#
+# usage: BOOTHY_HUB_TOKEN=... python3 hub.py [address] [wd]
+#   address: host:port (default 0.0.0.0:8765) or the path of a Unix socket
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import socket
+import hmac
+import hashlib
+import threading
+import itertools
+import collections
+import socketserver
+from printing import PrintSpooler, PrintJob
+
+MAX_HEADER = 64 * 1024
+
+
+def parse_address(address):
+    # "host:port" or "unix:/path" / "/path" -> (family, address)
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if address.startswith("/") or address.startswith("."):
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+
+def is_local(family, address):
+    # reachable from this machine only
+    return family == socket.AF_UNIX or address[0] in ("localhost", "::1") \
+        or address[0].startswith("127.")
+
+
+def send_message(f, header, payload=b""):
+    header = dict(header, size=len(payload))
+    f.write(json.dumps(header).encode() + b"\n")
+    if payload:
+        f.write(payload)
+    f.flush()
+
+
+def read_message(f, max_size=None):
+    # (header, payload); EOFError when the other end closed
+    line = f.readline(MAX_HEADER)
+    if not line:
+        raise EOFError("connection closed")
+    if not line.endswith(b"\n"):
+        raise ValueError("header too long")
+    header = json.loads(line.decode())
+    size = int(header.get("size", 0))
+    if size < 0 or (max_size is not None and size > max_size):
+        raise ValueError("payload of {} bytes refused".format(size))
+    payload = f.read(size) if size else b""
+    if len(payload) != size:
+        raise EOFError("connection closed")
+    return header, payload
+
+
+def safe_name(name):
+    name = re.sub(r"[^\w.-]", "_", os.path.basename(name or ""))
+    if name.strip(".") == "":
+        raise ValueError("bad file name {!r}".format(name))
+    return name
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_file(path, data):
+    # atomic and durable, photos/ is the event's only copy for a while
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class HubJob():
+    def __init__(self, job_id, booth, key, path, title, options):
+        self.id = job_id
+        self.booth = booth
+        self.key = key
+        self.path = path
+        self.title = title
+        self.options = options
+        self.state = "queued"
+        self.error = None
+        self.created = time.monotonic()
+        self.finished_at = None
+
+
+class FairQueue():
+    # one FIFO per booth, served in turn
+    def __init__(self):
+        self.queues = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, booth, item):
+        with self.cond:
+            self.queues.setdefault(booth, collections.deque()).append(item)
+            self.cond.notify()
+
+    def get(self):
+        # None once closed
+        with self.cond:
+            while True:
+                if self.closed:
+                    return None
+                for booth, items in self.queues.items():
+                    if items:
+                        item = items.popleft()
+                        # served: to the back of the line
+                        self.queues.move_to_end(booth)
+                        return item
+                self.cond.wait()
+
+    def ahead(self, booth, item):
+        # items served before this one, as the queue stands
+        with self.cond:
+            items = self.queues.get(booth)
+            if items is None or item not in items:
+                return 0
+            k = items.index(item)
+            count = k
+            before = True
+            for other, queued in self.queues.items():
+                if other == booth:
+                    before = False
+                    continue
+                count += min(len(queued), k + (1 if before else 0))
+            return count
+
+    def __len__(self):
+        with self.cond:
+            return sum(len(items) for items in self.queues.values())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # idle booths are disconnected, they reconnect on their next request
+    timeout = 300
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.server.hub.connections.add(self.connection)
+
+    def finish(self):
+        self.server.hub.connections.discard(self.connection)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        hub = self.server.hub
+        while True:
+            try:
+                header, payload = read_message(self.rfile, hub.max_size)
+            except (EOFError, OSError):
+                return
+            except ValueError as e:
+                reply, header = {"ok": False, "error": str(e)}, None
+            else:
+                reply = hub.handle(header, payload)
+            try:
+                send_message(self.wfile, reply)
+            except OSError:
+                return
+            if header is None:
+                # the stream is out of step after a bad message
+                return
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class PrintHub():
+    def __init__(self, address, wd, spooler, uploader=None, index=None,
+                 max_size=64 * 1024 * 1024, history=1000, token=None,
+                 logger=None, metrics=None):
+        # spooler: printing.PrintSpooler of the shared printer; uploader:
+        # upload.UploadWorker of the shared uplink; index: archive.Archive
+        # of photos/, optional; token: the booths' shared secret
+        self.family, self.address = parse_address(address)
+        if not token and not is_local(self.family, self.address):
+            raise ValueError("a token is needed to listen on {}".format(
+                address))
+        self.token = token
+        self.spool_dir = os.path.join(wd, "spool")
+        self.photos_dir = os.path.join(wd, "photos")
+        for path in [self.spool_dir, self.photos_dir]:
+            os.makedirs(path, exist_ok=True)
+        self.spooler = spooler
+        self.uploader = uploader
+        self.index = index
+        self.max_size = max_size
+        self.history = history
+        self.logger = logger
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # job ids stay unique across restarts of the hub
+        self.run_id = uuid.uuid4().hex[:8]
+        self.ids = itertools.count(1)
+        self.jobs = collections.OrderedDict()
+        self.keys = {}
+        self.queue = FairQueue()
+        self.current = None
+        # sha1 -> name, of the photos received since the start
+        self.digests = {}
+        self.printed = collections.Counter()
+        self.archived = 0
+        self.duplicates = 0
+        self.server = None
+        self.connections = set()
+        self._serving = None
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True, name="hub-print")
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def start(self):
+        self._dispatcher.start()
+        return self.listen()
+
+    def listen(self):
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = _UnixServer(self.address, _Handler)
+        else:
+            self.server = _TCPServer(self.address, _Handler)
+            # port 0: the one picked by the system, kept for listen() again
+            self.address = self.server.server_address
+        self.server.hub = self
+        self._serving = threading.Thread(target=self.server.serve_forever,
+                                         daemon=True, name="hub-server")
+        self._serving.start()
+        self.log("print hub listening on {}".format(self.url()))
+        return self
+
+    def disconnect(self):
+        # stops listening and drops the booths' connections; the queue and
+        # the printing go on (listen() takes booths again)
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        for conn in list(self.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+        self.server = None
+
+    def url(self):
+        if self.family == socket.AF_UNIX:
+            return self.address
+        return "{}:{}".format(*self.address[:2])
+
+    def handle(self, header, payload):
+        op = header.get("op")
+        if self.token and not hmac.compare_digest(
+                str(header.get("token", "")).encode(), self.token.encode()):
+            self.log("hub: {} from {} refused, bad token".format(
+                op, header.get("booth")))
+            return {"ok": False, "error": "unauthorized"}
+        try:
+            if op == "print":
+                return self.submit(header, payload)
+            if op == "status":
+                return self.status(header.get("job"))
+            if op == "archive":
+                return self.archive(header, payload)
+            if op == "ping":
+                return {"ok": True}
+            if op == "stats":
+                return dict(self.stats(), ok=True)
+            return {"ok": False, "error": "unknown op {!r}".format(op)}
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("hub: {} from {} failed".format(
+                    op, header.get("booth")), exc_info=True)
+            return {"ok": False, "error": str(e)}
+
+    def check(self, header, payload):
+        if header.get("sha1") not in (None, hashlib.sha1(payload).hexdigest()):
+            raise ValueError("payload does not match its sha1")
+        return safe_name(header.get("booth") or "booth")
+
+    def submit(self, header, payload):
+        booth = self.check(header, payload)
+        key = (booth, header.get("key") or hashlib.sha1(payload).hexdigest())
+        live = not header.get("key")
+        with self.lock:
+            job = self.keys.get(key)
+            # a request sent again, not a new print
+            if self.same_print(job, live):
+                return self.duplicate(booth, job)
+            job_id = "{}-{}".format(self.run_id, next(self.ids))
+        path = os.path.join(self.spool_dir, "{}-{}".format(
+            job_id, safe_name(header.get("name") or "print.jpg")))
+        # the file first: a job is only known once it can be printed
+        write_file(path, payload)
+        with self.lock:
+            job = self.keys.get(key)
+            if self.same_print(job, live):
+                # the same request, registered meanwhile
+                os.remove(path)
+                return self.duplicate(booth, job)
+            job = HubJob(job_id, booth, key, path, header.get("title",
+                                                               "boothy"),
+                         header.get("options"))
+            self.jobs[job_id] = job
+            self.keys[key] = job
+            self.prune()
+        self.queue.put(booth, job)
+        self.log("print job {} from {} queued".format(job_id, booth))
+        return {"ok": True, "job": job_id, "state": job.state,
+                "ahead": self.queue.ahead(booth, job) + (
+                    self.current is not None), "duplicate": False}
+
+    def same_print(self, job, live):
+        # live: content keys only match jobs not printed yet, a reprint of
+        # the same strip is a new job
+        if job is None or job.state == "failed":
+            return False
+        return not live or job.state != "done"
+
+    def duplicate(self, booth, job):
+        return {"ok": True, "job": job.id, "state": job.state,
+                "ahead": self.queue.ahead(booth, job), "duplicate": True}
+
+    def prune(self):
+        # finished jobs beyond `history` are forgotten, oldest first
+        finished = [j for j in self.jobs.values() if j.finished_at]
+        for job in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job.id]
+            if self.keys.get(job.key) is job:
+                del self.keys[job.key]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return {"ok": False, "error": "unknown job"}
+        ahead = 0
+        if job.state == "queued":
+            ahead = self.queue.ahead(job.booth, job) + (
+                self.current is not None)
+        return {"ok": True, "state": job.state, "error": job.error,
+                "ahead": ahead}
+
+    def _dispatch(self):
+        # one job at a time in the spooler, so the next one is picked when
+        # the printer is free, not when the job came in
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.current = job
+            local = self.spooler.submit(
+                job.path, title=job.title, options=job.options,
+                callback=lambda local, job=job: self._changed(job, local))
+            local.wait()
+            self.current = None
+
+    def _changed(self, job, local):
+        job.state = local.state
+        job.error = local.error
+        if local.finished_at is None:
+            return
+        job.finished_at = time.monotonic()
+        if local.state == "done":
+            self.printed[job.booth] += 1
+        if self.metrics is not None:
+            self.metrics.record("hub.print", 1000 * (job.finished_at -
+                                                     job.created),
+                                booth=job.booth, state=job.state)
+        self.log("print job {} from {}: {}".format(job.id, job.booth,
+                                                   job.state))
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+
+    def archive(self, header, payload):
+        booth = self.check(header, payload)
+        name = safe_name(header.get("name"))
+        digest = hashlib.sha1(payload).hexdigest()
+        with self.lock:
+            if digest in self.digests:
+                self.duplicates += 1
+                return {"ok": True, "name": self.digests[digest],
+                        "duplicate": True}
+            path = os.path.join(self.photos_dir, name)
+            if os.path.exists(path):
+                # sent again after a restart of the hub, or the same name
+                # from another booth
+                if file_sha1(path) == digest:
+                    self.digests[digest] = name
+                    self.duplicates += 1
+                    return {"ok": True, "name": name, "duplicate": True}
+                stem, ext = os.path.splitext(name)
+                name = "{}-{}{}".format(stem, booth, ext)
+                path = os.path.join(self.photos_dir, name)
+            write_file(path, payload)
+            self.digests[digest] = name
+            self.archived += 1
+        if self.index is not None:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in (".jpg", ".jpeg"):
+                self.index.add(stem, path)
+            else:
+                self.index.update(stem, animation_path=os.path.abspath(path))
+        if self.uploader is not None:
+            self.uploader.enqueue(path)
+        return {"ok": True, "name": name, "duplicate": False}
+
+    def stats(self):
+        return {"queued": len(self.queue),
+                "printing": self.current.id if self.current else None,
+                "printed": dict(self.printed),
+                "archived": self.archived,
+                "duplicates": self.duplicates}
+
+    def stop(self, timeout=None):
+        self.disconnect()
+        self.queue.close()
+        if self._serving is not None:
+            self._serving.join(timeout)
+        # the job printing, if any, is the spooler's to finish
+        self._dispatcher.join(timeout)
+
+
+class HubClient():
+    # one connection to the hub, opened on demand; OSError when it cannot
+    # be reached
+    def __init__(self, address, booth, timeout=30.0, token=None):
+        self.family, self.address = parse_address(address)
+        self.booth = booth
+        self.timeout = timeout
+        self.token = token
+        self.sock = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+
+    def request(self, header, payload=b""):
+        header = dict(header, booth=self.booth)
+        if self.token:
+            header["token"] = self.token
+        with self.lock:
+            # a kept connection may have been closed by the hub meanwhile:
+            # tried once more on a new one, every request is idempotent
+            for attempt in range(2):
+                reused = self.file is not None
+                try:
+                    if self.file is None:
+                        self.connect()
+                    send_message(self.file, header, payload)
+                    reply, _ = read_message(self.file)
+                    return reply
+                except (OSError, EOFError, ValueError) as e:
+                    self._close()
+                    if not reused or attempt:
+                        raise ConnectionError("print hub: {}".format(e))
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.file.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.file = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class HubSpooler(PrintSpooler):
+    # PrintSpooler whose printer is the hub's: jobs are sent to it and their
+    # state followed, and they wait here while it cannot be reached
+    def __init__(self, address, booth, poll_interval=1.0,
+                 retry_interval=10.0, timeout=30.0, token=None, logger=None):
+        self.client = HubClient(address, booth, timeout, token)
+        self.unreachable = False
+        PrintSpooler.__init__(self, printer=address,
+                              poll_interval=poll_interval,
+                              retry_interval=retry_interval, logger=logger)
+
+    def submit(self, path, callback=None, title="boothy", options=None):
+        job = PrintJob(path, title, options, callback)
+        # one key per print, the same for every resend of it
+        job.key = uuid.uuid4().hex
+        self.jobs.put(job)
+        return job
+
+    def process(self, job):
+        # an unreachable hub is waited for as long as it takes, any other
+        # error is retried up to max_attempts
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                if job.job_id is None and not self.send(job):
+                    return
+                if self.poll(job, None):
+                    return
+            except ConnectionError as e:
+                if not self.unreachable:
+                    self.log("{}, print jobs kept until it is back".format(
+                        e))
+                self.unreachable = True
+                self._stop.wait(self.retry_interval)
+            except Exception as e:
+                # a reply out of protocol, or a bug
+                failures += 1
+                if self.logger is not None:
+                    self.logger.error("print hub error", exc_info=True)
+                if failures >= self.max_attempts:
+                    self.finish(job, "failed", "print hub: {}".format(e))
+                    return
+                self._stop.wait(self.retry_interval)
+
+    def send(self, job):
+        # False when the job failed: the hub refused it, or the file is gone
+        try:
+            with open(job.path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            self.finish(job, "failed", "cannot read {}: {}".format(
+                job.path, e.strerror or e))
+            return False
+        digest = hashlib.sha1(data).hexdigest()
+        job.attempts += 1
+        reply = self.client.request(
+            {"op": "print", "key": job.key, "sha1": digest,
+             "name": os.path.basename(job.path), "title": job.title,
+             "options": job.options}, data)
+        if not reply.get("ok"):
+            self.finish(job, "failed", "print hub: {}".format(
+                reply.get("error")))
+            return False
+        if self.unreachable:
+            self.log("print hub back")
+            self.unreachable = False
+        job.job_id = reply["job"]
+        job.submitted_at = time.monotonic()
+        self.log("print job {} sent to the hub, {} ahead".format(
+            job.job_id, reply.get("ahead")))
+        return True
+
+    def poll(self, job, name):
+        # returns True once the job reached a final state
+        while not self._stop.is_set():
+            reply = self.client.request({"op": "status", "job": job.job_id})
+            if not reply.get("ok"):
+                # the hub restarted and lost its queue: sent again
+                job.job_id = None
+                return False
+            state, error = reply["state"], reply.get("error")
+            if state in ("done", "failed"):
+                self.finish(job, state, error)
+                return True
+            if state != job.state or error != job.error:
+                self.notify(job, state, error)
+            self._stop.wait(self.poll_interval)
+        return True
+
+    def close(self, timeout=None):
+        PrintSpooler.close(self, timeout)
+        self.client.close()
+
+
+class HubTransport():
+    # uplink transport of an UploadWorker: the photos go to the hub, which
+    # archives and uploads them; the worker's journal keeps them meanwhile
+    def __init__(self, address, booth, timeout=30.0, token=None):
+        self.client = HubClient(address, booth, timeout, token)
+        self.uploads = 0
+        self.duplicates = 0
+
+    def online(self):
+        try:
+            return self.client.request({"op": "ping"}).get("ok", False)
+        except OSError:
+            return False
+
+    def upload(self, paths):
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            reply = self.client.request(
+                {"op": "archive", "name": os.path.basename(path),
+                 "sha1": hashlib.sha1(data).hexdigest()}, data)
+            if not reply.get("ok"):
+                raise OSError("print hub: {}".format(reply.get("error")))
+            self.duplicates += reply.get("duplicate", False)
+        self.uploads += 1
+
+    def sync(self):
+        # the hub syncs the gallery once per batch of its own
+        pass
+
+    def close(self):
+        self.client.close()
+
+
+if __name__ == "__main__":
+    from upload import UploadWorker, SshTransport
+    from archive import Archive
+    from logqueue import init_logging, stop_logging
+    address = sys.argv[1] if len(sys.argv) > 1 else "0.0.0.0:8765"
+    wd = sys.argv[2] if len(sys.argv) > 2 else "."
+    token = os.environ.get("BOOTHY_HUB_TOKEN")
+    if not token and not is_local(*parse_address(address)):
+        sys.exit("hub: set BOOTHY_HUB_TOKEN to listen on {}".format(address))
+    logger = init_logging("hub", os.path.join(wd, "logs"), prefix="hub")
+    index = Archive(os.path.join(wd, "photos"), logger=logger)
+    uploader = UploadWorker(SshTransport(), os.path.join(
+        wd, "logs", "upload_journal.jsonl"), logger=logger,
+        on_uploaded=index.uploaded)
+    spooler = PrintSpooler(logger=logger)
+    hub = PrintHub(address, wd, spooler, uploader, index,
+                   token=token,
+                   logger=logger).start()
+    try:
+        while True:
+            time.sleep(60)
+            logger.info("hub: {}".format(hub.stats()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.stop(timeout=5)
+        spooler.close(timeout=5)
+        uploader.close(timeout=5)
+        index.close(timeout=5)
+        stop_logging("hub")
@@ -0,0 +1,221 @@
+# Template-driven layouts for the print strip and the screen preview.
+#
+# A template is a JSON file in templates/ (or the same dict in code):
+#
+#   {"name": "selphy-4logo",
+#    "paper": [4, 6], "dpi": 300, "units": "in",   or "size": [w, h] in px
+#    "background": "white",
+#    "slots": [{"box": [x, y, w, h], "capture": 0, "fit": "contain"}, ...],
+#             (fit: "contain", "cover" or "none", centred at its own size)
+#    "layers": [{"image": "4logo.png", "box": [x, y, w, h]},
+#               {"text": "...", "xy": [x, y], "size": 0.2, "fill": [r, g, b]}],
+#    "overlays": [...same as layers, drawn above the captures...]}
+#
+# or a grid with ImageMagick montage semantics, laid out for the capture
+# size once it is known (compositor.Montage renders through these too):
+#
+#   {"name": "strip", "grid": {"tile": [2, 4], "geometry": [8, 4],
+#                              "repeat": 2}}
+#
+# compile() resolves units, draws the background and static layers once and
+# computes where each slot goes. render(captures) then only copies the
+# background, pastes the captures (resized only when the slot is not their
+# size) and composites the overlays.
+
+import os
+import json
+import math
+from PIL import Image, ImageDraw, ImageFont
+from screens import FONT_PATH
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "templates")
+UNITS = {"px": None, "in": 1.0, "mm": 25.4}
+
+
+def load_template(name, templates_dir=TEMPLATES_DIR):
+    # a template name in templates/, or a path to a JSON file
+    path = name if name.endswith(".json") else os.path.join(
+        templates_dir, name + ".json")
+    with open(path) as f:
+        template = json.load(f)
+    template.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    template.setdefault("dir", os.path.dirname(os.path.abspath(path)))
+    return template
+
+
+def grid_template(tile, geometry, capture_size, captures=4, repeat=1,
+                  background="white", name="grid"):
+    # the slots `montage -tile COLSxROWS -geometry +X+Y` would use, for
+    # captures of at most `capture_size`: centred in their cell, unscaled
+    cols, rows = tile
+    bx, by = geometry
+    w, h = capture_size
+    cell_w, cell_h = (w + 2 * bx, h + 2 * by)
+    n = captures * repeat
+    # montage trims unused rows
+    rows = min(rows, -(-n // cols))
+    return {"name": name,
+            "size": [cols * cell_w, rows * cell_h],
+            "background": background,
+            "slots": [{"box": [(i % cols) * cell_w + bx,
+                               (i // cols) * cell_h + by, w, h],
+                       "capture": i // repeat, "fit": "none"}
+                      for i in range(n)],
+            "describe": "{}x{}+{}+{}{}".format(
+                tile[0], tile[1], bx, by,
+                "*{}".format(repeat) if repeat > 1 else "")}
+
+
+class Layout():
+    def __init__(self, template, capture_size=None, font=None,
+                 font_path=FONT_PATH):
+        if "grid" in template:
+            grid = template["grid"]
+            template = dict(template, **grid_template(
+                grid["tile"], grid.get("geometry", (0, 0)), capture_size,
+                captures=grid.get("captures", 4),
+                repeat=grid.get("repeat", 1),
+                background=template.get("background", "white"),
+                name=template.get("name", "grid")))
+        self.template = template
+        self.name = template.get("name", "layout")
+        self.dir = template.get("dir", ".")
+        if font is None:
+            fonts = {}
+
+            def font(size):
+                if size not in fonts:
+                    try:
+                        fonts[size] = ImageFont.truetype(font_path, size)
+                    except OSError:
+                        fonts[size] = ImageFont.load_default()
+                return fonts[size]
+        self.font = font
+        self.compile()
+
+    def px(self, value):
+        # template units to pixels
+        if self.px_per_unit is None:
+            return int(round(value))
+        return int(round(value * self.px_per_unit))
+
+    def compile(self):
+        template = self.template
+        units = template.get("units", "px")
+        dpi = template.get("dpi", 300)
+        self.px_per_unit = None if UNITS[units] is None else dpi / UNITS[units]
+        if "paper" in template:
+            # paper sizes are always in the template units
+            self.canvas_size = tuple(self.px(v) for v in template["paper"])
+        else:
+            self.canvas_size = tuple(self.px(v) for v in template["size"])
+        self.scaled = {}
+        self.slots = []
+        for slot in template["slots"]:
+            x, y, w, h = [self.px(v) for v in slot["box"]]
+            self.slots.append((slot.get("capture", len(self.slots)),
+                               (x, y, w, h), slot.get("fit", "contain")))
+        self.background = Image.new("RGB", self.canvas_size,
+                                    self._color(template.get("background",
+                                                             "white")))
+        self.draw_layers(self.background, template.get("layers", []))
+        self.overlay = None
+        if template.get("overlays"):
+            self.overlay = Image.new("RGBA", self.canvas_size, (0, 0, 0, 0))
+            self.draw_layers(self.overlay, template["overlays"])
+
+    def _color(self, value):
+        return value if isinstance(value, str) else tuple(value)
+
+    def draw_layers(self, img, layers):
+        d = ImageDraw.Draw(img)
+        for layer in layers:
+            if "image" in layer:
+                src = Image.open(os.path.join(self.dir, layer["image"]))
+                x, y, w, h = [self.px(v) for v in layer["box"]]
+                src = src.convert("RGBA")
+                src.thumbnail((w, h), Image.LANCZOS)
+                # centred in its box, transparency kept
+                img.paste(src, (x + (w - src.size[0]) // 2,
+                                y + (h - src.size[1]) // 2), src)
+            elif "text" in layer:
+                d.text(tuple(self.px(v) for v in layer["xy"]), layer["text"],
+                       font=self.font(self.px(layer["size"])),
+                       fill=self._color(layer.get("fill", (0, 0, 0))))
+            elif "rect" in layer:
+                x, y, w, h = [self.px(v) for v in layer["rect"]]
+                d.rectangle((x, y, x + w - 1, y + h - 1),
+                            fill=self._color(layer.get("fill", (0, 0, 0))))
+
+    def place(self, img, box, mode, scale=1):
+        # the part of the capture showing in its slot, resized for `scale`,
+        # and where it goes; the capture is centred in the slot, scaled to
+        # fit inside it ("contain") or to fill it, cropped ("cover")
+        x, y, w, h = box
+        iw, ih = img.size
+        if mode == "none":
+            # whole pixels, as montage does
+            ratio = 1
+            left, top = (x + (w - iw) // 2, y + (h - ih) // 2)
+        else:
+            if mode == "cover":
+                ratio = max(w / iw, h / ih)
+            else:
+                ratio = min(w / iw, h / ih)
+            left, top = (x + (w - iw * ratio) / 2, y + (h - ih * ratio) / 2)
+        # whole output pixels, so slots land where they would in a resized
+        # full-scale render
+        x0 = math.ceil(max(left, x) * scale)
+        y0 = math.ceil(max(top, y) * scale)
+        x1 = math.floor(min(left + iw * ratio, x + w) * scale)
+        y1 = math.floor(min(top + ih * ratio, y + h) * scale)
+        src = (max((x0 / scale - left) / ratio, 0),
+               max((y0 / scale - top) / ratio, 0),
+               min((x1 / scale - left) / ratio, iw),
+               min((y1 / scale - top) / ratio, ih))
+        if (x1 - x0, y1 - y0) == img.size:
+            return img, (x0, y0)
+        return img.resize((x1 - x0, y1 - y0), Image.LANCZOS, box=src,
+                          reducing_gap=2.0), (x0, y0)
+
+    def size(self, imgs=None):
+        return self.canvas_size
+
+    def layer(self, img, scale):
+        # static layers, resized once per scale
+        if scale == 1:
+            return img
+        key = (id(img), scale)
+        if key not in self.scaled:
+            self.scaled[key] = img.resize(
+                (int(self.canvas_size[0] * scale),
+                 int(self.canvas_size[1] * scale)),
+                Image.LANCZOS, reducing_gap=2.0)
+        return self.scaled[key]
+
+    def render(self, imgs, scale=1):
+        if self.template.get("layers"):
+            res = self.layer(self.background, scale).copy()
+        else:
+            # nothing drawn on the background, filling is cheaper
+            res = Image.new("RGB", self.layer(self.background, scale).size,
+                            self._color(self.template.get("background",
+                                                          "white")))
+        # repeated captures are resized once
+        placed = {}
+        for capture, box, mode in self.slots:
+            if capture >= len(imgs):
+                continue
+            key = (capture, box, mode)
+            if key not in placed:
+                placed[key] = self.place(imgs[capture], box, mode, scale)
+            img, xy = placed[key]
+            res.paste(img, xy)
+        if self.overlay is not None:
+            overlay = self.layer(self.overlay, scale)
+            res.paste(overlay, (0, 0), overlay)
+        return res
+
+    def describe(self):
+        return self.template.get("describe", self.name)
@@ -0,0 +1,104 @@
+# Non-blocking logging.
+#
+# The booth threads only put records on a bounded in-memory queue; one
+# listener thread formats them and writes the console and the log files,
+# so a slow SD card delays that thread and never a countdown or a capture.
+# The log files rotate by size (logs/booth_debug.log, booth_debug.log.1...)
+# and are appended to, a restart keeps the earlier logs.
+#
+# When the queue is full (the listener is stuck on a write) new records
+# below WARNING are dropped and counted, warnings and errors replace the
+# oldest queued record instead; the next record to get through is preceded
+# by a warning with the number of records lost.
+
+import os
+import queue
+import logging
+import threading
+import logging.handlers
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, maxsize=10000):
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(maxsize))
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record):
+        with self._lock:
+            if self.dropped and not self.queue.full():
+                lost = logging.LogRecord(
+                    record.name, logging.WARNING, __file__, 0,
+                    "{} log record(s) dropped, log writer behind".format(
+                        self.dropped), None, None)
+                self.dropped = 0
+                self.queue.put_nowait(lost)
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                if record.levelno < logging.WARNING:
+                    self.dropped += 1
+                    return
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(record)
+                except queue.Full:
+                    self.dropped += 1
+
+
+class Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # waits for room, the queue may be full when stopping
+        self.queue.put(self._sentinel)
+
+
+# logger name -> (queue handler, listener)
+_listeners = {}
+
+
+def init_logging(name="booth", output_dir="./logs/", prefix="booth",
+                 max_bytes=2 * 1024 * 1024, backups=5, maxsize=10000,
+                 console=True):
+    # name: logger to configure, None for the root logger
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    stop_logging(name)
+    formatter = logging.Formatter(FORMAT)
+    handlers = []
+    if console:
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.INFO)
+        handlers.append(handler)
+    os.makedirs(output_dir, exist_ok=True)
+    for level, suffix in [(logging.ERROR, "error"), (logging.DEBUG, "debug")]:
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(output_dir, "{}_{}.log".format(prefix, suffix)),
+            "a", maxBytes=max_bytes, backupCount=backups, delay=True)
+        handler.setLevel(level)
+        handlers.append(handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    queue_handler = BoundedQueueHandler(maxsize)
+    listener = Listener(
+        queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(queue_handler)
+    _listeners[name] = (queue_handler, listener)
+    return logger
+
+
+def stop_logging(name="booth"):
+    # writes out what is still queued and closes the files
+    if name not in _listeners:
+        return
+    queue_handler, listener = _listeners.pop(name)
+    logging.getLogger(name).removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
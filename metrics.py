@@ -0,0 +1,213 @@
+# Timing spans and per-session metrics.
+#
+# Code under measurement opens a span, `with metrics.span("capture",
+# session.name):`, or `span = metrics.span(...)` then `span.end()` when it
+# begins and ends in different callbacks, and counts events with
+# metrics.count(). Finished spans update in-memory counters, rolling
+# counters over the last `window` seconds and fixed-bucket histograms, and
+# are appended to a JSON lines file by a background writer, so the booth
+# thread only pays for a perf_counter() and a queue put:
+#
+#   {"t": 1718000000.12, "name": "capture", "session": "20240610-201500",
+#    "ms": 41.7, "shot": 2}
+#
+# Metrics(None) keeps the counters and histograms but writes no file.
+
+import json
+import time
+import queue
+import bisect
+import threading
+import collections
+
+# histogram bucket upper bounds, in ms
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+           30000, 60000, 120000]
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # one more bucket for everything above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.n += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        if not self.n:
+            return 0.0
+        rank = p / 100.0 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return float(self.buckets[i]) if i < len(self.buckets) \
+                    else self.max
+        return self.max
+
+    def stats(self):
+        return {"n": self.n,
+                "mean": self.total / self.n if self.n else 0.0,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "max": self.max}
+
+
+class Span():
+    def __init__(self, metrics, name, session=None, **fields):
+        self.metrics = metrics
+        self.name = name
+        self.session = session
+        self.fields = fields
+        self.t0 = time.perf_counter()
+        self.ms = None
+
+    def end(self, **fields):
+        # only the first end() counts
+        if self.ms is not None:
+            return self.ms
+        self.ms = 1000 * (time.perf_counter() - self.t0)
+        self.fields.update(fields)
+        self.metrics.record(self.name, self.ms, self.session, **self.fields)
+        return self.ms
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        self.end()
+        return False
+
+
+class Metrics():
+    def __init__(self, path=None, window=3600.0, flush_interval=1.0):
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        # (monotonic time, name, n) of the events inside the rolling window
+        self.recent = collections.deque()
+        self.histograms = {}
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        if path is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="metrics")
+            self._thread.start()
+
+    def span(self, name, session=None, **fields):
+        return Span(self, name, session, **fields)
+
+    def count(self, name, session=None, n=1, **fields):
+        now = time.monotonic()
+        with self.lock:
+            self.counters[name] += n
+            self.recent.append((now, name, n))
+            self._trim(now)
+        self._write(name, session, None, fields)
+
+    def record(self, name, ms, session=None, **fields):
+        now = time.monotonic()
+        with self.lock:
+            self.counters[name] += 1
+            self.recent.append((now, name, 1))
+            self._trim(now)
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(ms)
+        self._write(name, session, ms, fields)
+
+    def _trim(self, now):
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+
+    def _write(self, name, session, ms, fields):
+        if self._thread is None:
+            return
+        entry = {"t": round(time.time(), 3), "name": name}
+        if session is not None:
+            entry["session"] = session
+        if ms is not None:
+            entry["ms"] = round(ms, 3)
+        entry.update(fields)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # never block the booth for the sake of metrics
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    f.flush()
+                    return
+                lines = [entry]
+                while True:
+                    try:
+                        entry = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        break
+                    lines.append(entry)
+                for line in lines:
+                    f.write(json.dumps(line, default=str) + "\n")
+                f.flush()
+                if entry is None:
+                    return
+                time.sleep(self.flush_interval)
+
+    def rolling(self):
+        # event counts over the last `window` seconds
+        with self.lock:
+            self._trim(time.monotonic())
+            counts = collections.Counter()
+            for _, name, n in self.recent:
+                counts[name] += n
+        return dict(counts)
+
+    def stats(self):
+        with self.lock:
+            histograms = {name: h.stats()
+                          for name, h in self.histograms.items()}
+            totals = dict(self.counters)
+        return {"total": totals,
+                "last_{:.0f}s".format(self.window): self.rolling(),
+                "ms": histograms,
+                "dropped": self.dropped}
+
+    def report(self):
+        stats = self.stats()
+        recent = stats["last_{:.0f}s".format(self.window)]
+        lines = ["metrics"]
+        for name in sorted(recent):
+            lines.append("  {:<16} {:5d} in the last {:.0f}s, {} in "
+                         "all".format(name, recent[name], self.window,
+                                      stats["total"].get(name, 0)))
+        for name in sorted(stats["ms"]):
+            h = stats["ms"][name]
+            lines.append("  {:<16} n {:5d}  mean {:8.1f}  p50 <{:g}  "
+                         "p95 <{:g}  max {:.1f} ms".format(
+                             name, h["n"], h["mean"], h["p50"], h["p95"],
+                             h["max"]))
+        return "\n".join(lines)
+
+    def close(self, timeout=None):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
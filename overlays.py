@@ -0,0 +1,115 @@
+# Pre-rendered camera overlays.
+#
+# Countdown digits and prompt texts are drawn once into buffers padded to
+# the size the firmware expects (width multiple of 32, height multiple of
+# 16). Showing one is then a single renderer.update() on an existing
+# overlay instead of allocating an image, loading a font and rebuilding the
+# renderer on every tick. With double=True two renderers are used: the
+# hidden one is updated and then made visible, so a frame is never shown
+# half written.
+
+import time
+import collections
+from PIL import Image, ImageDraw, ImageFont
+
+
+def pad(size):
+    # the firmware's buffers: width a multiple of 32, height of 16
+    w, h = size
+    return ((w + 31) // 32 * 32, (h + 15) // 16 * 16)
+
+
+class OverlayPool():
+    def __init__(self, camera, size, font=None,
+                 font_path='Pillow/Tests/fonts/FreeMonoBold.ttf',
+                 mode="RGBA", background=(255, 0, 0, 0),
+                 layer=3, alpha=128, double=False):
+        self.camera = camera
+        self.size = size
+        self.padded = pad(size)
+        if font is None:
+            fonts = {}
+
+            def font(size):
+                if size not in fonts:
+                    fonts[size] = ImageFont.truetype(font_path, size)
+                return fonts[size]
+        self.font = font
+        self.mode = mode
+        self.background = background
+        self.layer = layer
+        self.alpha = alpha
+        self.double = double
+        self.frames = {}
+        self.renderers = []
+        self.visible = None
+        self.tick_times = collections.deque(maxlen=100)
+        self.blank = self.render_blank()
+
+    def render_blank(self):
+        background = self.background
+        if self.mode == "RGBA":
+            background = background[:3] + (0,)
+        return Image.new(self.mode, self.padded, background).tobytes()
+
+    def render(self, xcoord, ycoord, font_size, text, color):
+        img = Image.new(self.mode, self.padded, self.background)
+        draw = ImageDraw.Draw(img)
+        draw.text((xcoord, ycoord), text, color, font=self.font(font_size))
+        return img.tobytes()
+
+    def add(self, xcoord, ycoord, font_size, text, color=(32, 178, 170, 210)):
+        key = (xcoord, ycoord, font_size, text, color)
+        if key not in self.frames:
+            self.frames[key] = self.render(*key)
+        return key
+
+    def _renderer(self, buf):
+        renderer = self.camera.add_overlay(buf,
+                                           layer=self.layer,
+                                           size=self.padded,
+                                           format=self.mode.lower(),
+                                           alpha=self.alpha)
+        self.renderers.append(renderer)
+        return renderer
+
+    def show(self, xcoord, ycoord, font_size, text, color=(32, 178, 170, 210)):
+        t0 = time.perf_counter()
+        buf = self.frames[self.add(xcoord, ycoord, font_size, text, color)]
+        self.swap(buf)
+        self.tick_times.append(time.perf_counter() - t0)
+
+    def swap(self, buf):
+        if not self.renderers:
+            self.visible = self._renderer(buf)
+            if self.double:
+                back = self._renderer(self.blank)
+                back.alpha = 0
+            return
+        if not self.double:
+            self.visible.update(buf)
+            self.visible.alpha = self.alpha
+            return
+        back = [r for r in self.renderers if r is not self.visible][0]
+        back.update(buf)
+        back.alpha = self.alpha
+        self.visible.alpha = 0
+        self.visible = back
+
+    def hide(self):
+        # keep the renderers around, just make them transparent
+        for renderer in self.renderers:
+            renderer.alpha = 0
+
+    def close(self):
+        for renderer in self.renderers:
+            self.camera.remove_overlay(renderer)
+        self.renderers = []
+        self.visible = None
+
+    def stats(self):
+        times = sorted(self.tick_times)
+        return {"frames": len(self.frames),
+                "ticks": len(times),
+                "tick_ms_median": 1000 * times[len(times) // 2] if times else 0.0,
+                "tick_ms_max": 1000 * times[-1] if times else 0.0}
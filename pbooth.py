@@ -6,22 +6,26 @@
 # the 3 images with a template fourth image "4logo.png" in a grid. The final
 # image is then sent to the printer using the CUPs API.
 
-import picamera
 import itertools
-import cups
-import subprocess
 import os
-from shutil import copyfile
 import sys
 import time
 import logging
-import RPi.GPIO as GPIO
-from PIL import Image, ImageDraw, ImageFont
+from compositor import Montage, load_images
+from buttons import ButtonInput
+from overlays import OverlayPool
+from printing import PrintSpooler
+from hardware import pi_backends
+from archive import Archive
+from logqueue import init_logging, stop_logging
+from timeline import Timeline, capture_sequence
+from staging import Staging, default_root
 
 IMG1             = "1.jpg"
 IMG2             = "2.jpg"
 IMG3             = "3.jpg"
 IMG4             = "4.jpg"
+IMAGES           = [IMG1, IMG2, IMG3, IMG4]
 CurrentWorkingDir= "/home/pi/boothy/"
 logDir           = "logs"
 archiveDir       = "photos"
@@ -32,34 +36,34 @@ IMAGE_HEIGHT     = 480
 BUTTON_PIN       = 26
 LED_PIN          = 19 #connected to external 12v.
 PHOTO_DELAY      = 2
-overlay_renderer = None
-buttonEvent      = False
-
-#setup GPIOs
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-# GPIO.setup(LED_PIN, GPIO.OUT)
+FONT_PATH        = "/usr/share/fonts/truetype/freefont/FreeSerif.ttf"
+PRINT_MONTAGE    = Montage((2,4),(4,4),repeat=2)
+overlays         = None
+spooler          = None
+archive          = None
+staging          = None
+workDir          = "."
+
+backends         = None
+GPIO             = None
+buttons          = None
 
 #print the image
 def printPic(fileName):
+    global spooler
     addPreviewOverlay(100,200,55,"printing...")
-    conn = cups.Connection()
-    printers = conn.getPrinters()
-    default_printer = printers.keys()[0]
-    cups.setUser('pi')
-    conn.printFile (default_printer, fileName, "boothy", {'fit-to-page':'True'})
-    logging.info("Print job successfully created.");
+    #the spooler keeps the CUPS connection and uses the first printer found
+    if spooler is None:
+        spooler = PrintSpooler(printer=None, logger=logging.getLogger())
+    spooler.submit(fileName)
+    logging.info("Print job successfully queued.");
 
 #merges the 4 images
 def convertMergeImages(fileName):
     addPreviewOverlay(150,200,55,"merging images...")
-    #now merge all the images
-    subprocess.call(["montage",
-                     IMG1,IMG1,IMG2,IMG2,
-                     IMG3,IMG3,IMG4,IMG4,
-                     "-tile", "2x4",
-                     "-geometry", "+4+4",
-                     fileName])
+    #now merge all the images (same layout as montage -tile 2x4 -geometry +4+4)
+    imgs = load_images([workPath(name) for name in IMAGES])
+    PRINT_MONTAGE.render(imgs).save(workPath(fileName), "JPEG", quality=92)
     logging.info("Images have been merged.")
 
 def deleteImages(fileName):
@@ -73,51 +77,67 @@ def deleteImages(fileName):
     if os.path.isfile(fileName):
         os.remove(fileName);
 
+#captures and strips are written in RAM when /dev/shm is there
+def workPath(fileName):
+    return os.path.join(workDir, fileName)
+
+def initStaging():
+    global staging, workDir
+    root = default_root(CurrentWorkingDir)
+    if root is None:
+        return
+    staging = Staging(root, logger=logging.getLogger())
+    #strips a crash left behind are flushed to photos/ first
+    staging.recover()
+    workDir = staging.workdir(time.strftime("pbooth-%Y%m%d-%H%M%S")) or "."
+
 def cleanUp():
     GPIO.cleanup()
 
 def archiveImage(fileName):
+    global archive
     logging.info("Saving off image: "+fileName)
-    copyfile(fileName,archiveDir+"/"+fileName)
-
-def countdownFrom(secondsStr):
-    secondsNum = int(secondsStr)
-    if secondsNum >= 0 :
-        while secondsNum > 0 :
-            addPreviewOverlay(300,100,240,str(secondsNum))
-            time.sleep(1)
-            secondsNum=secondsNum-1
+    if staging is not None and workDir != ".":
+        #written once to the SD card, the index reads it right away
+        try:
+            staging.keep(workPath(fileName), archiveDir+"/"+fileName,
+                         wait=True)
+        except OSError:
+            #still in RAM with its note, the next start flushes it again
+            logging.error("Strip not archived: "+fileName, exc_info=True)
+            return
+        os.remove(workPath(fileName))
+    else:
+        #moved, not copied: the strip is not written a second time
+        os.replace(fileName, archiveDir+"/"+fileName)
+    #index it, the thumbnail is made in the background
+    if archive is None:
+        archive = Archive(archiveDir, logger=logging.getLogger())
+        archive.scan()
+    archive.add(os.path.splitext(fileName)[0], archiveDir+"/"+fileName,
+                layout=PRINT_MONTAGE.describe())
 
 def captureImage(imageName):
     addPreviewOverlay(150,200,100,"smile!   :)")
     #save image
-    camera.capture(imageName, resize=(IMAGE_WIDTH, IMAGE_HEIGHT))
+    camera.capture(workPath(imageName), resize=(IMAGE_WIDTH, IMAGE_HEIGHT))
     logging.info("Image "+imageName+" captured.")
 
+def initOverlays(camera):
+    global overlays
+    #render every overlay once, ticks then only update the renderer
+    overlays = OverlayPool(camera, (SCREEN_WIDTH, SCREEN_HEIGHT),
+                           font_path=FONT_PATH, mode="RGB",
+                           background=(0, 0, 0))
+    for secondsNum in range(1, PHOTO_DELAY+1):
+        overlays.add(300,100,240,str(secondsNum),(255, 20, 147))
+    overlays.add(150,200,100,"smile!   :)",(255, 20, 147))
+    overlays.add(150,200,55,"merging images...",(255, 20, 147))
+    overlays.add(100,200,55,"printing...",(255, 20, 147))
+    overlays.add(20,200,55,"Press red button to begin!",(255, 20, 147))
+
 def addPreviewOverlay(xcoord,ycoord,fontSize,overlayText):
-    global overlay_renderer
-    img = Image.new("RGB", (SCREEN_WIDTH, SCREEN_HEIGHT))
-    draw = ImageDraw.Draw(img)
-    draw.font = ImageFont.truetype(
-                    "/usr/share/fonts/truetype/freefont/FreeSerif.ttf",fontSize)
-    draw.text((xcoord,ycoord), overlayText, (255, 20, 147))
-
-    if not overlay_renderer:
-        # Note: The call to add_overlay has changed since picamera v.1.10.
-        # If you have a new version of picamera, then please change the
-        # first parameter to:  img.tobytes()
-        #
-        overlay_renderer = camera.add_overlay(img.tobytes(),
-                                              layer=3,
-                                              size=img.size,
-                                              alpha=128);
-    else:
-        camera.remove_overlay(overlay_renderer)
-        overlay_renderer = camera.add_overlay(img.tobytes(),
-                                              layer=3,
-                                              size=img.size,
-                                              alpha=128);
-        # overlay_renderer.update(img.tobytes()) # generate error
+    overlays.show(xcoord,ycoord,fontSize,overlayText,(255, 20, 147))
 
 #run a full series
 def play():
@@ -129,33 +149,21 @@ def play():
     #turn on flash
     # GPIO.output(LED_PIN,GPIO.HIGH)
 
-    countdownFrom(PHOTO_DELAY)
-    captureImage(IMG1)
-    time.sleep(1)
-
-    countdownFrom(PHOTO_DELAY)
-    captureImage(IMG2)
-    time.sleep(1)
-
-    countdownFrom(PHOTO_DELAY)
-    captureImage(IMG3)
-    time.sleep(1)
-
-    countdownFrom(PHOTO_DELAY)
-    captureImage(IMG4)
-    time.sleep(1)
-
+    #every tick, shot and pause is a deadline from now, a slow capture
+    #does not push the next countdowns back
+    timeline = Timeline(logger=logging.getLogger())
+    end = capture_sequence(timeline, 4, PHOTO_DELAY, 1,
+                           lambda shot, s: addPreviewOverlay(300,100,240,str(s)),
+                           lambda shot: captureImage(IMAGES[shot-1]))
+    timeline.at(end, "merge", convertMergeImages, fileName)
+    # printPic(fileName)
+    timeline.at(end+16, "archive", archiveImage, fileName)
+    timeline.run()
+    logging.debug(timeline.report())
 
     #turn off flash
     # GPIO.output(LED_PIN,GPIO.LOW)
 
-    convertMergeImages(fileName)
-    time.sleep(1)
-
-    # printPic(fileName)
-    time.sleep(15)
-
-    archiveImage(fileName)
     # deleteImages(fileName) # useless
 
 def initCamera(camera):
@@ -181,26 +189,8 @@ def initCamera(camera):
     camera.crop                  = (0.0, 0.0, 1.0, 1.0)
 
 def initLogger(output_dir):
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    # create console handler and set level to info
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    # create error file handler and set level to error
-    handler = logging.FileHandler(output_dir+"/"+time.strftime("%Y%m%d")+"_error.log","w", encoding=None, delay="true")
-    handler.setLevel(logging.ERROR)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    # create debug file handler and set level to debug
-    handler = logging.FileHandler(output_dir+"/"+time.strftime("%Y%m%d")+"_debug.log","w", encoding=None, delay="true")
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    #the root logger, written by a background thread to rotating files
+    init_logging(None, output_dir, prefix="pbooth")
 
 def onButtonPress():
     logging.info("Big red button pressed!")
@@ -212,37 +202,49 @@ def onButtonDePress():
     logging.info("Big red button de-pressed!")
 
 #start flow
-with picamera.PiCamera() as camera:
-    os.chdir(CurrentWorkingDir)
-
-    try:
-        initLogger(logDir)
-        initCamera(camera)
-        # GPIO.output(LED_PIN,GPIO.LOW)
-        logging.info("Starting preview")
-        camera.start_preview()
-
-        addPreviewOverlay(20,200,55,"Press red button to begin!")
-
-        logging.info("Starting application loop")
-        while True:
-            input_state = GPIO.input(BUTTON_PIN)
-            if input_state == False :
-                input_state = 1
-                if buttonEvent == False :
-                    buttonEvent = True
+if __name__ == "__main__":
+    #hardware is only touched when run as a script
+    backends = pi_backends()
+    GPIO = backends.gpio
+    #setup GPIOs, button edges are delivered through a queue
+    buttons = ButtonInput(GPIO, {"red": BUTTON_PIN})
+    # GPIO.setup(LED_PIN, GPIO.OUT)
+
+    with backends.camera() as camera:
+        os.chdir(CurrentWorkingDir)
+
+        try:
+            initLogger(logDir)
+            initStaging()
+            initCamera(camera)
+            initOverlays(camera)
+            # GPIO.output(LED_PIN,GPIO.LOW)
+            logging.info("Starting preview")
+            camera.start_preview()
+
+            addPreviewOverlay(20,200,55,"Press red button to begin!")
+
+            logging.info("Starting application loop")
+            while True:
+                event = buttons.wait()
+                if event.pressed :
                     onButtonPress()
-            else :
-                if buttonEvent == True :
-                    buttonEvent = False
+                    #ignore presses made during the play sequence
+                    buttons.flush()
+                else :
                     onButtonDePress()
-    except BaseException:
-        logging.error("Unhandled exception : " , exc_info=True)
-        camera.close()
-        cleanUp()
-    finally:
-        logging.info("quitting...")
-        cleanUp()
-        camera.close()
+        except BaseException:
+            logging.error("Unhandled exception : " , exc_info=True)
+            camera.close()
+            cleanUp()
+        finally:
+            logging.info("quitting...")
+            cleanUp()
+            camera.close()
+            if staging is not None:
+                if workDir != ".":
+                    staging.drop(workDir)
+                staging.close(timeout=5)
+            stop_logging(None)
 
 #end
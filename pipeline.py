@@ -0,0 +1,376 @@
+# Background session pipeline.
+#
+# Once the four shots are taken a Session is handed to the pipeline and the
+# booth is free for the next guest. Each stage has its own worker thread
+# and a bounded queue, so a slow printer or uplink only backs up its own
+# stage (and eventually applies back-pressure) instead of holding the
+# screen:
+#
+#   compose -> (review decision) -> print -> archive -> upload
+#                                                         -> animate
+#
+# (animate only with an animator, see animation.py)
+#
+# Every session works in its own directory, sessions/<name>/, keyed by the
+# timestamp name, so consecutive sessions never overwrite each other's
+# files. The raw captures stay there once the session is done.
+#
+# With a staging area (staging.py) the session writes to a RAM directory
+# instead; the archive stage has the files worth keeping (the captures,
+# photos/ and toprint/) flushed to their places in one batch, and the RAM
+# directory goes once both the pipeline and the printer are done with it.
+
+import os
+import time
+import queue
+import threading
+import contextlib
+
+
+class Session():
+    def __init__(self, name, wd=".", work=None):
+        # work: the directory the session writes to, when it is not its
+        # final one (a staging.Staging workdir)
+        self.name = name
+        self.dir = os.path.join(wd, "sessions", name)
+        self.work = work or self.dir
+        self.staged = self.work != self.dir
+        self.photo_path = os.path.join(wd, "photos", name + ".jpg")
+        self.toprint_path = os.path.join(wd, "toprint", name + ".jpg")
+        self.preview_path = os.path.join(self.work, "preview.jpg")
+        self.strip_path = self.toprint_path
+        if self.staged:
+            self.strip_path = os.path.join(self.work, "toprint.jpg")
+        for path in [self.work, os.path.dirname(self.photo_path),
+                     os.path.dirname(self.toprint_path)]:
+            os.makedirs(path, exist_ok=True)
+        self.captures = []
+        self.captured_at = []
+        self.review = None
+        self.preview = None
+        self.print_requested = None
+        # time.monotonic() of the guest's choice on the review screen
+        self.decided_at = None
+        # print-ready file made during the review, None until then
+        self.print_path = None
+        self.composed = False
+        self.decision = threading.Lock()
+        self.print_job = None
+        # "pipeline", "print": who is done with the working directory
+        self.finished = set()
+        self.error = None
+        # the stage that failed, once the pipeline gave up on the session
+        self.failed_stage = None
+        self.done = threading.Event()
+        # called from the pipeline threads
+        self.on_preview = None
+        self.on_print = None
+        # on_error(session, stage), when a stage failed
+        self.on_error = None
+
+    def release(self):
+        # the pipeline is done with the images; a print job still queued
+        # keeps the session, not its captures
+        self.captures = []
+        self.review = None
+        self.preview = None
+
+    def capture_path(self, i):
+        return os.path.join(self.work, "{}.jpg".format(i))
+
+    def kept_captures(self):
+        return [(self.capture_path(i), os.path.join(self.dir,
+                                                    "{}.jpg".format(i)))
+                for i in range(1, len(self.captured_at) + 1)]
+
+    def kept(self):
+        # [(working file, final path)] of the files that outlive the session
+        pairs = self.kept_captures()
+        pairs.append((self.preview_path, self.photo_path))
+        pairs.append((self.strip_path, self.toprint_path))
+        return [(src, dst) for src, dst in pairs if os.path.exists(src)]
+
+    def notify(self, callback, *args):
+        if callback is not None:
+            callback(self, *args)
+
+
+class Stage():
+    def __init__(self, name, fn, maxsize=4, logger=None):
+        self.name = name
+        self.fn = fn
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.processed = 0
+        self.failed = 0
+        self.pipeline = None
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="stage-" + name)
+
+    def start(self, pipeline):
+        self.pipeline = pipeline
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            session = self.queue.get()
+            if session is None:
+                return
+            try:
+                with self.pipeline.span("stage." + self.name, session.name):
+                    following = self.fn(session)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                session.error = "{}: {}".format(self.name, e)
+                if self.logger is not None:
+                    self.logger.error("session {} failed in {}".format(
+                        session.name, self.name), exc_info=True)
+                following = None
+                session.done.set()
+                self.pipeline.failed(session, self.name)
+            if following is not None:
+                self.pipeline.put(following, session)
+
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+
+class Pipeline():
+    def __init__(self, logger=None, metrics=None):
+        self.logger = logger
+        self.metrics = metrics
+        self.stages = {}
+        self.order = []
+
+    def span(self, name, session=None, **fields):
+        if self.metrics is None:
+            return contextlib.nullcontext()
+        return self.metrics.span(name, session, **fields)
+
+    def record(self, name, session, seconds):
+        if self.metrics is not None:
+            self.metrics.record(name, 1000 * seconds, session.name)
+
+    def failed(self, session, stage):
+        # the session goes no further
+        with session.decision:
+            session.failed_stage = stage
+        session.notify(session.on_error, stage)
+
+    def add(self, name, fn, maxsize=4):
+        # fn(session) returns the name of the next stage, or None
+        self.stages[name] = Stage(name, fn, maxsize, self.logger)
+        self.order.append(name)
+
+    def start(self):
+        for name in self.order:
+            self.stages[name].start(self)
+
+    def put(self, stage, session, timeout=None):
+        # blocks while the stage queue is full (back-pressure)
+        self.stages[stage].queue.put(session, timeout=timeout)
+
+    def depth(self):
+        return {name: self.stages[name].queue.qsize() for name in self.order}
+
+    def stats(self):
+        return {name: {"queued": self.stages[name].queue.qsize(),
+                       "processed": self.stages[name].processed,
+                       "failed": self.stages[name].failed}
+                for name in self.order}
+
+    def close(self, timeout=None):
+        for name in self.order:
+            self.stages[name].stop(timeout)
+
+
+class BoothPipeline(Pipeline):
+    # the booth's stages: compositor, print spooler, photos/ archive and
+    # upload worker
+    def __init__(self, compositor, spooler, uploader, logger=None,
+                 maxsize=4, metrics=None, review_size=(800, 480), index=None,
+                 animator=None, photo_filter=None, print_profile=None,
+                 staging=None):
+        Pipeline.__init__(self, logger, metrics)
+        self.compositor = compositor
+        # staging.Staging of the sessions with a RAM working directory
+        self.staging = staging
+        # filters.Filter applied to the captures before composition,
+        # optional
+        self.photo_filter = photo_filter
+        # prepress.PrintProfile: print-ready files made before the guest
+        # chose to print, optional
+        self.print_profile = print_profile
+        # archive index (archive.Archive), optional
+        self.index = index
+        self.review_size = review_size
+        self.spooler = spooler
+        self.uploader = uploader
+        self.add("compose", self.compose, maxsize)
+        self.add("print", self.print_strip, maxsize)
+        self.add("archive", self.archive, maxsize)
+        self.add("upload", self.upload, maxsize)
+        self.animator = animator
+        if animator is not None:
+            self.add("animate", self.animate, maxsize)
+        self.start()
+
+    def compose(self, session):
+        # the raw captures are already on disk, the montages and the
+        # animation use the filtered ones
+        if self.photo_filter is not None:
+            with self.span("filter", session.name,
+                           filter=self.photo_filter.name):
+                session.captures = self.photo_filter.apply(session.captures)
+        # the screen-sized review first: it is what the guest is waiting for
+        with self.span("montage.review", session.name):
+            session.review = self.compositor.review(session.captures,
+                                                    self.review_size)
+        session.notify(session.on_preview)
+        with self.span("montage.preview", session.name):
+            session.preview = self.compositor.show_preview(
+                session.captures, session.preview_path)
+        with self.span("montage.strip", session.name):
+            strip = self.compositor.print_strip(session.captures,
+                                                session.strip_path)
+        # speculatively, unless the guest already said no
+        if self.print_profile is not None and session.print_requested \
+                is not False:
+            with self.span("prepress", session.name,
+                           profile=self.print_profile.name):
+                session.print_path = self.print_profile.prepare(
+                    strip, self.print_profile.path(session.work))
+        # the session moves on once composed and reviewed, whichever
+        # comes last
+        with session.decision:
+            session.composed = True
+            if session.print_requested is None:
+                return None
+        return "print" if session.print_requested else "archive"
+
+    def decide(self, session, print_requested, decided_at=None):
+        # called from the UI on the review screen
+        with session.decision:
+            session.print_requested = print_requested
+            session.decided_at = decided_at or time.monotonic()
+            stage = session.failed_stage
+            if stage is None and not session.composed:
+                return
+        if stage is not None:
+            # failed after the review screen came: the print screen must
+            # not wait for a print that will never come
+            session.notify(session.on_error, stage)
+            return
+        self.put("print" if print_requested else "archive", session)
+
+    def print_strip(self, session):
+        # from submission to the printer being done with the strip
+        span = self.span("print", session.name)
+
+        def changed(job):
+            # from the green press to the job reaching CUPS, and to the
+            # printer starting on it
+            if job.state in ("submitted", "printing") and \
+                    job.state not in reported:
+                reported.add(job.state)
+                self.record("print." + job.state, session,
+                            time.monotonic() - session.decided_at)
+            if job.finished_at is not None:
+                if self.metrics is not None:
+                    span.end(state=job.state, error=job.error,
+                             attempts=job.attempts)
+                if self.index is not None:
+                    self.index.printed(session.name, job.state, job.error)
+                if session.print_path is not None:
+                    # the printer is done with it, the strip in toprint/
+                    # stays
+                    with contextlib.suppress(OSError):
+                        os.remove(session.print_path)
+                    session.print_path = None
+                self.finish(session, "print")
+            session.notify(session.on_print, job)
+        reported = set()
+        if self.index is not None:
+            self.index.printed(session.name, "queued")
+        if session.print_path is not None:
+            session.print_job = self.spooler.submit(
+                session.print_path, callback=changed,
+                options=self.print_profile.options())
+        else:
+            session.print_job = self.spooler.submit(session.strip_path,
+                                                    callback=changed)
+        return "archive"
+
+    def archive(self, session):
+        if session.staged:
+            # one batch, waited for: the index and the uploader read them
+            with self.span("staging.flush", session.name):
+                self.staging.keep_all(session.kept(), wait=True)
+        else:
+            os.replace(session.preview_path, session.photo_path)
+        if not session.print_requested and session.print_path is not None:
+            # not printed after all, the strip in toprint/ stays
+            os.remove(session.print_path)
+            session.print_path = None
+        if self.index is not None:
+            self.index.add(
+                session.name, session.photo_path,
+                toprint_path=session.toprint_path,
+                captures=session.captured_at,
+                layout=self.compositor.print_montage.describe(),
+                print_state=None if session.print_requested else "skipped")
+        return "upload"
+
+    def upload(self, session):
+        self.uploader.enqueue(session.photo_path)
+        session.done.set()
+        if self.animator is not None:
+            return "animate"
+        session.release()
+        self.finish(session, "pipeline")
+        return None
+
+    def animate(self, session):
+        # waits on the animator's process pool; the booth does not
+        try:
+            path = self.animator.make(session.captures,
+                                      self.animator.path(session.photo_path))
+        finally:
+            session.release()
+            self.finish(session, "pipeline")
+        if self.index is not None:
+            self.index.update(session.name, animation_path=path)
+        self.uploader.enqueue(path)
+        return None
+
+    def finish(self, session, part):
+        # part: "pipeline" or "print"; the working directory is dropped
+        # once neither needs it anymore
+        with session.decision:
+            if part in session.finished:
+                return
+            session.finished.add(part)
+            if "pipeline" not in session.finished or (
+                    session.print_requested and
+                    "print" not in session.finished):
+                return
+        if session.staged:
+            self.staging.drop(session.work)
+
+    def failed(self, session, stage):
+        # the raw captures are still kept, and the session lets go of its
+        # images and working directory
+        try:
+            if session.staged and stage in ("compose", "print"):
+                self.staging.keep_all([(src, dst) for src, dst in
+                                       session.kept_captures()
+                                       if os.path.exists(src)])
+            session.release()
+            # no print job coming either (compose or print failed)
+            if session.print_job is None:
+                self.finish(session, "print")
+            self.finish(session, "pipeline")
+        finally:
+            Pipeline.failed(self, session, stage)
@@ -0,0 +1,109 @@
+# Print-ready files, made while the guest is still on the review screen.
+#
+# CUPS used to receive the strip as a JPEG of whatever size the montage
+# had, with fit-to-page: after the green press it still had to decode it,
+# scale it to the paper and convert the colours before the Selphy could
+# start. A PrintProfile does that work ahead of time, in the compose stage:
+# the strip is turned to the paper's orientation, resized to the exact
+# device pixels of the paper at the printer's DPI, converted to the
+# printer's ICC profile when one is given, and written either as a JPEG or
+# (raster=True) as an uncompressed PPM, pixels CUPS only has to pass on.
+# Pressing green is then only a submit of that file; pressing red deletes
+# it.
+
+import os
+from PIL import Image
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
+
+UNITS = {"in": 1.0, "mm": 25.4}
+
+# name: PrintProfile arguments
+PROFILES = {
+    # Selphy CP1300 postcard (KP-108IN / RP-108)
+    "postcard": {"paper": (100, 148), "units": "mm", "dpi": 300},
+    "4x6": {"paper": (4, 6), "units": "in", "dpi": 300},
+}
+
+
+class PrintProfile():
+    def __init__(self, paper=(100, 148), units="mm", dpi=300, fit="contain",
+                 icc_profile=None, intent=0, raster=False, quality=95,
+                 background="white", name="custom"):
+        # paper: (width, height) in `units`; fit: "contain" (white margins)
+        # or "cover" (cropped, borderless); intent: ICC rendering intent,
+        # 0 = perceptual
+        self.name = name
+        self.dpi = dpi
+        self.size = tuple(int(round(v * dpi / UNITS[units])) for v in paper)
+        self.fit = fit
+        self.raster = raster
+        self.quality = quality
+        self.background = background
+        self.transform = None
+        if icc_profile is not None:
+            if ImageCms is None:
+                raise ValueError("ICC profiles need Pillow with littlecms")
+            # built once, the profiles are parsed here and not per print
+            self.transform = ImageCms.buildTransform(
+                ImageCms.createProfile("sRGB"),
+                ImageCms.getOpenProfile(icc_profile), "RGB", "RGB",
+                renderingIntent=intent)
+
+    def path(self, session_dir):
+        return os.path.join(session_dir,
+                            "print." + ("ppm" if self.raster else "jpg"))
+
+    def options(self):
+        # the file already has the paper's pixels, CUPS must not scale it
+        return {"print-scaling": "none"}
+
+    def render(self, img):
+        w, h = self.size
+        iw, ih = img.size
+        # landscape strip on portrait paper (or the other way): turned
+        if (iw > ih) != (w > h) and iw != ih:
+            img = img.transpose(Image.ROTATE_90)
+            iw, ih = img.size
+        if self.fit == "cover":
+            ratio = max(w / iw, h / ih)
+        else:
+            ratio = min(w / iw, h / ih)
+        # the part of the image that lands on the paper, in source pixels
+        cw, ch = (min(iw, w / ratio), min(ih, h / ratio))
+        box = ((iw - cw) / 2, (ih - ch) / 2, (iw + cw) / 2, (ih + ch) / 2)
+        size = (min(w, int(round(iw * ratio))), min(h, int(round(ih * ratio))))
+        img = img.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
+        if size != self.size:
+            page = Image.new("RGB", self.size, self.background)
+            page.paste(img, ((w - size[0]) // 2, (h - size[1]) // 2))
+            img = page
+        if self.transform is not None:
+            img = ImageCms.applyTransform(img, self.transform)
+        return img
+
+    def prepare(self, img, path):
+        img = self.render(img.convert("RGB"))
+        tmp = path + ".tmp"
+        if self.raster:
+            img.save(tmp, "PPM")
+        else:
+            img.save(tmp, "JPEG", quality=self.quality,
+                     dpi=(self.dpi, self.dpi))
+        os.replace(tmp, path)
+        return path
+
+
+def get_profile(profile):
+    # a PROFILES name, a dict of PrintProfile arguments or a PrintProfile
+    if profile is None or isinstance(profile, PrintProfile):
+        return profile
+    if isinstance(profile, str):
+        if profile not in PROFILES:
+            raise ValueError("unknown print profile {!r}, one of: {}".format(
+                profile, ", ".join(sorted(PROFILES))))
+        return PrintProfile(name=profile, **PROFILES[profile])
+    return PrintProfile(**profile)
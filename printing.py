@@ -0,0 +1,379 @@
+# Background print spooler.
+#
+# A single thread owns the CUPS connection: it keeps it open between jobs,
+# caches printer discovery, submits queued jobs one after the other and
+# polls their state until CUPS reports them completed. When the printer
+# stops on an error (paper or ink out, jammed...) it tells the caller,
+# waits, re-enables the printer and carries on; aborted jobs are submitted
+# again. Callers get a PrintJob they can wait on or a callback run when the
+# print really finished.
+
+import time
+import queue
+import threading
+
+# IPP job states
+JOB_PENDING = 3
+JOB_HELD = 4
+JOB_PROCESSING = 5
+JOB_STOPPED = 6
+JOB_CANCELED = 7
+JOB_ABORTED = 8
+JOB_COMPLETED = 9
+# IPP printer states
+PRINTER_IDLE = 3
+PRINTER_PROCESSING = 4
+PRINTER_STOPPED = 5
+# IPP status of a request about a job or printer CUPS does not know
+IPP_NOT_FOUND = 0x0406
+
+
+class PrintJob():
+    def __init__(self, path, title="boothy", options=None, callback=None):
+        self.path = path
+        self.title = title
+        self.options = options or {'fit-to-page': 'True'}
+        self.callback = callback
+        self.state = "queued"
+        self.error = None
+        self.job_id = None
+        self.attempts = 0
+        self.submitted_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def succeeded(self):
+        return self.state == "done"
+
+
+class PrintSpooler():
+    def __init__(self, cups_module=None, printer="Canon_SELPHY_CP1300",
+                 user="pi", poll_interval=1.0, retry_interval=10.0,
+                 max_attempts=3, discovery_ttl=60.0, logger=None):
+        self.cups = cups_module
+        self.printer = printer
+        self.user = user
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.discovery_ttl = discovery_ttl
+        self.logger = logger
+        self.conn = None
+        self.connections = 0
+        self._printers = None
+        self._discovered_at = 0
+        self.jobs = queue.Queue()
+        self.current = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def submit(self, path, callback=None, title="boothy", options=None):
+        job = PrintJob(path, title, options, callback)
+        self.jobs.put(job)
+        return job
+
+    def pending(self):
+        # queued and being printed
+        return self.jobs.unfinished_tasks
+
+    def drain(self, timeout=None):
+        # waits until every job submitted so far is done, False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            self._stop.wait(0.05)
+        return True
+
+    def connection(self):
+        if self.conn is None:
+            if self.cups is None:
+                import cups
+                self.cups = cups
+            self.cups.setUser(self.user)
+            self.conn = self.cups.Connection()
+            self.connections += 1
+            self._printers = None
+        return self.conn
+
+    def disconnect(self):
+        self.conn = None
+        self._printers = None
+
+    def printers(self, refresh=False):
+        now = time.monotonic()
+        if (refresh or self._printers is None
+                or now - self._discovered_at > self.discovery_ttl):
+            self._printers = self.connection().getPrinters()
+            self._discovered_at = now
+        return self._printers
+
+    def find_printer(self):
+        printers = self.printers()
+        if self.printer not in printers and (self.printer or not printers):
+            printers = self.printers(refresh=True)
+        if self.printer in printers:
+            return self.printer
+        if self.printer is None and printers:
+            return list(printers.keys())[0]
+        return None
+
+    def printer_error(self, name):
+        # reasons ending with "-error" stop the printer (media-empty-error,
+        # marker-supply-empty-error...), warnings/reports do not
+        attrs = self.connection().getPrinterAttributes(
+            name, requested_attributes=["printer-state",
+                                        "printer-state-reasons"])
+        reasons = [r for r in attrs.get("printer-state-reasons", [])
+                   if r.endswith("-error")]
+        if reasons or attrs.get("printer-state") == PRINTER_STOPPED:
+            return ", ".join(reasons) or "printer stopped"
+        return None
+
+    def notify(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        if job.callback is not None:
+            try:
+                job.callback(job)
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error("print callback failed", exc_info=True)
+
+    def finish(self, job, state, error=None):
+        job.finished_at = time.monotonic()
+        self.notify(job, state, error)
+        job.done.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job is None:
+                self.jobs.task_done()
+                break
+            self.current = job
+            try:
+                self.process(job)
+            finally:
+                self.current = None
+                self.jobs.task_done()
+
+    def process(self, job):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                name = self.find_printer()
+                if name is None:
+                    self.log("Printer not found ! ")
+                    self.finish(job, "failed", "printer not found")
+                    return
+                if job.job_id is None:
+                    job.attempts += 1
+                    job.job_id = self.connection().printFile(
+                        name, job.path, job.title, job.options)
+                    job.submitted_at = time.monotonic()
+                    self.log("print job {} submitted to {}".format(
+                        job.job_id, name))
+                    self.notify(job, "submitted")
+                if self.poll(job, name):
+                    return
+            except Exception as e:
+                # lost CUPS (restarted, IPP error): reconnect and resume, a
+                # few times; a file CUPS keeps refusing must not hold the
+                # jobs behind it
+                failures += 1
+                self.log("print error: {}".format(e))
+                self.disconnect()
+                if failures >= self.max_attempts:
+                    self.finish(job, "failed", str(e))
+                    return
+                if job.job_id is not None and self.unknown_job(e):
+                    # CUPS lost the job (restarted with its queue purged)
+                    job.job_id = None
+                self._stop.wait(self.retry_interval)
+
+    def unknown_job(self, e):
+        args = getattr(e, "args", ())
+        return bool(args) and args[0] == IPP_NOT_FOUND
+
+    def poll(self, job, name):
+        # returns True once the job reached a final state
+        while not self._stop.is_set():
+            attrs = self.connection().getJobAttributes(job.job_id)
+            state = attrs.get("job-state")
+            if state == JOB_COMPLETED:
+                self.log("print job {} completed".format(job.job_id))
+                self.finish(job, "done")
+                return True
+            if state in (JOB_CANCELED, JOB_ABORTED):
+                if job.attempts >= self.max_attempts:
+                    self.finish(job, "failed", "job {}".format(
+                        "canceled" if state == JOB_CANCELED else "aborted"))
+                    return True
+                self.log("print job {} aborted, retrying".format(job.job_id))
+                job.job_id = None
+                return False
+            error = self.printer_error(name)
+            if error is not None:
+                self.log("printer error: {}".format(error))
+                self.notify(job, "error", error)
+                self._stop.wait(self.retry_interval)
+                # CUPS disables the queue on backend errors
+                self.connection().enablePrinter(name)
+                continue
+            if state == JOB_PROCESSING and job.state != "printing":
+                self.notify(job, "printing")
+            self._stop.wait(self.poll_interval)
+        return True
+
+    def close(self, timeout=None):
+        self._stop.set()
+        self.jobs.put(None)
+        self._thread.join(timeout)
+
+
+class FakeCups():
+    # Stand-in for the pycups module. Jobs go pending -> processing ->
+    # completed over `print_time` seconds; out_of_paper() stops the printer
+    # until refill() and enablePrinter() are called, like a Selphy. While
+    # jam() lasts, the jobs it starts are aborted; restart() forgets every
+    # job, like cupsd restarted with its queue purged.
+    IPPError = RuntimeError
+
+    def __init__(self, printers=("Canon_SELPHY_CP1300",), print_time=0.5,
+                 start_delay=0.05):
+        self.print_time = print_time
+        self.start_delay = start_delay
+        self.user = None
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.printer_attrs = {
+            name: {"printer-state": PRINTER_IDLE,
+                   "printer-state-reasons": ["none"]}
+            for name in printers}
+        self.jobs = {}
+        self.next_id = 1
+        self.paper = True
+        self.jammed = False
+
+    def setUser(self, user):
+        self.user = user
+
+    def Connection(self):
+        self.connections += 1
+        return FakeCupsConnection(self)
+
+    def out_of_paper(self):
+        with self.lock:
+            self.paper = False
+
+    def refill(self):
+        with self.lock:
+            self.paper = True
+
+    def jam(self, jammed=True):
+        with self.lock:
+            self.jammed = jammed
+
+    def restart(self):
+        with self.lock:
+            self.jobs.clear()
+            for printer in self.printer_attrs.values():
+                printer["printer-state"] = PRINTER_IDLE
+                printer["printer-state-reasons"] = ["none"]
+
+    def advance(self):
+        # move jobs forward according to the clock
+        now = time.monotonic()
+        busy = None
+        for job_id in sorted(self.jobs):
+            job = self.jobs[job_id]
+            if job["job-state"] in (JOB_COMPLETED, JOB_CANCELED, JOB_ABORTED):
+                continue
+            printer = self.printer_attrs[job["printer"]]
+            if busy == job["printer"]:
+                continue
+            busy = job["printer"]
+            if printer["printer-state"] == PRINTER_STOPPED:
+                continue
+            if not self.paper:
+                printer["printer-state"] = PRINTER_STOPPED
+                printer["printer-state-reasons"] = ["media-empty-error"]
+                continue
+            if job["started"] is None:
+                if now - job["created"] >= self.start_delay:
+                    job["started"] = now
+                    job["job-state"] = JOB_PROCESSING
+                    printer["printer-state"] = PRINTER_PROCESSING
+            elif self.jammed:
+                job["job-state"] = JOB_ABORTED
+                printer["printer-state"] = PRINTER_IDLE
+            elif now - job["started"] >= self.print_time:
+                job["job-state"] = JOB_COMPLETED
+                printer["printer-state"] = PRINTER_IDLE
+                printer["printer-state-reasons"] = ["none"]
+
+
+class FakeCupsConnection():
+    def __init__(self, cups):
+        self.cups = cups
+
+    def getPrinters(self):
+        with self.cups.lock:
+            self.cups.advance()
+            return {name: dict(attrs)
+                    for name, attrs in self.cups.printer_attrs.items()}
+
+    def getPrinterAttributes(self, name=None, uri=None,
+                             requested_attributes=None):
+        with self.cups.lock:
+            self.cups.advance()
+            return dict(self.cups.printer_attrs[name])
+
+    def printFile(self, printer, filename, title, options):
+        with self.cups.lock:
+            if printer not in self.cups.printer_attrs:
+                raise self.cups.IPPError(IPP_NOT_FOUND,
+                                         "client-error-not-found")
+            job_id = self.cups.next_id
+            self.cups.next_id += 1
+            self.cups.jobs[job_id] = {"printer": printer,
+                                      "file": filename,
+                                      "title": title,
+                                      "options": dict(options),
+                                      "created": time.monotonic(),
+                                      "started": None,
+                                      "job-state": JOB_PENDING}
+            return job_id
+
+    def getJobAttributes(self, job_id):
+        with self.cups.lock:
+            self.cups.advance()
+            if job_id not in self.cups.jobs:
+                raise self.cups.IPPError(IPP_NOT_FOUND,
+                                         "client-error-not-found")
+            job = self.cups.jobs[job_id]
+            return {"job-id": job_id, "job-state": job["job-state"],
+                    "job-printer-uri": job["printer"]}
+
+    def enablePrinter(self, name):
+        with self.cups.lock:
+            printer = self.cups.printer_attrs[name]
+            if self.cups.paper:
+                printer["printer-state"] = PRINTER_IDLE
+                printer["printer-state-reasons"] = ["none"]
+
+    def cancelJob(self, job_id, purge_job=False):
+        with self.cups.lock:
+            self.cups.jobs[job_id]["job-state"] = JOB_CANCELED
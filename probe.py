@@ -0,0 +1,144 @@
+# Resource probe for long runs.
+#
+# The booth runs unattended for 8-12 hours; anything a cycle leaves behind
+# (Tk images, camera overlays, file descriptors, child processes never
+# waited on, Python objects) adds up. ResourceProbe samples the counters
+# that show such leaks, cheaply enough to run in production every few
+# sessions:
+#
+#   rss_kb      resident memory (/proc/self/statm)
+#   fds         open file descriptors (/proc/self/fd)
+#   children    child processes, zombies included
+#   zombies     children exited but never waited on
+#   threads     Python threads
+#   tk_images   images held by the display (Tk image names)
+#   overlays    camera overlays
+#   staged_kb   files in the RAM staging area (tmpfs is not in rss_kb)
+#   traced_kb   memory allocated by Python, when tracemalloc is on
+#
+# find_leaks() tells bounded from unbounded growth over a series of samples
+# (see soak.py): after a warm-up, the last third of the run must not go
+# past the middle third by more than a per-counter tolerance.
+
+import os
+import gc
+import time
+import threading
+import collections
+import tracemalloc
+
+# growth allowed between the middle and the last third of a run
+TOLERANCE = {"rss_kb": 4096, "traced_kb": 1024, "fds": 0, "children": 0,
+             "zombies": 0, "threads": 0, "tk_images": 0, "overlays": 0,
+             "staged_kb": 8192}
+
+
+def read_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        # peak, not current, off Linux
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def count_children():
+    # (children, zombies) from /proc, (None, None) without it
+    pid = os.getpid()
+    children = zombies = 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None, None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces, fields start after ")"
+        fields = stat[stat.rfind(")") + 2:].split()
+        if int(fields[1]) == pid:
+            children += 1
+            if fields[0] == "Z":
+                zombies += 1
+    return children, zombies
+
+
+class ResourceProbe():
+    def __init__(self, booth=None, history=100):
+        self.booth = booth
+        self.history = collections.deque(maxlen=history)
+        self.baseline = None
+
+    def sample(self, **fields):
+        children, zombies = count_children()
+        sample = collections.OrderedDict([
+            ("t", round(time.time(), 3)),
+            ("rss_kb", read_rss_kb()),
+            ("fds", count_fds()),
+            ("children", children),
+            ("zombies", zombies),
+            ("threads", threading.active_count())])
+        booth = self.booth
+        if booth is not None:
+            sample["tk_images"] = booth.backends.display.image_count(
+                booth.root)
+            sample["overlays"] = len(getattr(booth.camera, "overlays", ()))
+            if getattr(booth, "staging", None) is not None:
+                sample["staged_kb"] = booth.staging.used() // 1024
+        if tracemalloc.is_tracing():
+            sample["traced_kb"] = tracemalloc.get_traced_memory()[0] // 1024
+        sample.update(fields)
+        self.history.append(sample)
+        return sample
+
+    def format(self, sample):
+        return "resources: " + ", ".join(
+            "{} {}".format(k, v) for k, v in sample.items() if k != "t")
+
+    def snapshot(self):
+        # tracemalloc reference point for top()
+        if tracemalloc.is_tracing():
+            gc.collect()
+            self.baseline = tracemalloc.take_snapshot()
+
+    def top(self, n=10):
+        # the source lines that allocated the most since snapshot()
+        if self.baseline is None or not tracemalloc.is_tracing():
+            return []
+        gc.collect()
+        stats = tracemalloc.take_snapshot().compare_to(self.baseline,
+                                                       "lineno")
+        return ["{}:{} {:+.1f} KiB in {:+d} blocks".format(
+                    s.traceback[0].filename, s.traceback[0].lineno,
+                    s.size_diff / 1024, s.count_diff)
+                for s in stats[:n] if s.size_diff > 0]
+
+
+def find_leaks(samples, warmup=0.2, tolerance=TOLERANCE):
+    # {counter: (middle third max, last third max)} for the counters that
+    # kept growing
+    samples = samples[int(len(samples) * warmup):]
+    if len(samples) < 6:
+        return {}
+    third = len(samples) // 3
+    middle, last = (samples[third:2 * third], samples[2 * third:])
+    leaks = {}
+    for key, allowed in tolerance.items():
+        before = [s[key] for s in middle if s.get(key) is not None]
+        after = [s[key] for s in last if s.get(key) is not None]
+        if before and after and max(after) > max(before) + allowed:
+            leaks[key] = (max(before), max(after))
+    return leaks
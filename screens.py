@@ -0,0 +1,87 @@
+# Screen and asset cache for the Tk display.
+#
+# Fonts are loaded once per size, static screens are turned into PhotoImages
+# once, and parameterised screens (e.g. "photo 2 / 4 !" on the smile
+# background) are rendered once per distinct set of arguments. Showing a
+# screen is then only a canvas item swap.
+
+import collections
+from PIL import ImageFont
+
+FONT_PATH = 'Pillow/Tests/fonts/FreeMonoBold.ttf'
+
+
+class ScreenCache():
+    def __init__(self, photo_factory=None, font_path=FONT_PATH, max_size=32):
+        if photo_factory is None:
+            from PIL import ImageTk
+            photo_factory = ImageTk.PhotoImage
+        self.photo_factory = photo_factory
+        self.font_path = font_path
+        self.max_size = max_size
+        self.fonts = {}
+        self.renderers = {}
+        self.static = {}
+        self.photos = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.switch_times = collections.deque(maxlen=100)
+
+    def font(self, size):
+        if size not in self.fonts:
+            try:
+                self.fonts[size] = ImageFont.truetype(self.font_path, size)
+            except OSError:
+                # font missing (e.g. off the Pi): Pillow's built-in one
+                self.fonts[size] = ImageFont.load_default()
+        return self.fonts[size]
+
+    def add(self, name, img):
+        # static screen, converted right away and never evicted
+        self.static[name] = self.photo_factory(img)
+
+    def register(self, name, render):
+        # parameterised screen: render(*args) returns a PIL image
+        self.renderers[name] = render
+
+    def prerender(self, name, *args):
+        # warm-up lookups are not counted, hit or miss
+        hits, misses = self.hits, self.misses
+        self.get(name, *args)
+        self.hits, self.misses = hits, misses
+
+    def get(self, name, *args):
+        if not args and name in self.static:
+            self.hits += 1
+            return self.static[name]
+        key = (name,) + args
+        if key in self.photos:
+            self.hits += 1
+            self.photos.move_to_end(key)
+            return self.photos[key]
+        self.misses += 1
+        photo = self.photo_factory(self.renderers[name](*args))
+        self.photos[key] = photo
+        while len(self.photos) > self.max_size:
+            self.photos.popitem(last=False)
+        return photo
+
+    def record_switch(self, seconds):
+        self.switch_times.append(seconds)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        times = sorted(self.switch_times)
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "cached": len(self.static) + len(self.photos),
+                "switch_ms_median": 1000 * times[len(times) // 2] if times else 0.0,
+                "switch_ms_max": 1000 * times[-1] if times else 0.0}
+
+    def report(self):
+        return ("screen cache: {hits} hits / {misses} misses "
+                "({hit_rate:.0%}), {cached} screens, switch median "
+                "{switch_ms_median:.1f} ms max {switch_ms_max:.1f} ms").format(
+                    **self.stats())
+
@@ -0,0 +1,114 @@
+# Non-blocking state machine driven by the Tk event loop.
+#
+# Each state has an `enter` callback and a table of button handlers. Nothing
+# in a state ever blocks: delays are scheduled with root.after(), blocking
+# work (capture, montage, printing) is handed to an executor and its result
+# comes back to the Tk thread through a queue drained every `poll_interval`
+# seconds, together with button releases. Every transition bumps an epoch;
+# timers and results scheduled by a state that has been left are dropped.
+
+import queue
+
+
+class StateMachine():
+    def __init__(self, root, buttons=None, logger=None, poll_interval=0.02,
+                 initial=None):
+        self.root = root
+        self.buttons = buttons
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.initial = initial
+        self.states = {}
+        self.state = None
+        self.epoch = 0
+        self.inbox = queue.Queue()
+        self.transitions = 0
+
+    def add(self, name, enter=None, buttons=None):
+        # buttons: {"green": "next_state" or callable}
+        self.states[name] = (enter, buttons or {})
+
+    def start(self, state, *args):
+        if self.initial is None:
+            self.initial = state
+        self.goto(state, *args)
+        self._pump()
+
+    def goto(self, state, *args):
+        self.epoch += 1
+        self.transitions += 1
+        self.state = state
+        if self.logger is not None:
+            self.logger.debug("state {}".format(state))
+        if self.buttons is not None:
+            self.buttons.arm()
+        enter = self.states[state][0]
+        if enter is not None:
+            self._call(enter, *args)
+
+    def _call(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            if self.logger is not None:
+                self.logger.error("error in state {}".format(self.state),
+                                  exc_info=True)
+            if self.initial is not None and self.state != self.initial:
+                self.goto(self.initial)
+
+    def _guard(self, fn):
+        # run fn only if no transition happened since it was scheduled
+        epoch = self.epoch
+
+        def guarded(*args):
+            if epoch == self.epoch:
+                self._call(fn, *args)
+        return guarded
+
+    def after(self, seconds, fn, *args):
+        return self.root.after(int(1000 * seconds), self._guard(fn), *args)
+
+    def post(self, fn, *args):
+        # thread safe: run fn(*args) on the Tk thread, in the current state
+        self.inbox.put((self._guard(fn), args))
+
+    def callback(self, fn):
+        # thread-safe function running fn on the Tk thread, as long as the
+        # machine is still in the state that created it
+        guarded = self._guard(fn)
+        return lambda *args: self.inbox.put((guarded, args))
+
+    def run_in(self, executor, fn, *args, then=None):
+        # run fn in the executor, then(result) back on the Tk thread
+        # errors are raised on the Tk thread, where they are logged
+        future = executor.submit(fn, *args)
+
+        def finished(f):
+            result = f.result()
+            if then is not None:
+                then(result)
+        done = self._guard(finished)
+        future.add_done_callback(lambda f: self.inbox.put((done, (f,))))
+        return future
+
+    def button(self, name):
+        handler = self.states[self.state][1].get(name)
+        if handler is None:
+            return
+        if callable(handler):
+            self._call(handler)
+        else:
+            self.goto(handler)
+
+    def _pump(self):
+        while True:
+            try:
+                fn, args = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            self._call(fn, *args)
+        if self.buttons is not None:
+            name = self.buttons.poll()
+            if name is not None:
+                self.button(name)
+        self.root.after(int(1000 * self.poll_interval), self._pump)
@@ -0,0 +1,80 @@
+# Headless booth simulator.
+#
+# usage: python3 simulate.py [cycles] [speed]
+#
+# Runs full Booth.run() cycles with the simulated backends (synthetic
+# camera frames, scripted button presses, fake CUPS queue, offscreen
+# display, local gallery directory) in a temporary working directory, at
+# `speed` times real time. Sessions are staged in a temporary directory in
+# /dev/shm of their own, removed at the end: a new working directory every
+# run would otherwise leave a new staging root behind every run.
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+from booth_tk import Booth
+from hardware import simulated_backends, SimulatedGuest
+
+ASSETS = ["booth0.png", "booth1.png", "end.png", "print.png"]
+
+
+def make_wd(src=os.path.dirname(os.path.abspath(__file__))):
+    wd = tempfile.mkdtemp(prefix="boothy_sim_")
+    for name in ASSETS:
+        shutil.copy(os.path.join(src, name), wd)
+    os.makedirs(os.path.join(wd, "logs"))
+    return wd
+
+
+def simulate(cycles=1, speed=20.0, script=None, wd=None, logger=None,
+             booth_options=None, setup=None):
+    # setup(booth), if given, runs before the first cycle
+    if logger is None:
+        logger = logging.getLogger("booth.sim")
+    if wd is None:
+        wd = make_wd()
+    booth_options = dict(booth_options or {})
+    staging = None
+    if "staging" not in booth_options and os.path.isdir("/dev/shm"):
+        staging = tempfile.mkdtemp(prefix="boothy_sim_", dir="/dev/shm")
+        booth_options["staging"] = staging
+    backends = simulated_backends(os.path.join(wd, "gallery"), speed)
+    try:
+        booth = Booth(logger, wd=wd, backends=backends, **booth_options)
+        if setup is not None:
+            setup(booth)
+        guest = SimulatedGuest(booth, script, cycles=cycles)
+        t0 = time.monotonic()
+        try:
+            guest.start()
+            booth.run()
+        finally:
+            guest.stop()
+            booth.teardown()
+    finally:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+    return booth, guest, time.monotonic() - t0
+
+
+if __name__ == "__main__":
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    wd = make_wd()
+    try:
+        booth, guest, elapsed = simulate(cycles, speed, wd=wd)
+        print("{} session(s), {} presses in {:.1f}s ({:.0f}x real time)".format(
+            guest.sessions, guest.presses, elapsed, speed))
+        print("photos: {}".format(sorted(os.listdir(os.path.join(wd, "photos")))))
+        print("pipeline: {}".format(booth.pipeline.stats()))
+        print(booth.screens.report())
+        print(booth.metrics.report())
+        with open(os.path.join(wd, "logs", "metrics.jsonl")) as f:
+            print("metrics.jsonl: {} lines".format(len(f.readlines())))
+    finally:
+        shutil.rmtree(wd)
@@ -0,0 +1,99 @@
+# Soak test: thousands of simulated booth cycles, watching for leaks.
+#
+# usage: python3 soak.py [cycles] [speed] [--trace]
+#
+# Runs simulate.py's full Booth.run() cycles at `speed` times real time and
+# samples the resource probe (probe.py) on every home screen: RSS, open
+# file descriptors, child and zombie processes, threads, Tk images and
+# camera overlays, plus Python allocations with --trace (tracemalloc, the
+# top growing allocation sites are listed at the end). Exits with status 1
+# if a counter is still growing in the last third of the run, a pipeline
+# stage failed or anything was logged at ERROR level.
+
+import os
+import sys
+import time
+import shutil
+import logging
+import threading
+import tracemalloc
+from metrics import Metrics
+from probe import ResourceProbe, find_leaks
+from simulate import simulate, make_wd
+
+
+class ErrorCounter(logging.Handler):
+    # keeps the ERROR records, whatever logger they went to
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def soak(cycles=1000, speed=500.0, trace=False, warmup=0.2):
+    if trace:
+        tracemalloc.start(1)
+    wd = make_wd()
+    logger = logging.getLogger("booth.soak")
+    logger.setLevel(logging.WARNING)
+    # a short rolling window: an hour of metrics is a lot of cycles here
+    metrics = Metrics(os.path.join(wd, "logs", "metrics.jsonl"), window=60)
+    state = {}
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    def setup(booth):
+        booth.probe = ResourceProbe(booth, history=cycles + 1)
+        state["probe"] = booth.probe
+        threading.Thread(target=progress, args=(booth.probe,),
+                         daemon=True).start()
+
+    def progress(probe):
+        snapshot_at = max(int(cycles * warmup), 1)
+        reported = 0
+        while not state.get("done"):
+            n = len(probe.history)
+            if trace and probe.baseline is None and n >= snapshot_at:
+                probe.snapshot()
+            if n >= reported + max(cycles // 10, 1):
+                reported = n
+                print("  cycle {:5d}: {}".format(n, probe.format(
+                    probe.history[-1])))
+            time.sleep(0.5)
+
+    try:
+        booth, guest, elapsed = simulate(
+            cycles, speed, wd=wd, logger=logger, setup=setup,
+            booth_options={"probe_every": 1, "metrics": metrics})
+    finally:
+        state["done"] = True
+        logging.getLogger().removeHandler(errors)
+        shutil.rmtree(wd)
+    probe = state["probe"]
+    samples = list(probe.history)
+    print("{} cycles in {:.0f}s".format(guest.sessions, elapsed))
+    print("first: {}".format(probe.format(samples[0])))
+    print("last:  {}".format(probe.format(samples[-1])))
+    for line in probe.top():
+        print("  " + line)
+    leaks = find_leaks(samples, warmup)
+    for key, (before, after) in sorted(leaks.items()):
+        print("LEAK {}: {} -> {}".format(key, before, after))
+    failed = {name: stage["failed"] for name, stage in
+              booth.pipeline.stats().items() if stage["failed"]}
+    for name, n in sorted(failed.items()):
+        print("FAILED {}: {} session(s)".format(name, n))
+    for record in errors.records[:10]:
+        print("ERROR {}".format(record.getMessage()))
+    if len(errors.records) > 10:
+        print("ERROR ... {} more".format(len(errors.records) - 10))
+    return not leaks and not failed and not errors.records
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    cycles = int(args[0]) if args else 1000
+    speed = float(args[1]) if len(args) > 1 else 500.0
+    sys.exit(0 if soak(cycles, speed, "--trace" in sys.argv) else 1)
@@ -0,0 +1,256 @@
+# Write-behind RAM staging for session files.
+#
+# A session writes its four captures, the preview, the print strip and the
+# print-ready file while it is in flight; on the SD card every one of those
+# writes can stall behind the card's garbage collection, and so can the
+# capture or the montage waiting on it. With a Staging area they are
+# written to a directory on tmpfs (/dev/shm) instead, and a single flusher
+# thread writes to persistent storage only the files that must be kept:
+#
+#   keep(src, dst)   copy src to dst: all the files of a batch are written
+#                    to "dst.tmp", then fsynced, then renamed over dst, then
+#                    their directories are fsynced once each
+#   drop(dir)        delete a session's RAM directory, after the files
+#                    kept from it before are on disk; a directory with a
+#                    file that could not be flushed stays, for recover()
+#
+# Every kept file has a "src.keep" note with its destination next to it,
+# so after a crash (the process, not the Pi: tmpfs does not survive a
+# reboot) recover() flushes what was not flushed yet and drops the rest.
+# Past `max_bytes` in RAM, workdir() returns None and the session writes
+# straight to the SD card as before.
+
+import os
+import queue
+import shutil
+import hashlib
+import threading
+
+
+class Flush():
+    # the files of one keep_all(), wait() raises when one was not flushed
+    def __init__(self, count):
+        self.count = count
+        self.failed = []
+        self.done = threading.Event()
+        if not count:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            return False
+        if self.failed:
+            raise OSError("not flushed: {}".format(", ".join(self.failed)))
+        return True
+
+
+def default_root(wd, base="/dev/shm"):
+    # one staging root per booth directory, stable across restarts
+    if not os.path.isdir(base):
+        return None
+    digest = hashlib.sha1(os.path.abspath(wd).encode()).hexdigest()[:8]
+    return os.path.join(base, "boothy-" + digest)
+
+
+class Staging():
+    def __init__(self, root, max_bytes=256 * 1024 * 1024, batch=16,
+                 logger=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.batch = batch
+        self.logger = logger
+        os.makedirs(root, exist_ok=True)
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="staging")
+        self._thread.start()
+
+    def used(self):
+        total = 0
+        for top, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(top, name))
+                except OSError:
+                    pass
+        return total
+
+    def workdir(self, name):
+        # RAM directory for a session, None when staging is full
+        if self.used() >= self.max_bytes:
+            if self.logger is not None:
+                self.logger.info("staging full, {} written to disk".format(
+                    name))
+            return None
+        path = os.path.join(self.root, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def keep(self, src, dst, wait=False):
+        return self.keep_all([(src, dst)], wait)
+
+    def keep_all(self, pairs, wait=False):
+        # [(src, dst)]; returns a Flush, wait: block until they are all on
+        # disk (OSError when one could not be)
+        pairs = list(pairs)
+        flush = Flush(len(pairs))
+        for i, (src, dst) in enumerate(pairs):
+            with open(src + ".keep.tmp", "w") as f:
+                f.write(os.path.abspath(dst))
+            os.replace(src + ".keep.tmp", src + ".keep")
+            self._queue.put(("keep", src, dst, flush))
+        if wait:
+            flush.wait()
+        return flush
+
+    def drop(self, path):
+        # path: a directory from workdir()
+        self._queue.put(("drop", path, None, None))
+
+    def recover(self):
+        # files noted for keeping by a previous run, and its leftovers;
+        # returns the number of files flushed again
+        pairs = []
+        entries = sorted(os.listdir(self.root))
+        for name in entries:
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            for note in sorted(os.listdir(path)):
+                if not note.endswith(".keep"):
+                    continue
+                src = os.path.join(path, note[:-len(".keep")])
+                with open(os.path.join(path, note)) as f:
+                    dst = f.read().strip()
+                if os.path.exists(src) and dst:
+                    pairs.append((src, dst))
+        for src, dst in pairs:
+            self._queue.put(("keep", src, dst, None))
+        for name in entries:
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                self.drop(path)
+        if pairs and self.logger is not None:
+            self.logger.info("staging: {} file(s) left by the last run "
+                             "flushed again".format(len(pairs)))
+        return len(pairs)
+
+    def _run(self):
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.batch:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            keeps = []
+            for entry in entries:
+                if entry is None:
+                    self._flush(keeps)
+                    return
+                if entry[0] == "keep":
+                    keeps.append(entry)
+                else:
+                    # files kept before the drop go first
+                    self._flush(keeps)
+                    keeps = []
+                    self._drop(entry[1])
+            self._flush(keeps)
+
+    def _drop(self, path):
+        try:
+            unflushed = [n for n in os.listdir(path) if n.endswith(".keep")]
+        except OSError:
+            return
+        if unflushed:
+            # the only copy of these files, left for recover()
+            if self.logger is not None:
+                self.logger.error("staging: {} kept, {} file(s) not "
+                                  "flushed".format(path, len(unflushed)))
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _flush(self, keeps):
+        if not keeps:
+            return
+        written = []
+        for entry in keeps:
+            _, src, dst, _ = entry
+            tmp = dst + ".tmp"
+            fout = None
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                with open(src, "rb") as fin:
+                    fout = open(tmp, "wb")
+                    shutil.copyfileobj(fin, fout, 1024 * 1024)
+                    fout.flush()
+                written.append((entry, tmp, fout))
+            except OSError:
+                self._failed(entry, tmp, fout)
+        # one pass of fsyncs once everything is written, then the renames
+        dirs = set()
+        for entry, tmp, fout in written:
+            _, src, dst, _ = entry
+            try:
+                os.fsync(fout.fileno())
+                fout.close()
+                os.replace(tmp, dst)
+                dirs.add(os.path.dirname(dst))
+                os.remove(src + ".keep")
+                self.flushed += 1
+            except OSError:
+                self._failed(entry, tmp, fout)
+        for path in dirs:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        self.batches += 1
+        for entry in keeps:
+            flush = entry[3]
+            if flush is not None:
+                flush.count -= 1
+                if flush.count == 0:
+                    flush.done.set()
+
+    def _failed(self, entry, tmp, fout):
+        # the source and its .keep note stay, the partial copy goes
+        self.failed += 1
+        if self.logger is not None:
+            self.logger.error("staging: {} not flushed".format(entry[2]),
+                              exc_info=True)
+        if entry[3] is not None:
+            entry[3].failed.append(entry[2])
+        if fout is not None:
+            try:
+                fout.close()
+            except OSError:
+                pass
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {"flushed": self.flushed, "batches": self.batches,
+                "failed": self.failed, "pending": self.pending(),
+                "used": self.used()}
+
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
+        # left in place when a session is still there, for recover()
+        try:
+            os.rmdir(self.root)
+        except OSError:
+            pass
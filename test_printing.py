@@ -0,0 +1,82 @@
+# PrintSpooler against the FakeCups stand-in.
+#
+# usage: python3 -m pytest -q test_printing.py (or python3 test_printing.py)
+
+import os
+import tempfile
+from printing import PrintSpooler, FakeCups
+
+PRINTER = "Canon_SELPHY_CP1300"
+
+
+def spooler_for(cups, **kwargs):
+    return PrintSpooler(cups_module=cups, printer=PRINTER,
+                        poll_interval=0.01, retry_interval=0.05, **kwargs)
+
+
+def strip():
+    fd, path = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    return path
+
+
+def test_paper_out_waits_and_retries():
+    cups = FakeCups(print_time=0.05, start_delay=0.01)
+    cups.out_of_paper()
+    spooler = spooler_for(cups)
+    states = []
+    job = spooler.submit(strip(), callback=lambda job: states.append(
+        (job.state, job.error)))
+    try:
+        while ("error", "media-empty-error") not in states:
+            assert not job.wait(0.05)
+        cups.refill()
+        assert job.wait(5)
+        assert job.state == "done"
+        # the same job, not a second copy
+        assert job.attempts == 1 and len(cups.jobs) == 1
+    finally:
+        spooler.close(timeout=2)
+
+
+def test_fails_after_max_attempts():
+    cups = FakeCups(print_time=0.05, start_delay=0.01)
+    cups.jam()
+    spooler = spooler_for(cups, max_attempts=3)
+    job = spooler.submit(strip())
+    after = spooler.submit(strip())
+    try:
+        assert job.wait(5)
+        assert job.state == "failed" and job.error == "job aborted"
+        assert job.attempts == 3
+        # the jobs behind it are not held up
+        cups.jam(False)
+        assert after.wait(5) and after.state == "done"
+    finally:
+        spooler.close(timeout=2)
+
+
+def test_reconnects_when_cups_lost_the_job():
+    cups = FakeCups(print_time=0.3, start_delay=0.01)
+    spooler = spooler_for(cups)
+    submitted = []
+    job = spooler.submit(strip(), callback=lambda job: job.state ==
+                         "submitted" and submitted.append(job.job_id))
+    try:
+        while not submitted:
+            assert not job.wait(0.01)
+        cups.restart()
+        assert job.wait(5)
+        assert job.state == "done"
+        # a new connection, the job submitted again
+        assert cups.connections == 2
+        assert job.attempts == 2 and len(submitted) == 2
+    finally:
+        spooler.close(timeout=2)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("{} ok".format(name))
@@ -0,0 +1,126 @@
+# UploadWorker and its journal against the LocalTransport stand-in.
+#
+# usage: python3 -m pytest -q test_upload.py (or python3 test_upload.py)
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from upload import UploadJournal, UploadWorker, LocalTransport
+
+
+def photos(wd, n):
+    paths = []
+    for i in range(n):
+        path = os.path.join(wd, "p{}.jpg".format(i))
+        with open(path, "wb") as f:
+            f.write(b"jpeg" * (i + 1))
+        paths.append(path)
+    return paths
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def journal_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_replay_after_restart():
+    wd = tempfile.mkdtemp(prefix="boothy_test_")
+    try:
+        journal = os.path.join(wd, "journal.jsonl")
+        transport = LocalTransport(os.path.join(wd, "gallery"))
+        transport.is_online = False
+        worker = UploadWorker(transport, journal, min_backoff=10)
+        paths = photos(wd, 3)
+        for path in paths:
+            worker.enqueue(path)
+        worker.close(timeout=2)
+        # unplugged: the next start finds them in the journal
+        transport.is_online = True
+        worker = UploadWorker(transport, journal, min_backoff=0.05)
+        try:
+            assert wait_for(lambda: worker.depth() == 0)
+            assert sorted(os.listdir(transport.dest_dir)) == [
+                "p0.jpg", "p1.jpg", "p2.jpg"]
+            assert journal_lines(journal) == []
+        finally:
+            worker.close(timeout=2)
+    finally:
+        shutil.rmtree(wd)
+
+
+def test_torn_last_line():
+    wd = tempfile.mkdtemp(prefix="boothy_test_")
+    try:
+        path = os.path.join(wd, "journal.jsonl")
+        with open(path, "w") as f:
+            f.write('{"add": "/a.jpg"}\n{"add": "/b.jpg"}\n'
+                    '{"done": "/a.jpg"}\n{"add": "/c.j')
+        journal = UploadJournal(path)
+        assert list(journal.pending) == ["/b.jpg"]
+        # rewritten whole, the torn line is gone
+        assert journal_lines(path) == [{"add": "/b.jpg"}]
+        journal.add("/d.jpg")
+        assert list(UploadJournal(path).pending) == ["/b.jpg", "/d.jpg"]
+    finally:
+        shutil.rmtree(wd)
+
+
+def test_compacts_while_paths_stay_pending():
+    wd = tempfile.mkdtemp(prefix="boothy_test_")
+    try:
+        path = os.path.join(wd, "journal.jsonl")
+        journal = UploadJournal(path, compact_after=10)
+        for i in range(25):
+            journal.add("/{}.jpg".format(i))
+        for i in range(24):
+            journal.done(["/{}.jpg".format(i)])
+        # never empty, still not 25 adds and 24 dones
+        assert len(journal_lines(path)) < 15
+        assert list(UploadJournal(path).pending) == ["/24.jpg"]
+    finally:
+        shutil.rmtree(wd)
+
+
+def test_offline_backoff():
+    wd = tempfile.mkdtemp(prefix="boothy_test_")
+    try:
+        transport = LocalTransport(os.path.join(wd, "gallery"))
+        transport.is_online = False
+        worker = UploadWorker(transport, os.path.join(wd, "journal.jsonl"),
+                              min_backoff=0.02, max_backoff=0.08)
+        try:
+            worker.enqueue(photos(wd, 1)[0])
+            # doubles from min_backoff up to max_backoff, nothing lost
+            backoffs = set()
+            assert wait_for(lambda: backoffs.add(worker.backoff) or
+                            worker.backoff == 0.08)
+            assert backoffs <= {0, 0.02, 0.04, 0.08}
+            assert worker.last_error == "offline"
+            assert worker.uploaded == 0 and worker.depth() == 1
+            transport.is_online = True
+            worker.retry_now()
+            assert wait_for(lambda: worker.depth() == 0)
+            assert worker.backoff == 0 and worker.last_error is None
+            assert transport.uploads == 1
+        finally:
+            worker.close(timeout=2)
+    finally:
+        shutil.rmtree(wd)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("{} ok".format(name))
@@ -0,0 +1,144 @@
+# Deadline-based timeline for the capture sequence.
+#
+# Countdowns used to chain "show the digit, then wait one second": every
+# tick was late by the time the previous one took to draw, and the delays
+# added up over a session, so the shutter did not fire on the beat after
+# "1". A Timeline plans the whole sequence up front as deadlines on a
+# monotonic clock, relative to its start (tick displays, shutters, pauses),
+# so a slow step makes one event late instead of shifting all the others.
+#
+# Each event may have a `prepare` step run `prewarm` seconds ahead of its
+# deadline (render the next digit, fetch the next screen), so the work left
+# at the deadline itself is small. The achieved-versus-planned error of
+# every event is kept and, with a Metrics, recorded as "timeline.<kind>".
+#
+# start() drives the events from a Tk-style after(seconds, fn) timer
+# (StateMachine.after); run() is the blocking version for pbooth.py.
+
+import time
+
+
+class Event():
+    def __init__(self, offset, kind, fn, args, prepare=None, fields=None):
+        self.offset = offset
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.prepare = prepare
+        self.fields = fields or {}
+        self.deadline = None
+        self.error = None
+
+
+class Timeline():
+    def __init__(self, after=None, clock=time.monotonic, prewarm=0.1,
+                 metrics=None, session=None, logger=None):
+        self.after = after
+        self.clock = clock
+        self.prewarm = prewarm
+        self.metrics = metrics
+        self.session = session
+        self.logger = logger
+        self.events = []
+        self.started = None
+        self.cancelled = False
+
+    def at(self, offset, kind, fn=None, *args, prepare=None, **fields):
+        # offset: seconds from the start of the timeline
+        event = Event(offset, kind, fn, args, prepare, fields)
+        self.events.append(event)
+        return event
+
+    def end(self):
+        return max([e.offset for e in self.events] or [0])
+
+    def start(self, now=None):
+        self.started = self.clock() if now is None else now
+        for event in sorted(self.events, key=lambda e: e.offset):
+            event.deadline = self.started + event.offset
+            self.after(max(event.deadline - self.prewarm - self.clock(), 0),
+                       self._wake, event)
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _wake(self, event):
+        # ahead of the deadline: prepare, then wait for the rest of the time
+        if self.cancelled:
+            return
+        self._prepare(event)
+        self.after(max(event.deadline - self.clock(), 0), self._fire, event)
+
+    def _prepare(self, event):
+        if event.prepare is not None:
+            try:
+                event.prepare()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error("timeline: preparing {} failed".format(
+                        event.kind), exc_info=True)
+
+    def _fire(self, event):
+        if self.cancelled:
+            return
+        event.error = self.clock() - event.deadline
+        if self.metrics is not None:
+            # the histogram has the lateness, the event its signed error
+            self.metrics.record(
+                "timeline." + event.kind, 1000 * max(event.error, 0),
+                self.session, error_ms=round(1000 * event.error, 2),
+                planned=event.offset, **event.fields)
+        if event.fn is not None:
+            event.fn(*event.args)
+
+    def run(self, sleep=time.sleep):
+        # blocking: sleep until each deadline in turn
+        self.started = self.clock()
+        for event in sorted(self.events, key=lambda e: e.offset):
+            if self.cancelled:
+                return
+            event.deadline = self.started + event.offset
+            wait = event.deadline - self.prewarm - self.clock()
+            if wait > 0:
+                sleep(wait)
+            self._prepare(event)
+            wait = event.deadline - self.clock()
+            if wait > 0:
+                sleep(wait)
+            self._fire(event)
+
+    def errors(self):
+        # [(kind, planned offset, error in seconds)] of the events fired
+        return [(e.kind, e.offset, e.error) for e in self.events
+                if e.error is not None]
+
+    def report(self):
+        fired = [e for e in self.events if e.error is not None]
+        if not fired:
+            return "timeline: no event fired"
+        worst = max(fired, key=lambda e: abs(e.error))
+        return "timeline: {} events, mean error {:+.1f} ms, worst {} at " \
+               "{:.1f}s {:+.1f} ms".format(
+                   len(fired),
+                   1000 * sum(e.error for e in fired) / len(fired),
+                   worst.kind, worst.offset, 1000 * worst.error)
+
+
+def capture_sequence(timeline, shots, countdown, pause, tick, shutter,
+                     prepare_tick=None, prepare_shutter=None):
+    # shot n (from 1): digits countdown..1 a second apart, the shutter on
+    # the next beat, then `pause` seconds before the next countdown;
+    # returns the offset at which the last pause ends
+    for shot in range(1, shots + 1):
+        base = (shot - 1) * (countdown + pause)
+        for i, s in enumerate(range(countdown, 0, -1)):
+            timeline.at(base + i, "tick", tick, shot, s,
+                        prepare=prepare_tick and (
+                            lambda shot=shot, s=s: prepare_tick(shot, s)),
+                        shot=shot, value=s)
+        timeline.at(base + countdown, "shutter", shutter, shot,
+                    prepare=prepare_shutter and (
+                        lambda shot=shot: prepare_shutter(shot)),
+                    shot=shot)
+    return shots * (countdown + pause)
@@ -0,0 +1,281 @@
+# Resumable gallery upload worker.
+#
+# Photos to upload are appended to an on-disk journal before anything else
+# happens, so nothing is lost when the venue Wi-Fi drops or the Pi is
+# unplugged: pending files are replayed from the journal on the next start.
+# A single worker thread uploads them in batches over one reused SSH
+# connection (OpenSSH connection multiplexing), runs the remote gallery sync
+# once per batch, and backs off exponentially while the gallery is
+# unreachable.
+
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import subprocess
+import collections
+
+
+class UploadJournal():
+    # append-only JSON lines: {"add": path} / {"done": path}, rewritten
+    # with the pending paths only once empty or `compact_after` paths done
+    def __init__(self, path, compact_after=500):
+        self.path = path
+        self.compact_after = compact_after
+        self.done_entries = 0
+        self.pending = collections.OrderedDict()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn last line after a power cut
+                        continue
+                    if "add" in entry:
+                        self.pending[entry["add"]] = True
+                    elif "done" in entry:
+                        self.pending.pop(entry["done"], None)
+        self.compact()
+
+    def _append(self, entries):
+        with open(self.path, "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, path):
+        if path not in self.pending:
+            self._append([{"add": path}])
+            self.pending[path] = True
+
+    def done(self, paths):
+        self._append([{"done": path} for path in paths])
+        for path in paths:
+            self.pending.pop(path, None)
+        self.done_entries += len(paths)
+        # a long offline stretch must not make every replay slower
+        if not self.pending or self.done_entries >= self.compact_after:
+            self.compact()
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for path in self.pending:
+                f.write(json.dumps({"add": path}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.done_entries = 0
+
+    def batch(self, size):
+        return list(self.pending)[:size]
+
+
+class SshTransport():
+    # scp/ssh to the piwigo host, sharing one master connection
+    def __init__(self, host="photo",
+                 remote_dir="/mnt/docker/piwigo/config/www/gallery/galleries/mariage/photomaton/",
+                 sync_cmd="/home/piwigo/sync_piwigo.sh",
+                 probe=("photo.caye.fr", 443),
+                 control_path="/tmp/boothy-ssh-%r@%h:%p",
+                 timeout=60):
+        self.host = host
+        self.remote_dir = remote_dir
+        self.sync_cmd = sync_cmd
+        self.probe = probe
+        self.timeout = timeout
+        self.ssh_opts = ["-o", "ControlMaster=auto",
+                         "-o", "ControlPath={}".format(control_path),
+                         "-o", "ControlPersist=600",
+                         "-o", "ConnectTimeout=10",
+                         "-o", "BatchMode=yes"]
+
+    def online(self):
+        try:
+            socket.create_connection(self.probe, timeout=5).close()
+            return True
+        except OSError:
+            return False
+
+    def upload(self, paths):
+        subprocess.run(["scp"] + self.ssh_opts + list(paths)
+                       + ["{}:{}".format(self.host, self.remote_dir)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       timeout=self.timeout, check=True)
+
+    def sync(self):
+        subprocess.run(["ssh"] + self.ssh_opts + [self.host, self.sync_cmd],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       timeout=self.timeout, check=True)
+
+
+class LocalTransport():
+    # copies into a local directory, for tests and benchmarks
+    def __init__(self, dest_dir, delay=0.0):
+        self.dest_dir = dest_dir
+        self.delay = delay
+        self.is_online = True
+        self.syncs = 0
+        self.uploads = 0
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def online(self):
+        return self.is_online
+
+    def upload(self, paths):
+        if not self.is_online:
+            raise OSError("offline")
+        time.sleep(self.delay)
+        for path in paths:
+            shutil.copy(path, self.dest_dir)
+        self.uploads += 1
+
+    def sync(self):
+        self.syncs += 1
+
+
+class UploadWorker():
+    def __init__(self, transport, journal_path, batch_size=10,
+                 min_backoff=2.0, max_backoff=300.0, logger=None,
+                 metrics=None, on_uploaded=None):
+        self.transport = transport
+        self.journal = UploadJournal(journal_path)
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.logger = logger
+        self.metrics = metrics
+        # called with the paths of every batch uploaded
+        self.on_uploaded = on_uploaded
+        self.backoff = 0
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+        self.batches = 0
+        self.last_error = None
+        self._wake = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def enqueue(self, path):
+        with self._wake:
+            self.journal.add(os.path.abspath(path))
+            self._wake.notify()
+
+    def depth(self):
+        with self._wake:
+            return len(self.journal.pending)
+
+    def stats(self):
+        with self._wake:
+            depth = len(self.journal.pending)
+        return {"pending": depth,
+                "uploaded": self.uploaded,
+                "batches": self.batches,
+                "bytes": self.uploaded_bytes,
+                "throughput_kBps": (self.uploaded_bytes / 1000.0
+                                    / self.upload_seconds
+                                    if self.upload_seconds else 0.0),
+                "backoff": self.backoff,
+                "last_error": self.last_error}
+
+    def _wait(self, timeout):
+        # returns False when closed
+        with self._wake:
+            if not self._closed:
+                self._wake.wait(timeout)
+            return not self._closed
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._closed and not self.journal.pending:
+                    self._wake.wait()
+                if self._closed:
+                    return
+                batch = self.journal.batch(self.batch_size)
+            # files deleted meanwhile are dropped
+            missing = [p for p in batch if not os.path.exists(p)]
+            if missing:
+                with self._wake:
+                    self.journal.done(missing)
+                batch = [p for p in batch if p not in missing]
+                if not batch:
+                    continue
+            if not self._upload(batch):
+                self.backoff = min(max(2 * self.backoff, self.min_backoff),
+                                   self.max_backoff)
+                self.log("upload failed ({}), retrying in {:.0f}s".format(
+                    self.last_error, self.backoff))
+                if not self._wait(self.backoff):
+                    return
+
+    def _upload(self, batch):
+        if not self.transport.online():
+            self.last_error = "offline"
+            self.count("upload_offline")
+            return False
+        t0 = time.monotonic()
+        try:
+            self.transport.upload(batch)
+            self.transport.sync()
+        except Exception as e:
+            # any transport error backs off, the worker thread goes on
+            self.last_error = str(e)
+            self.count("upload_failed")
+            if not isinstance(e, (OSError, subprocess.SubprocessError)) \
+                    and self.logger is not None:
+                self.logger.error("upload failed", exc_info=True)
+            return False
+        elapsed = time.monotonic() - t0
+        self.upload_seconds += elapsed
+        if self.metrics is not None:
+            # photos are named after their session
+            self.metrics.record("upload", 1000 * elapsed, photos=len(batch),
+                                sessions=[os.path.splitext(
+                                    os.path.basename(p))[0] for p in batch])
+        for path in batch:
+            try:
+                self.uploaded_bytes += os.path.getsize(path)
+            except OSError:
+                # deleted since, it was uploaded all the same
+                pass
+        self.uploaded += len(batch)
+        self.batches += 1
+        self.backoff = 0
+        self.last_error = None
+        with self._wake:
+            self.journal.done(batch)
+        if self.on_uploaded is not None:
+            try:
+                self.on_uploaded(batch)
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error("upload callback failed", exc_info=True)
+        self.log("uploaded {} photo(s), {} pending".format(
+            len(batch), len(self.journal.pending)))
+        return True
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def retry_now(self):
+        # e.g. when the network comes back
+        with self._wake:
+            self._wake.notify()
+
+    def close(self, timeout=None):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join(timeout)